@@ -1,44 +1,332 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.interpolate import RBFInterpolator
-from scipy.integrate import simps
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from scipy.interpolate import RBFInterpolator, RegularGridInterpolator, CubicHermiteSpline
+from scipy.integrate import solve_ivp
+from scipy.optimize import brentq
+from scipy.integrate import simpson
+from dataloader import load_scan_data
+from fieldfit import fit_field_map
 
-def interpolate_grid(filename, ds=0.0005, neighbors=12, downsample_factor=1, dtype=np.float32):
+def detect_line_grid(xz, grid_tol=1e-5, min_samples=4):
+    '''
+    Check whether midplane points come from scan lines along z at fixed x positions.
+    Input:  xz ((n, 2) array of x, z in meters)
+            grid_tol (maximum spread of x within a line in meters)
+    Output: list of index arrays (one per line, ordered by x), or None for scattered data
+    '''
+    order = np.argsort(xz[:, 0], kind='stable')
+    breaks = np.nonzero(np.diff(xz[order, 0]) > grid_tol)[0] + 1
+    lines = np.split(order, breaks)
+    counts = np.array([line.shape[0] for line in lines])
+    if len(lines) < 2 or counts.min() < min_samples or counts.max() > 1.05 * counts.min():
+        return None
+    return lines
+
+def line_grid_interpolator(xyzB, lines, method='cubic'):
+    '''
+    Resample scan lines onto a common z axis and build a RegularGridInterpolator over (x, z).
+    Input:  xyzB ((n, 6) array in SI units)
+            lines (index arrays from detect_line_grid)
+    Output: interpolator called like the RBF interpolator with (n, 2) x, z points, returns (n, 3) B
+    '''
+    x = np.array([np.mean(xyzB[line, 0]) for line in lines])
+    lines = [line[np.argsort(xyzB[line, 2], kind='stable')] for line in lines]
+    z_min = max(xyzB[line[0], 2] for line in lines)
+    z_max = min(xyzB[line[-1], 2] for line in lines)
+    z = np.linspace(z_min, z_max, max(line.shape[0] for line in lines))
+    B = np.array([[np.interp(z, xyzB[line, 2], xyzB[line, 3+k]) for k in range(3)] for line in lines]).transpose((0, 2, 1))
+    if min(x.shape[0], z.shape[0]) < 4:
+        method = 'linear'
+    return RegularGridInterpolator((x, z), B, method=method, bounds_error=False, fill_value=None)
+
+def _catmull_rom_weights(t):
+    '''
+    t: (...) fractional position between nodes 1 and 2, returns (..., 4) weights of nodes 0..3
+    '''
+    t2, t3 = t * t, t * t * t
+    return np.stack(((-t3 + 2*t2 - t) / 2, (3*t3 - 5*t2 + 2) / 2, (-3*t3 + 4*t2 + t) / 2, (t3 - t2) / 2), axis=-1)
+
+class FieldMap3D:
+    '''
+    Field map on a regular x, y, z grid (m, T) with a vectorized tricubic (Catmull-Rom) lookup.
+    Every lookup gathers the 4x4x4 nodes around each point and contracts them with separable
+    weights, so the cost per point is small and constant.  The grid is padded with one linearly
+    extrapolated node on each side, points outside the map are clamped to its boundary.
+    Called like the midplane interpolators with (n, 3) x, y, z or (n, 2) x, z (y = 0) points.
+    '''
+    is_volume = True
+
+    def __init__(self, x, y, z, B, chunk_size=50000):
+        '''
+        x, y, z: uniformly spaced grid axes, B: (n_x, n_y, n_z, 3) field at the nodes
+        '''
+        self.axes = [np.asarray(axis, dtype=float) for axis in (x, y, z)]
+        self.shape = np.array([axis.shape[0] for axis in self.axes])
+        B = np.asarray(B, dtype=float)
+        if np.any(self.shape < 2):
+            raise ValueError('Volume map needs at least 2 nodes along x, y and z')
+        if B.shape != tuple(self.shape) + (3,):
+            raise ValueError(f'Field shape {B.shape} does not match the grid {tuple(self.shape)}')
+        self.origin = np.array([axis[0] for axis in self.axes])
+        self.spacing = np.array([(axis[-1] - axis[0]) / (axis.shape[0] - 1) for axis in self.axes])
+        if not all(np.allclose(np.diff(axis), step) for axis, step in zip(self.axes, self.spacing)):
+            raise ValueError('Volume map must lie on a uniformly spaced grid')
+        padded = np.pad(B, ((1, 1), (1, 1), (1, 1), (0, 0)), mode='reflect', reflect_type='odd')
+        _, n_y, n_z = padded.shape[:3]
+        self.strides = np.array([n_y * n_z, n_z, 1])
+        # Components stored separately, gathered with flat node indices
+        self.B = np.ascontiguousarray(padded.reshape((-1, 3)).T)
+        # Flat offsets of the 4x4x4 stencil, x major like the weights
+        offsets = np.arange(4)
+        self.stencil = (offsets[:, None, None] * self.strides[0] + offsets[None, :, None] * self.strides[1] + offsets[None, None, :]).ravel()
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return f'Field Map 3D {tuple(int(n) for n in self.shape)} nodes, spacing {self.spacing} m'
+
+    @classmethod
+    def from_points(cls, xyzB):
+        '''
+        xyzB: (n, 6) array (x, y, z, Bx, By, Bz) in SI units covering a regular x, y, z grid
+        '''
+        xyzB = np.asarray(xyzB, dtype=float).reshape((-1, 6))
+        axes = [np.unique(xyzB[:, i]) for i in range(3)]
+        if np.prod([axis.shape[0] for axis in axes]) != xyzB.shape[0]:
+            raise ValueError('Volume data must lie on a regular x, y, z grid')
+        order = np.lexsort((xyzB[:, 2], xyzB[:, 1], xyzB[:, 0]))
+        B = xyzB[order, 3:].reshape(tuple(axis.shape[0] for axis in axes) + (3,))
+        return cls(*axes, B)
+
+    def __call__(self, points):
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if points.shape[1] == 2:
+            points = np.column_stack((points[:, 0], np.zeros(points.shape[0]), points[:, 1]))
+        B = np.empty((points.shape[0], 3))
+        for start in range(0, points.shape[0], self.chunk_size):
+            B[start:start + self.chunk_size] = self.__lookup__(points[start:start + self.chunk_size])
+        return B
+
+    def __lookup__(self, points):
+        u = np.clip((points - self.origin) / self.spacing, 0, self.shape - 1)
+        i = np.minimum(np.floor(u).astype(int), self.shape - 2)
+        w = _catmull_rom_weights(u - i)
+        weights = (w[:, 0, :, None, None] * w[:, 1, None, :, None] * w[:, 2, None, None, :]).reshape((-1, 64))
+        # Padded index of node i-1 is i
+        flat = (i @ self.strides)[:, None] + self.stencil
+        return np.einsum('nk,cnk->nc', weights, self.B[:, flat])
+
+GRID_CACHE_DIR = 'grid_cache'
+_worker_state = {}
+
+def _attach_shared(name, shape):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+def _init_rbf_worker(data_name, data_shape, points_name, points_shape, out_name, neighbors, kernel):
+    '''
+    Runs once per worker process: attach shared arrays and build the worker's own RBF
+    '''
+    data_shm, data = _attach_shared(data_name, data_shape)
+    points_shm, points = _attach_shared(points_name, points_shape)
+    out_shm, out = _attach_shared(out_name, (points_shape[0], 3))
+    _worker_state['shm'] = (data_shm, points_shm, out_shm)
+    _worker_state['points'] = points
+    _worker_state['out'] = out
+    _worker_state['interp'] = RBFInterpolator(data[:, :2], data[:, 2:], neighbors=neighbors, kernel=kernel)
+
+def _evaluate_rbf_chunk(start, stop):
+    _worker_state['out'][start:stop] = _worker_state['interp'](_worker_state['points'][start:stop])
+    return stop - start
+
+def evaluate_rbf_parallel(xz, B, points, neighbors=12, kernel='cubic', workers=None, chunk_size=20000):
+    '''
+    Evaluate a local RBF fit of B(x, z) at points split into chunks over a process pool.
+    Data, points and results live in shared memory so only chunk bounds are sent to workers.
+    Input:  xz ((n, 2) data positions), B ((n, 3) data field values)
+            points ((m, 2) evaluation positions)
+            workers (number of processes, defaults to cpu count)
+    Output: (m, 3) array of B at points
+    '''
+    workers = os.cpu_count() if workers is None else workers
+    data = np.hstack((xz, B)).astype(np.float64)
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    if workers < 2 or points.shape[0] <= chunk_size:
+        return RBFInterpolator(data[:, :2], data[:, 2:], neighbors=neighbors, kernel=kernel)(points)
+    blocks = []
+    try:
+        for array in (data, points, np.zeros((points.shape[0], 3))):
+            shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            np.ndarray(array.shape, dtype=np.float64, buffer=shm.buf)[:] = array
+            blocks.append(shm)
+        bounds = [(i, min(i + chunk_size, points.shape[0])) for i in range(0, points.shape[0], chunk_size)]
+        init_args = (blocks[0].name, data.shape, blocks[1].name, points.shape, blocks[2].name, neighbors, kernel)
+        with ProcessPoolExecutor(max_workers=min(workers, len(bounds)), initializer=_init_rbf_worker, initargs=init_args) as pool:
+            list(pool.map(_evaluate_rbf_chunk, *zip(*bounds)))
+        return np.ndarray((points.shape[0], 3), dtype=np.float64, buffer=blocks[2].buf).copy()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+def grid_cache_key(xyzB, **params):
+    '''
+    Hash of the input data and interpolation parameters, identifies a cached field grid
+    '''
+    digest = hashlib.sha1(np.ascontiguousarray(xyzB).tobytes())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+def load_cached_grid(key, cache_dir=GRID_CACHE_DIR):
+    filename = os.path.join(cache_dir, f'{key}.npz')
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with np.load(filename, allow_pickle=False) as cached:
+            return cached['x'], cached['z'], cached['B_grid']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_cached_grid(key, x, z, B_grid, cache_dir=GRID_CACHE_DIR):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_filename = os.path.join(cache_dir, f'{key}.tmp.npz')
+        np.savez(tmp_filename, x=x, z=z, B_grid=B_grid)
+        os.replace(tmp_filename, os.path.join(cache_dir, f'{key}.npz'))
+    except OSError:
+        print(f'Could not write grid cache {key}')
+
+def stage_key(parent, **params):
+    '''
+    Hash identifying a pipeline stage: the key (or input data array) of the stage it depends on and its own parameters
+    '''
+    if isinstance(parent, str):
+        digest = hashlib.sha1(parent.encode('utf-8'))
+    else:
+        digest = hashlib.sha1(np.ascontiguousarray(parent).tobytes())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+def memoize_stage(name, key, compute, cache_dir=GRID_CACHE_DIR):
+    '''
+    Load the arrays of stage name stored under key, or call compute() and store the dict of arrays it returns
+    '''
+    filename = os.path.join(cache_dir, f'{name}-{key}.npz')
+    if os.path.isfile(filename):
+        try:
+            with np.load(filename, allow_pickle=False) as cached:
+                print(f'Using cached {name} stage {key}')
+                return {k: cached[k] for k in cached.files}
+        except (OSError, ValueError):
+            pass
+    result = compute()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_filename = os.path.join(cache_dir, f'{name}-{key}.tmp.npz')
+        np.savez(tmp_filename, **result)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        print(f'Could not write {name} stage cache {key}')
+    return result
+
+def interpolate_grid(filename, ds=0.0005, neighbors=12, downsample_factor=1, dtype=np.float32, grid_tol=1e-5,
+                     workers=None, use_cache=True, cache_dir=GRID_CACHE_DIR):
     '''
     Read hall probe data from file, create a uniform grid,
     and generate interpolated field values on the grid.
-    Input:  filename (file path to hall probe data)
+    Data measured on scan lines along z is interpolated with a cubic RegularGridInterpolator,
+    scattered data falls back to a cubic RBF.
+    Input:  filename (file path to hall probe data, or (n, 6) array of data in mm and mT)
             ds step (in meters)
             n (downsample factor)
             dtype (data type)
+            grid_tol (maximum spread of x within a scan line in meters)
+            workers (processes used to evaluate the RBF on the grid)
+            use_cache (reuse the field grid stored in cache_dir for the same data and parameters,
+                the interpolator is rebuilt from the data as without the cache, only the grid evaluation is skipped)
     Output: (interpolation object, grid data, x mesh, z mesh, B field grid)
     '''
-    xyzB = np.genfromtxt(filename, dtype=dtype)
+    if isinstance(filename, str):
+        xyzB = load_scan_data(filename).astype(dtype)
+    else:
+        xyzB = np.array(filename, dtype=dtype)
     xyzB /= 1000 # convert to SI units (m and T)
     xyzB = xyzB[::downsample_factor] # downsample data
-    hp_interp = RBFInterpolator(xyzB[:, [0, 2]], xyzB[:, 3:], neighbors=neighbors, kernel='cubic')
-    xyz_min = np.min(xyzB[:, :3], axis=0)
-    xyz_max = np.max(xyzB[:, :3], axis=0)
-    x = np.arange(xyz_min[0], xyz_max[0], ds)
-    z = np.arange(xyz_min[2], xyz_max[2], ds)
-    xyzB_grid = np.zeros((len(z)*len(x), 6))
-    for i, x_value in enumerate(x):
-        for j, z_value in enumerate(z):
-            xyzB_grid[i*len(z) + j] = [x_value, 0, z_value, 0, 0, 0]
-    xyzB_grid[:, 3:] = hp_interp(xyzB_grid[:, [0, 2]])
+    key = grid_cache_key(xyzB, ds=ds, neighbors=neighbors, grid_tol=grid_tol)
+    cached = load_cached_grid(key, cache_dir) if use_cache else None
+    lines = detect_line_grid(xyzB[:, [0, 2]], grid_tol)
+    if cached is not None:
+        print(f'Using cached field grid {key}')
+        x, z, B_grid = cached
+        # Same interpolator as when the grid was computed, building it is cheap compared to evaluating it on the grid
+        if lines is not None:
+            hp_interp = line_grid_interpolator(xyzB, lines)
+        else:
+            hp_interp = RBFInterpolator(xyzB[:, [0, 2]], xyzB[:, 3:], neighbors=neighbors, kernel='cubic')
+    else:
+        xyz_min = np.min(xyzB[:, :3], axis=0)
+        xyz_max = np.max(xyzB[:, :3], axis=0)
+        x = np.arange(xyz_min[0], xyz_max[0], ds)
+        z = np.arange(xyz_min[2], xyz_max[2], ds)
+        # Rows ordered x major, z minor
+        x_grid, z_grid = np.meshgrid(x, z, indexing='ij')
+        xz_points = np.column_stack((x_grid.ravel(), z_grid.ravel()))
+        if lines is not None:
+            print(f'Gridded data: {len(lines)} lines, using RegularGridInterpolator')
+            hp_interp = line_grid_interpolator(xyzB, lines)
+            B_values = hp_interp(xz_points)
+        else:
+            print('Scattered data, using RBFInterpolator')
+            hp_interp = RBFInterpolator(xyzB[:, [0, 2]], xyzB[:, 3:], neighbors=neighbors, kernel='cubic')
+            B_values = evaluate_rbf_parallel(xyzB[:, [0, 2]], xyzB[:, 3:], xz_points, neighbors, 'cubic', workers)
+        # (len(z), len(x), 3) like the meshes
+        B_grid = B_values.reshape((len(x), len(z), 3)).transpose((1, 0, 2))
+        if use_cache:
+            save_cached_grid(key, x, z, B_grid, cache_dir)
     x_mesh, z_mesh = np.meshgrid(x, z)
-    Bx = np.zeros_like(x_mesh)
-    By = np.zeros_like(x_mesh)
-    Bz = np.zeros_like(x_mesh)
-    for i in range(xyzB_grid.shape[0]):
-        xi = np.where(x == xyzB_grid[i, 0])[0]
-        zi = np.where(z == xyzB_grid[i, 2])[0]
-        Bx[zi, xi] = xyzB_grid[i, 3]
-        By[zi, xi] = xyzB_grid[i, 4]
-        Bz[zi, xi] = xyzB_grid[i, 5]
-    B_grid = np.stack((Bx, By, Bz), axis=-1)
+    xyzB_grid = np.zeros((len(z)*len(x), 6))
+    xyzB_grid[:, 0] = x_mesh.T.ravel()
+    xyzB_grid[:, 2] = z_mesh.T.ravel()
+    xyzB_grid[:, 3:] = B_grid.transpose((1, 0, 2)).reshape((-1, 3))
     return (hp_interp, xyzB_grid, x_mesh, z_mesh, B_grid)
 
+def fit_field_model(filename, scan_plane='zx', scan_spacing=1.0, order=5):
+    '''
+    Laplace consistent alternative to the RBF in interpolate_grid.
+    Input:  filename (file path to hall probe data, or (n, 6) array of data in mm and mT)
+            scan_plane ('zx' or 'yz' planar map with lines along z, None for a volume grid)
+            scan_spacing (line spacing in mm)
+            order (order of the complex potential series)
+    Output: LaplaceFieldModel in SI units, callable with (n, 2) x, z points like the RBF interpolator
+    '''
+    if isinstance(filename, str):
+        xyzB = np.array(load_scan_data(filename), dtype=np.float64)
+    else:
+        xyzB = np.array(filename, dtype=np.float64)
+    xyzB /= 1000 # convert to SI units (m and T)
+    model = fit_field_map(xyzB, scan_plane, 'z', scan_spacing / 1000, order)
+    print(f'{model}\nfit residuals rms: {model.residuals["rms"]} T max: {model.residuals["max"]} T')
+    return model
+
+def interpolate_volume(filename, dtype=np.float64):
+    '''
+    Read volume hall probe data measured on a regular x, y, z grid for 3D tracking.
+    Input:  filename (file path to hall probe data, or (n, 6) array of data in mm and mT)
+    Output: FieldMap3D in SI units
+    '''
+    if isinstance(filename, str):
+        xyzB = load_scan_data(filename).astype(dtype)
+    else:
+        xyzB = np.array(filename, dtype=dtype)
+    xyzB /= 1000 # convert to SI units (m and T)
+    field_map = FieldMap3D.from_points(xyzB)
+    print(field_map)
+    return field_map
+
 def plot_field_map(x_mesh, z_mesh, B, save_file=None, show_plot=True):
     '''
     Takes meshgrid and interpolated field data and plots the field map.
@@ -59,10 +347,122 @@ def plot_field_map(x_mesh, z_mesh, B, save_file=None, show_plot=True):
     if show_plot:
         plt.show()
 
-def beam_traj(hp_interp, xyzB, xb, xb_prime, yb, yb_prime, zb, zb_max, ds, hr):
+def _field_lookup(hp_interp, x, y, z):
+    '''
+    One interpolator call for every particle of a bundle.
+    x is (n_traj,), y and z are scalar or (n_traj,), returns (n_traj, 3) B.
+    Volume maps (is_volume) are looked up at x, y, z, midplane interpolators at x, z.
+    '''
+    x = np.asarray(x, dtype=float)
+    if getattr(hp_interp, 'is_volume', False):
+        return hp_interp(np.column_stack((x, np.broadcast_to(y, x.shape), np.broadcast_to(z, x.shape))))
+    return hp_interp(np.column_stack((x, np.broadcast_to(z, x.shape))))
+
+def _paraxial_rhs(hp_interp, z, state, hr):
+    '''
+    state is (4, n_traj) x, y, x', y'; returns d state / dz with one batched field lookup
+    '''
+    B = _field_lookup(hp_interp, state[0], state[1], z)
+    return np.stack((state[2], state[3], B[:, 1] / hr, B[:, 0] / hr))
+
+def _stations_output(hp_interp, z, states, hr):
+    '''
+    states is (n_z, 4, n_traj) at stations z, returns track_bundle outputs with one field lookup
+    '''
+    n_traj = states.shape[2]
+    xyzB_traj = np.zeros((n_traj, len(z), 6))
+    xyzB_traj[:, :, 0] = states[:, 0].T
+    xyzB_traj[:, :, 1] = states[:, 1].T
+    xyzB_traj[:, :, 2] = z
+    xyzB_traj[:, :, 3:] = _field_lookup(hp_interp, xyzB_traj[:, :, 0].ravel(), xyzB_traj[:, :, 1].ravel(),
+                                        xyzB_traj[:, :, 2].ravel()).reshape((n_traj, len(z), 3))
+    xy_prime = np.stack((states[:, 2].T, states[:, 3].T), axis=-1)
+    return xyzB_traj, xy_prime
+
+def track_bundle_rk4(hp_interp, state, zb, zb_max, ds, hr, z_out=None):
+    '''
+    Classic fixed step RK4 for the bundle state (4, n_traj), four batched lookups per step.
+    Output at z_out is interpolated with cubic Hermite splines using the state derivatives.
+    '''
+    z = np.arange(zb, zb_max, ds)
+    states = np.zeros((len(z), 4, state.shape[1]))
+    derivatives = np.zeros_like(states)
+    states[0] = state
+    for i in range(len(z)):
+        k1 = _paraxial_rhs(hp_interp, z[i], states[i], hr)
+        derivatives[i] = k1
+        if i == len(z) - 1:
+            break
+        k2 = _paraxial_rhs(hp_interp, z[i] + ds / 2, states[i] + ds / 2 * k1, hr)
+        k3 = _paraxial_rhs(hp_interp, z[i] + ds / 2, states[i] + ds / 2 * k2, hr)
+        k4 = _paraxial_rhs(hp_interp, z[i] + ds, states[i] + ds * k3, hr)
+        states[i+1] = states[i] + ds / 6 * (k1 + 2*k2 + 2*k3 + k4)
+    if z_out is None:
+        return z, states
+    z_out = np.asarray(z_out, dtype=float)
+    return z_out, CubicHermiteSpline(z, states, derivatives, axis=0)(z_out)
+
+def track_bundle_rk45(hp_interp, state, zb, zb_max, hr, tol=1e-8, z_out=None, ds=0.0005):
+    '''
+    Adaptive Dormand-Prince RK45 (solve_ivp) with relative and absolute tolerance tol on the bundle state.
+    Every right hand side evaluation is one batched lookup for all particles.
+    Output at z_out (default stations every ds) comes from the dense output of the solver.
+    '''
+    z_out = np.arange(zb, zb_max, ds) if z_out is None else np.asarray(z_out, dtype=float)
+    n_traj = state.shape[1]
+    solution = solve_ivp(lambda z, y: _paraxial_rhs(hp_interp, z, y.reshape((4, n_traj)), hr).ravel(),
+                         (zb, z_out[-1]), state.ravel(), method='RK45', rtol=tol, atol=tol, t_eval=z_out)
+    if not solution.success:
+        raise RuntimeError(f'RK45 tracking failed: {solution.message}')
+    return z_out, solution.y.reshape((4, n_traj, -1)).transpose((2, 0, 1))
+
+def track_bundle(hp_interp, xb, xb_prime, yb, yb_prime, zb, zb_max, ds, hr, method='euler', tol=1e-8, z_out=None):
+    '''
+    Propagate a bundle of trajectories through the field map together,
+    making a single batched field lookup per step for all particles.
+    Inputs: hp_interp - interpolator called with (n, 2) x, z points,
+                or a volume map (FieldMap3D) called with (n, 3) x, y, z points for x/y/z motion
+            xb, xb_prime, yb, yb_prime - initial positions and angles, scalars or (n_traj,) arrays
+            zb - initial z position (shared by the bundle)
+            zb_max - final z position
+            ds - step size ('euler', 'rk4') or output station spacing ('rk45')
+            hr - beam stiffness
+            method - 'euler' (first order, fixed step), 'rk4' (fixed step) or 'rk45' (adaptive step)
+            tol - relative and absolute tolerance of 'rk45'
+            z_out - z stations of the output for 'rk4' and 'rk45' (default every ds)
+    Output: xyzB_traj - (n_traj, n_steps, 6) xyz and B field values along the trajectories
+            xy_prime - (n_traj, n_steps, 2) x and y angles along the trajectories
+    '''
+    xb, xb_prime, yb, yb_prime = np.broadcast_arrays(*[np.atleast_1d(np.asarray(i, dtype=float)) for i in (xb, xb_prime, yb, yb_prime)])
+    if method == 'rk4':
+        z, states = track_bundle_rk4(hp_interp, np.stack((xb, yb, xb_prime, yb_prime)), zb, zb_max, ds, hr, z_out)
+        return _stations_output(hp_interp, z, states, hr)
+    elif method == 'rk45':
+        z, states = track_bundle_rk45(hp_interp, np.stack((xb, yb, xb_prime, yb_prime)), zb, zb_max, hr, tol, z_out, ds)
+        return _stations_output(hp_interp, z, states, hr)
+    elif method != 'euler':
+        raise ValueError(f'Unknown tracking method: {method}')
+    z = np.arange(zb, zb_max, ds)
+    n_traj = xb.shape[0]
+    xyzB_traj = np.zeros((n_traj, len(z), 6))
+    xy_prime = np.zeros((n_traj, len(z), 2))
+    xyzB_traj[:, 0, 0] = xb
+    xyzB_traj[:, 0, 1] = yb
+    xyzB_traj[:, :, 2] = z
+    xy_prime[:, 0, 0] = xb_prime
+    xy_prime[:, 0, 1] = yb_prime
+    for i in range(len(z)):
+        xyzB_traj[:, i, 3:] = _field_lookup(hp_interp, xyzB_traj[:, i, 0], xyzB_traj[:, i, 1], z[i])
+        if i < len(z) - 1:
+            xyzB_traj[:, i+1, :2] = xyzB_traj[:, i, :2] + ds * xy_prime[:, i]
+            xy_prime[:, i+1, 0] = xy_prime[:, i, 0] + ds * xyzB_traj[:, i, 4] / hr
+            xy_prime[:, i+1, 1] = xy_prime[:, i, 1] + ds * xyzB_traj[:, i, 3] / hr
+    return xyzB_traj, xy_prime
+
+def beam_traj(hp_interp, xyzB, xb, xb_prime, yb, yb_prime, zb, zb_max, ds, hr, method='euler', tol=1e-8, z_out=None):
     '''
     Calculate beam trajectory given initial conditions and field map.
-    Inputs: hp_interp - RBFInterpolator object
+    Inputs: hp_interp - midplane interpolator or volume map (FieldMap3D)
             xyzB - grid data - not currently used.  future use for domain verification
             xb - initial x position
             xb_prime - initial x angle
@@ -72,29 +472,12 @@ def beam_traj(hp_interp, xyzB, xb, xb_prime, yb, yb_prime, zb, zb_max, ds, hr):
             zb_max - final z position
             ds - step size
             hr - beam stiffness
+            method, tol, z_out - integrator options, see track_bundle
     Output: xyzB_traj - xyz and B field values along trajectory
             xy_prime - x and y angles along trajectory
     '''
-    z = np.arange(zb, zb_max, ds)
-    xp = np.zeros(len(z))
-    yp = np.zeros(len(z))
-    xyzB_traj = np.zeros((len(z), 6))
-    xyzB_traj[0] = [xb, yb, zb, 0, 0, 0]
-    xyzB_traj[:, 2] = z
-    xp[0] = xb_prime
-    yp[0] = yb_prime
-    for i, z_step in enumerate(xyzB_traj):
-        # xyzB_traj[i, 3:] = hp_interp(z_step[:3].reshape((1,3)))
-        xyzB_traj[i, 3:] = hp_interp(z_step[[0, 2]].reshape((1,2)))
-        if i < len(z) - 1:
-            xyzB_traj[i+1, 0] = xyzB_traj[i, 0] + ds * xp[i]
-            xyzB_traj[i+1, 1] = xyzB_traj[i, 1] + ds * yp[i]
-            dxb_prime = ds * xyzB_traj[i, 4] / hr
-            xp[i+1] = xp[i] + dxb_prime
-            dyb_prime = ds * xyzB_traj[i, 3] / hr
-            yp[i+1] = yp[i] + dyb_prime
-    xy_prime = np.stack((xp, yp), axis=-1)
-    return xyzB_traj, xy_prime
+    xyzB_traj, xy_prime = track_bundle(hp_interp, xb, xb_prime, yb, yb_prime, zb, zb_max, ds, hr, method, tol, z_out)
+    return xyzB_traj[0], xy_prime[0]
 
 def plot_trajectory(xyzB_traj, xy_prime, save_file=None, show_plot=True):
     '''
@@ -149,49 +532,66 @@ def plot_traj_diff(start_positions, dtetas, fit_dteta, xc, save_file=None, show_
     if show_plot:
         plt.show()
 
-def find_optimal_start(hp_data_interp, xyzB_grid, Teta_in, x_min, x_max, z_min, z_max, ds, HR, save_plot=False, show_plot=True):
-    trajectories = []
-    xy_primes = []
-    start_positions = np.arange(x_min, x_max + ds, ds)
-    print(f'start_positions shape = {start_positions.shape}')
-    for start in start_positions:
-        traj, xy_prime = beam_traj(hp_data_interp, xyzB_grid, start, Teta_in, 0, 0, z_min, z_max, ds, HR)
-        trajectories.append(traj)
-        xy_primes.append(xy_prime)
-    trajectories = np.array(trajectories)
-    xy_primes = np.array(xy_primes)
-    dtetas = xy_primes[:, 0] + xy_primes[:, -1]
-    print(f'dtetas shape = {dtetas[:, 0].shape}')
-    fit_dteta = np.polyfit(start_positions, dtetas[:, 0], 1)
-    xc = np.roots(fit_dteta)[0]
-    opt_traj, opt_xy_prime = beam_traj(hp_data_interp, xyzB_grid, xc, Teta_in, 0, 0, z_min, z_max, ds, HR)
+def find_optimal_start(hp_data_interp, xyzB_grid, Teta_in, x_min, x_max, z_min, z_max, ds, HR, save_plot=False, show_plot=True,
+                       method='euler', tol=1e-8, sweep=False, num_sweep=21, xtol=1e-7):
+    '''
+    Find the start position xc between x_min and x_max where the trajectory is symmetric,
+    ie. the entry and exit angles cancel: x'(z_min) + x'(z_max) = 0.
+    The condition is solved with Brent's method, which needs only a handful of trajectories.
+    sweep=True also tracks num_sweep start positions as one bundle for the diagnostic plots.
+    Output: optimal trajectory, its angles and xc
+    '''
+    def dteta(start):
+        _, xy_prime = track_bundle(hp_data_interp, start, Teta_in, 0, 0, z_min, z_max, ds, HR, method, tol)
+        return xy_prime[0, 0, 0] + xy_prime[0, -1, 0]
+    try:
+        xc, result = brentq(dteta, x_min, x_max, xtol=xtol, full_output=True)
+    except ValueError:
+        raise ValueError(f'Angle difference does not change sign between x_min={x_min} and x_max={x_max}, '
+                         'widen the start range or use sweep=True to inspect it')
+    print(f'xc = {xc:.9f} m after {result.function_calls} trajectories')
+    opt_traj, opt_xy_prime = beam_traj(hp_data_interp, xyzB_grid, xc, Teta_in, 0, 0, z_min, z_max, ds, HR, method, tol)
+    if sweep and (save_plot or show_plot):
+        start_positions = np.linspace(x_min, x_max, num_sweep)
+        # Track all sweep start positions as one bundle
+        trajectories, xy_primes = track_bundle(hp_data_interp, start_positions, Teta_in, 0, 0, z_min, z_max, ds, HR, method, tol)
+        dtetas = xy_primes[:, 0] + xy_primes[:, -1]
+        fit_dteta = np.polyfit(start_positions, dtetas[:, 0], 1)
     if save_plot:
-        plot_trajectory(trajectories, xy_primes, save_file='trajectories.pdf', show_plot=False)
         plot_trajectory(opt_traj, opt_xy_prime, save_file='optimal_trajectory.pdf', show_plot=False)
-        plot_traj_diff(start_positions, dtetas, fit_dteta, xc, save_file='dteta_fit')
+        if sweep:
+            plot_trajectory(trajectories, xy_primes, save_file='trajectories.pdf', show_plot=False)
+            plot_traj_diff(start_positions, dtetas, fit_dteta, xc, save_file='dteta_fit', show_plot=False)
     elif show_plot:
-        plot_trajectory(trajectories, xy_primes)
-        plot_trajectory(opt_traj, opt_xy_prime)
-        plot_traj_diff(start_positions, dtetas, fit_dteta, xc)
+        if sweep:
+            plot_trajectory(trajectories, xy_primes, show_plot=False)
+        plot_trajectory(opt_traj, opt_xy_prime, show_plot=False)
+        if sweep:
+            plot_traj_diff(start_positions, dtetas, fit_dteta, xc, show_plot=False)
         plt.show()
     return opt_traj, opt_xy_prime, xc
 
-def field_on_traj(optimal_traj, opt_xy_prime, hp_interp, delta=0.0005):
+def field_on_traj(optimal_traj, opt_xy_prime, hp_interp, delta=0.0005, order=5):
+    '''
+    Field along lines across the trajectory, transverse multipoles fitted at every step.
+    All sample points are evaluated in one interpolator call and the polynomial fits of
+    every step share one Vandermonde least squares solve (same scaling as np.polyfit).
+    returns b_pf, a_pf (n_steps, order+1) highest power first, and their integrals
+    '''
     dx = np.arange(-0.010, 0.010 + delta, delta)
-    yh = np.zeros_like(dx)
-    B_all = np.zeros((optimal_traj.shape[0], dx.shape[0],3))
-    b_pf = np.zeros((optimal_traj.shape[0], 6))
-    a_pf = np.zeros_like(b_pf)
-    for i, z_step in enumerate(optimal_traj):
-        xh = z_step[0] + dx * np.cos(opt_xy_prime[i][0])
-        zh = z_step[2] - dx * np.sin(opt_xy_prime[i][0])
-        # B_all[i] = hp_interp(np.stack((xh, yh, zh), axis=-1))
-        B_all[i] = hp_interp(np.stack((xh, zh), axis=-1))
-    for j, B_dx in enumerate(B_all):
-        b_pf[j] = np.polyfit(dx, B_dx[:, 1], 5)
-        a_pf[j] = np.polyfit(dx, B_dx[:, 0], 5)
-    int_b_pf = simps(b_pf, dx=delta, axis=0)
-    int_a_pf = simps(a_pf, dx=delta, axis=0)
+    angle = opt_xy_prime[:optimal_traj.shape[0], 0]
+    xh = optimal_traj[:, 0, None] + dx * np.cos(angle)[:, None]
+    zh = optimal_traj[:, 2, None] - dx * np.sin(angle)[:, None]
+    yh = np.broadcast_to(optimal_traj[:, 1, None], xh.shape)
+    B_all = _field_lookup(hp_interp, xh.ravel(), yh.ravel(), zh.ravel()).reshape((optimal_traj.shape[0], dx.shape[0], -1))
+    V = np.vander(dx, order + 1)
+    scale = np.sqrt(np.sum(V**2, axis=0))
+    # By and Bx of every step are the right hand sides of one solve
+    rhs = np.hstack((B_all[:, :, 1].T, B_all[:, :, 0].T))
+    coeffs = (np.linalg.lstsq(V / scale, rhs, rcond=None)[0] / scale[:, None]).T
+    b_pf, a_pf = coeffs[:optimal_traj.shape[0]], coeffs[optimal_traj.shape[0]:]
+    int_b_pf = simpson(b_pf, dx=delta, axis=0)
+    int_a_pf = simpson(a_pf, dx=delta, axis=0)
     return b_pf, a_pf, int_b_pf, int_a_pf
 
 def plot_coeffs(z, b_coeffs, a_coeffs, int_b_coeffs, int_a_coeffs, save_file=None, show_plot=True):
@@ -1,31 +1,41 @@
 from nicdaq import HallDAQ
 from calibration import get_xyz_calib_values, calib_data, orthogonalize
+from probes import update_active_probe
 from zeisscmm import CMM
+from frames import Frame
+from hardware import HardwareSession, HardwareBusy
 import numpy as np
 from time import sleep
 import tkinter as tk
-from tkinter import filedialog, ttk
+from tkinter import filedialog, ttk, messagebox
 from PIL import Image, ImageTk
 from datetime import datetime
 
 class Cube:
     def __init__(self, cube_alignment_filename: str,\
                  calibration_array: np.ndarray,\
-                 probe_offset_filename: str):
+                 probe_offset_filename: str, session=None):
         self.cube_dict = {}
-        self.daq = HallDAQ(1, 20000, start_trigger=True, acquisition='finite')
-        self.daq.power_on()
-        self.cmm = CMM()
+        self.session = session
+        self.daq = HallDAQ(1, 20000, start_trigger=True, acquisition='finite', session=session, user='Cube Qualification')
+        try:
+            self.daq.power_on()
+            self.cmm = CMM() if session is None else session.connect_cmm()
+        except Exception:
+            self.daq.power_off()
+            self.daq.close_tasks()
+            raise
         self.calib_coeffs = calibration_array
         self.rotation, self.translation = self.load_cube_alignment(cube_alignment_filename)
         self.probe_offset = np.genfromtxt(probe_offset_filename)
-        self.cube_origin_mcs = (np.zeros((3,)) - self.translation)@self.rotation + self.probe_offset
+        self.frame = Frame(self.rotation, self.translation)
+        self.cube_origin_mcs = self.frame.to_mcs(np.zeros((3,))) + self.probe_offset
     
     def cube2mcs(self, coordinate):
-        return (coordinate - self.translation)@self.rotation
+        return self.frame.to_mcs(coordinate)
 
     def mcs2cube(self, coordinate):
-        return coordinate@np.linalg.inv(self.rotation) + self.translation
+        return self.frame.from_mcs(coordinate)
 
     def load_cube_alignment(self, filename: str):
         diff = np.genfromtxt(filename, delimiter=' ')
@@ -43,7 +53,8 @@ class Cube:
         self.cube_dict[cube_dict_key] = np.mean(cal_data, axis=0)
 
     def shutdown(self):
-        self.cmm.close()
+        if self.session is None:
+            self.cmm.close()
         self.daq.power_off()
         self.daq.close_tasks()
     
@@ -55,22 +66,24 @@ class CubeWindow(tk.Toplevel):
         self.cube = None
         self.click_index = None
         self.calib_array = np.load('zg_calib_coeffs.npy')
-        self.images = self.__create_image_dict__()
+        self.keys = ['x1', 'x2', 'x3', 'x4', 'y1', 'y2', 'y3', 'y4', 'z1', 'z2', 'z3', 'z4']
+        # Images are decoded when a step first shows them
+        self.images = {}
         super().__init__(parent)
         self.title('Sensor Orthogonalization')
         self.frm_cube_window = tk.Frame(self)
         self.frm_cube_window.pack()
         self.create_widgets()
+        # Closing the window must also end the hardware lease
+        self.protocol('WM_DELETE_WINDOW', self.close_window)
     
-    def __create_image_dict__(self):
-        image_dict = {}
-        self.keys = ['x1', 'x2', 'x3', 'x4', 'y1', 'y2', 'y3', 'y4', 'z1', 'z2', 'z3', 'z4']
-        images = ['images/cube_x1.jpg', 'images/cube_x2.jpg', 'images/cube_x3.jpg', 'images/cube_x4.jpg',
-                  'images/cube_y1.jpg', 'images/cube_y2.jpg', 'images/cube_y3.jpg', 'images/cube_y4.jpg',
-                  'images/cube_z1.jpg', 'images/cube_z2.jpg', 'images/cube_z3.jpg', 'images/cube_z4.jpg']
-        for i in range(12):
-            image_dict[self.keys[i]] = ImageTk.PhotoImage(Image.open(images[i]))
-        return image_dict
+    def __get_image__(self, key: str):
+        '''
+        returns the PhotoImage of cube side key, kept in self.images so Tk does not drop it
+        '''
+        if key not in self.images:
+            self.images[key] = ImageTk.PhotoImage(Image.open(f'images/cube_{key}.jpg'))
+        return self.images[key]
     
     def create_widgets(self):
         self.btn_load_alignment = ttk.Button(self.frm_cube_window,
@@ -91,13 +104,17 @@ class CubeWindow(tk.Toplevel):
     
     def load_alignment(self):
         self.cube_filename = filedialog.askopenfilename(filetypes=[('Text Files', '*.txt'), ('All Files', '*.*')])
-        self.lbl_img.configure(image=self.images['x1'])
+        self.lbl_img.configure(image=self.__get_image__('x1'))
         self.lbl_img_desc.configure(text='Manually guide hallprobe into cube.')
         self.focus()
     
     def measure_origin(self):
         if self.cube is None:
-            self.cube = Cube(self.cube_filename, self.calib_array, 'fsv_offset.txt')
+            try:
+                self.cube = Cube(self.cube_filename, self.calib_array, 'fsv_offset.txt', HardwareSession.instance())
+            except HardwareBusy as e:
+                messagebox.showerror(title='Hardware Busy', message=str(e))
+                return
             self.manual_position = self.cube.mcs2cube(self.cube.cmm.get_position())
             # self.probe_offset_cube = self.cube.probe_offset@self.cube.rotation
             self.cube_origin_fsv_offset = self.cube.cube2mcs(np.zeros((3,))) + self.cube.probe_offset # cube origin wrt mcs + fsv offset wrt mcs
@@ -137,6 +154,7 @@ class CubeWindow(tk.Toplevel):
                 s_matrix_mcs = np.linalg.inv(self.cube.rotation) @ T
                 np.save('sensitivity.npy', s_matrix_mcs, allow_pickle=False)
                 np.save(f'sensitivity.npy backup {now_str}', s_matrix_mcs, allow_pickle=False)
+                update_active_probe(s_matrix=s_matrix_mcs)
                 # save cube alignment
                 np.save(f'cube_align backup {now_str}.npy', self.cube.rotation, allow_pickle=False)
                 self.lbl_img_desc.configure(text='Cube qualification complete.  Window can now be closed.')
@@ -149,11 +167,11 @@ class CubeWindow(tk.Toplevel):
         if self.click_index is None:
             self.click_index = 0
         self.measure_origin()
-        if self.click_index < 12:
+        if self.cube is not None and self.click_index < 12:
             self.update_step()
         
     def update_step(self):
-        self.lbl_img.configure(image=self.images[self.keys[self.click_index]])
+        self.lbl_img.configure(image=self.__get_image__(self.keys[self.click_index]))
         self.lbl_img_desc.configure(text=f'Rotate cube to side number {self.cube_sequence[self.click_index]}')
     
     def close_window(self):
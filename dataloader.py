@@ -0,0 +1,74 @@
+import numpy as np
+import json
+import os
+from scanfile import ScanFile, SCAN_EXT
+
+CACHE_SUFFIX = '.cache.npy'
+KEY_SUFFIX = '.cache.json'
+DEFAULT_DATASETS = ['area', 'line', 'points', 'area_full']
+
+def source_key(filename: str, skip_header=0):
+    '''
+    mtime and size identify the version of a text file the cache was built from
+    '''
+    stat = os.stat(filename)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'skip_header': skip_header}
+
+def parse_text(filename: str, skip_header=0):
+    '''
+    Read a space delimited scan text file into an (n, m) float64 array
+    '''
+    try:
+        return np.loadtxt(filename, ndmin=2, skiprows=skip_header)
+    except ValueError:
+        # Missing values, use the slower but more forgiving parser
+        return np.atleast_2d(np.genfromtxt(filename, skip_header=skip_header))
+
+def load_text(filename: str, use_cache=True, skip_header=0):
+    '''
+    Load a scan text file.  The parsed array is written to a binary sidecar
+    file (<filename>.cache.npy) which is memory mapped on later loads as long
+    as the text file's mtime and size are unchanged.
+    The returned array is copy-on-write, so in place unit conversions are safe.
+    '''
+    if not use_cache:
+        return parse_text(filename, skip_header)
+    cache_filename = filename + CACHE_SUFFIX
+    key_filename = filename + KEY_SUFFIX
+    key = source_key(filename, skip_header)
+    if os.path.isfile(cache_filename) and os.path.isfile(key_filename):
+        try:
+            with open(key_filename, 'r') as file:
+                cached_key = json.load(file)
+            if cached_key == key:
+                return np.load(cache_filename, mmap_mode='c', allow_pickle=False)
+        except (OSError, ValueError):
+            pass
+    data = parse_text(filename, skip_header)
+    try:
+        np.save(cache_filename, data, allow_pickle=False)
+        with open(key_filename, 'w') as file:
+            json.dump(key, file)
+    except OSError:
+        print(f'Could not write cache for {filename}')
+    return data
+
+def load_scan_data(filename: str, dataset=None, use_cache=True, skip_header=0):
+    '''
+    Load (n, 6) scan data (x, y, z, Bx, By, Bz) from a .scan file or a text file.
+    dataset selects the .scan dataset, defaults to the first of area, line, points, area_full.
+    '''
+    if filename.endswith(SCAN_EXT):
+        scan_file = ScanFile(filename)
+        if dataset is None:
+            dataset = next((i for i in DEFAULT_DATASETS if i in scan_file.datasets()), None)
+            if dataset is None:
+                raise ValueError(f'{filename} has no {", ".join(DEFAULT_DATASETS)} dataset (it has {scan_file.datasets()}), select the dataset explicitly')
+        data = scan_file.read(dataset)
+        return data.reshape((-1, data.shape[-1]))
+    return load_text(filename, use_cache=use_cache, skip_header=skip_header)
+
+def clear_cache(filename: str):
+    for suffix in (CACHE_SUFFIX, KEY_SUFFIX):
+        if os.path.isfile(filename + suffix):
+            os.remove(filename + suffix)
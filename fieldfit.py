@@ -0,0 +1,158 @@
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+axis_index = {'x': 0, 'y': 1, 'z': 2}
+
+class LaplaceFieldModel:
+    '''
+    Laplace consistent field model built from a 2D complex potential series at every
+    longitudinal station z:
+        By + iBx = sum_k C_k(z) w^k,  w = x + iy
+    which is the derivative of the complex potential G(w) = sum_k C_k w^(k+1) / (k+1),
+    B = grad Im G.  Bz follows from the same potential, Bz = Im sum_k C_k'(z) w^(k+1) / (k+1),
+    to leading order in the longitudinal derivatives.
+    The coefficients are interpolated along z with cubic splines, so evaluation at
+    any (x, y, z) is a Horner loop over the series order on whole arrays.
+    Outside the fitted z range the field is zero.
+    '''
+    is_volume = True
+
+    def __init__(self, z: np.ndarray, coeffs: np.ndarray):
+        '''
+        z: (n_z,) stations, coeffs: (n_z, order+1) complex C_k at every station
+        '''
+        self.z = np.asarray(z, dtype=float)
+        self.coeffs = np.asarray(coeffs, dtype=complex)
+        self.order = self.coeffs.shape[1] - 1
+        self.spline = CubicSpline(self.z, self.coeffs, axis=0, extrapolate=False)
+        self.spline_dz = self.spline.derivative()
+        self.residuals = None
+
+    def __repr__(self):
+        return f'Laplace Field Model order {self.order}, {self.z.shape[0]} stations z = {self.z[0]:.4g} .. {self.z[-1]:.4g}'
+
+    def __call__(self, points):
+        '''
+        points: (n, 3) array of x, y, z or (n, 2) array of x, z on the midplane (like RBFInterpolator calls)
+        returns (n, 3) array of Bx, By, Bz
+        '''
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if points.shape[1] == 2:
+            w = points[:, 0] + 0j
+            z = points[:, 1]
+        else:
+            w = points[:, 0] + 1j*points[:, 1]
+            z = points[:, 2]
+        C = np.nan_to_num(self.spline(z))
+        dC = np.nan_to_num(self.spline_dz(z))
+        F = np.zeros(w.shape, dtype=complex)
+        G = np.zeros(w.shape, dtype=complex)
+        for k in range(self.order, -1, -1):
+            F = F * w + C[:, k]
+            G = G * w + dC[:, k] / (k + 1)
+        G *= w
+        return np.column_stack((F.imag, F.real, G.imag))
+
+    def multipoles(self, reference_radius: float):
+        '''
+        returns normal B_n and skew A_n (n_z, order+1) at reference_radius, column n-1 is harmonic n
+        '''
+        scale = reference_radius**np.arange(self.order + 1)
+        return self.coeffs.real * scale, self.coeffs.imag * scale
+
+    def evaluate_residuals(self, data: np.ndarray):
+        '''
+        data: (n, 6) array (x, y, z, Bx, By, Bz)
+        returns dict with rms and max (3,) of measured - model inside the fitted z range and (n, 3) residuals
+        '''
+        data = np.asarray(data, dtype=float).reshape((-1, 6))
+        residuals = data[:, 3:] - self(data[:, :3])
+        inside = (data[:, 2] >= self.z[0]) & (data[:, 2] <= self.z[-1])
+        residuals[~inside] = np.nan
+        self.residuals = {'rms': np.sqrt(np.nanmean(residuals**2, axis=0)),
+                          'max': np.nanmax(np.abs(residuals), axis=0),
+                          'residuals': residuals}
+        return self.residuals
+
+def group_stations(data: np.ndarray, scan_plane: str, scan_direction: str, scan_spacing: float):
+    '''
+    Resample measured lines onto common stations along scan_direction (pcs z).
+    data: (n, 6) array or (lines, samples, 6) array of planar scan lines,
+        or (n, 6) volume data on a regular x, y, z grid (scan_plane None)
+    returns z (n_z,), w (n_points,) complex transverse positions, B (n_points, n_z, 3)
+    '''
+    if scan_plane is None:
+        data = np.asarray(data, dtype=float).reshape((-1, 6))
+        z = np.unique(data[:, 2])
+        order = np.lexsort((data[:, 2], data[:, 1], data[:, 0]))
+        grid = data[order].reshape((-1, z.shape[0], 6))
+        if grid.shape[0] * z.shape[0] != data.shape[0] or not np.allclose(grid[:, :, 2], z):
+            raise ValueError('Volume data must lie on a regular x, y, z grid')
+        return z, grid[:, 0, 0] + 1j*grid[:, 0, 1], grid[:, :, 3:]
+    if scan_direction != 'z':
+        raise ValueError('Scan lines must run along the magnet axis (z) to fit a longitudinal model')
+    across = axis_index[''.join([i for i in scan_plane if i != scan_direction])]
+    if data.ndim == 3:
+        lines = list(data)
+    else:
+        # Line positions relative to the first line, lines need not sit on multiples of the spacing
+        offset = data[:, across] - np.min(data[:, across])
+        line_id = np.rint(offset / scan_spacing).astype(int)
+        on_line = np.abs(offset - line_id * scan_spacing) < scan_spacing / 2
+        lines = [data[on_line & (line_id == i)] for i in np.unique(line_id[on_line])]
+    lines = [line[np.argsort(line[:, 2], kind='stable')] for line in lines if line.shape[0] > 1]
+    s_min = max(line[0, 2] for line in lines)
+    s_max = min(line[-1, 2] for line in lines)
+    ds = np.median(np.concatenate([np.diff(line[:, 2]) for line in lines]))
+    z = np.arange(s_min, s_max + ds / 2, ds)
+    w = np.array([np.mean(line[:, 0]) + 1j*np.mean(line[:, 1]) for line in lines])
+    B = np.array([[np.interp(z, line[:, 2], line[:, 3+k]) for k in range(3)] for line in lines]).transpose((0, 2, 1))
+    return z, w, B
+
+def fit_field_map(data: np.ndarray, scan_plane='zx', scan_direction='z', scan_spacing=1.0, order=5, rcond=None):
+    '''
+    Fit a LaplaceFieldModel to a planar (zx or yz) or volume (scan_plane None) field map.
+    All stations share the transverse sample positions, so the complex least squares
+    problem is solved for every station at once with one pseudo-inverse.
+    Planar maps only constrain the series on one line through the axis, the order is
+    limited to the number of lines - 1.
+    returns LaplaceFieldModel with residuals evaluated at the measured points
+    '''
+    z, w, B = group_stations(data, scan_plane, scan_direction, scan_spacing)
+    order = min(order, w.shape[0] - 1)
+    # Scale transverse positions for conditioning of the Vandermonde matrix
+    r = np.max(np.abs(w)) if np.max(np.abs(w)) > 0 else 1.0
+    V = (w[:, None] / r)**np.arange(order + 1)
+    F = B[:, :, 1] + 1j*B[:, :, 0]
+    if scan_plane is not None and np.all(np.abs(w.imag) <= np.abs(w.real).max() * 1e-6):
+        # Midplane x line: Re C_k fits By and Im C_k fits Bx, each a real least squares problem
+        pinv = np.linalg.pinv(V.real, rcond=1e-15 if rcond is None else rcond)
+        coeffs = pinv @ F.real + 1j*(pinv @ F.imag)
+    elif scan_plane is not None and np.all(np.abs(w.real) <= np.abs(w.imag).max() * 1e-6):
+        # Vertical y line: w^k = (iy)^k mixes By and Bx, solve the real system of both components
+        A = np.vstack((np.hstack((V.real, -V.imag)), np.hstack((V.imag, V.real))))
+        solution = np.linalg.pinv(A, rcond=1e-15 if rcond is None else rcond) @ np.vstack((F.real, F.imag))
+        coeffs = solution[:order + 1] + 1j*solution[order + 1:]
+    else:
+        coeffs = np.linalg.pinv(V, rcond=1e-15 if rcond is None else rcond) @ F
+    coeffs = (coeffs / r**np.arange(order + 1)[:, None]).T
+    model = LaplaceFieldModel(z, coeffs)
+    model.evaluate_residuals(np.asarray(data).reshape((-1, 6)))
+    return model
+
+
+if __name__ == '__main__':
+    from time import perf_counter
+    from dataloader import load_scan_data
+    # Fit every third line of a quadrupole map and check the model against all lines
+    data = np.array(load_scan_data('scans/AQD-0024/AQD-0024 area data.txt')).reshape((23, -1, 6))
+    start = perf_counter()
+    model = fit_field_map(data[::3], 'zx', 'z', 1.0, order=5)
+    print(f'{model}, fit in {perf_counter() - start:.4f} s')
+    print(f'fit residuals rms {model.residuals["rms"]} max {model.residuals["max"]} mT')
+    check = model.evaluate_residuals(data)
+    print(f'all lines residuals rms {check["rms"]} max {check["max"]} mT')
+    points = data.reshape((-1, 6))[:, :3]
+    start = perf_counter()
+    model(points)
+    print(f'{points.shape[0]} evaluations in {perf_counter() - start:.4f} s')
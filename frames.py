@@ -0,0 +1,84 @@
+import numpy as np
+
+class Frame:
+    '''
+    Affine transform from a local coordinate system (pcs, fsv, cube) to the mcs.
+    Follows the Calypso coordinate difference convention used throughout:
+        mcs = (local - translation) @ rotation + probe_offset
+    Coordinates can be (3,), (n, 3) or (m, n, 3) arrays.  Every transform is a
+    single matmul over the whole array and the inverse rotation is computed once.
+    '''
+    def __init__(self, rotation, translation=np.zeros(3), probe_offset=np.zeros(3)):
+        self.rotation = np.asarray(rotation, dtype=float).reshape((3,3))
+        self.translation = np.asarray(translation, dtype=float).reshape((3,))
+        self.probe_offset = np.asarray(probe_offset, dtype=float).reshape((3,))
+        # mcs = local @ matrix + offset
+        self.matrix = self.rotation
+        self.offset = self.probe_offset - self.translation @ self.rotation
+        self.inv_matrix = np.linalg.inv(self.matrix)
+
+    def __repr__(self):
+        return f'Frame(\n{self.matrix},\n{self.offset})'
+
+    @classmethod
+    def from_affine(cls, matrix, offset):
+        '''
+        Frame of mcs = local @ matrix + offset
+        '''
+        return cls(matrix, np.zeros(3), offset)
+
+    @classmethod
+    def from_file(cls, filename: str, probe_offset=np.zeros(3)):
+        '''
+        filename is the Calypso text file of 9 rotation and 3 translation values
+        '''
+        diff = np.genfromtxt(filename)
+        return cls(diff[:-3], diff[-3:], probe_offset)
+
+    def to_mcs(self, coordinates):
+        return np.asarray(coordinates) @ self.matrix + self.offset
+
+    def from_mcs(self, coordinates):
+        return (np.asarray(coordinates) - self.offset) @ self.inv_matrix
+
+    def vector_to_mcs(self, vectors):
+        '''
+        Rotate direction/velocity vectors only (no translation)
+        '''
+        return np.asarray(vectors) @ self.matrix
+
+    def vector_from_mcs(self, vectors):
+        return np.asarray(vectors) @ self.inv_matrix
+
+    def inverse(self):
+        '''
+        Frame mapping mcs coordinates into this frame's local coordinates
+        '''
+        return Frame.from_affine(self.inv_matrix, -self.offset @ self.inv_matrix)
+
+    def compose(self, other):
+        '''
+        Frame that applies self.to_mcs followed by other.to_mcs
+        '''
+        return Frame.from_affine(self.matrix @ other.matrix, self.offset @ other.matrix + other.offset)
+
+    def relative_to(self, other):
+        '''
+        Frame mapping this frame's local coordinates into other's local coordinates
+        eg. pcs_frame.relative_to(fsv_frame).to_mcs(xyz_pcs) returns xyz wrt fsv
+        '''
+        return self.compose(other.inverse())
+
+def field_matrix(rotation, s_matrix):
+    '''
+    Combined sensitivity and rotation matrix used to bring
+    calibrated hall sensor readings into the pcs: rotation @ s_matrix
+    '''
+    return np.asarray(rotation) @ np.asarray(s_matrix)
+
+def transform_field(Bxyz, matrix):
+    '''
+    Bxyz is a (3,), (n, 3) or (m, n, 3) array of field values
+    returns matrix @ B for every row in one matmul
+    '''
+    return np.asarray(Bxyz) @ np.asarray(matrix).T
@@ -1,8 +1,11 @@
 from calibration import filter_data, get_xyz_calib_values, calib_data
+from probes import load_registry, update_active_probe, serial_from_folder
 from nicdaq import HallDAQ
 from time import sleep
 import numpy as np
 import zeisscmm
+from frames import Frame
+from hardware import HardwareSession, HardwareBusy
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
@@ -15,11 +18,18 @@ class FSV:
     GLAZE_THK = 0.01
     TRACE_Z_OFFSET = 0.242
 
-    def __init__(self, fsv_filename: str, probe_calibration_array: np.ndarray):
-        self.daq = HallDAQ(1, 10000, start_trigger=True, acquisition='finite')
-        self.daq.power_on()
-        self.cmm = zeisscmm.CMM()
+    def __init__(self, fsv_filename: str, probe_calibration_array: np.ndarray, session=None):
+        self.session = session
+        self.daq = HallDAQ(1, 10000, start_trigger=True, acquisition='finite', session=session, user='FSV Qualification')
+        try:
+            self.daq.power_on()
+            self.cmm = zeisscmm.CMM() if session is None else session.connect_cmm()
+        except Exception:
+            self.daq.power_off()
+            self.daq.close_tasks()
+            raise
         self.rotation, self.translation = self.import_fsv_alignment(fsv_filename)
+        self.frame = Frame(self.rotation, self.translation)
         self.calibration_coeffs = probe_calibration_array
     
     def calc_offset(self, data_pos: np.ndarray, data_neg: np.ndarray, filter_cutoff=500, fit_lc=125):
@@ -68,10 +78,10 @@ class FSV:
         return (rotation, translation)
 
     def fsv2mcs(self, coordinate: np.ndarray):
-        return (coordinate - self.translation)@self.rotation
+        return self.frame.to_mcs(coordinate)
 
     def mcs2fsv(self, coordinate: np.ndarray):
-        return coordinate@np.linalg.inv(self.rotation) + self.translation
+        return self.frame.from_mcs(coordinate)
 
     def perform_scan(self, start_pt, end_pt, speed=(5,5,5), sensitivity=100, direction='positive'):
         '''
@@ -181,9 +191,11 @@ class FSV:
             file.write(f'{offset_mcs[0]} {offset_mcs[1]} {offset_mcs[2]}\n')
         with open(f'fsv_offset backup {now_str}.txt', 'w') as file:
             file.write(f'{offset_mcs[0]} {offset_mcs[1]} {offset_mcs[2]}\n')
+        update_active_probe(fsv_offset=offset_mcs)
 
     def shutdown(self):
-        self.cmm.close()
+        if self.session is None:
+            self.cmm.close()
         self.daq.power_off()
         self.daq.close_tasks()
 
@@ -200,6 +212,8 @@ class fsvWindow(tk.Toplevel):
         self.img_fsv_y = ImageTk.PhotoImage(Image.open('images/fsv_y.jpg'))
         self.img_fsv_z = ImageTk.PhotoImage(Image.open('images/fsv_z.jpg'))
         self.create_widgets()
+        # Closing the window must also end the hardware lease
+        self.protocol('WM_DELETE_WINDOW', self.__shutdown_tasks__)
     
     def __shutdown_tasks__(self):
         if self.fsv:
@@ -232,9 +246,12 @@ class fsvWindow(tk.Toplevel):
     
     def load_calibration(self):
         calib_folder = filedialog.askdirectory()
-        self.calib_coeffs = get_xyz_calib_values(calib_folder)
         zg_offset = np.genfromtxt('zg_offset.txt')
-        self.calib_coeffs[:, 2, 0] = -zg_offset
+        # Register probe so the mapping routines can switch to it by serial
+        registry = load_registry()
+        probe = registry.register(serial_from_folder(calib_folder), calib_folder, zg_offset=zg_offset)
+        registry.save()
+        self.calib_coeffs = probe.calib_coeffs.copy()
         np.save('zg_calib_coeffs.npy', self.calib_coeffs, allow_pickle=False)
         if (self.fsv_filename and self.calib_coeffs) is not None:
             self.btn_run_x.configure(state='enabled')
@@ -256,7 +273,11 @@ class fsvWindow(tk.Toplevel):
             messagebox.showerror(title='Error', message='Load alignment and calibration files first.')
         else:
             if self.fsv is None:
-                self.fsv = FSV(self.fsv_filename, self.calib_coeffs)
+                try:
+                    self.fsv = FSV(self.fsv_filename, self.calib_coeffs, HardwareSession.instance())
+                except HardwareBusy as e:
+                    messagebox.showerror(title='Hardware Busy', message=str(e))
+                    return
             if offset == 'x':
                 self.fsv.run_x_routine()
                 self.btn_run_x.configure(state='disabled')
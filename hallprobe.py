@@ -3,16 +3,43 @@ import zeisscmm
 import numpy as np
 from time import sleep, perf_counter
 from calibration import calib_data, remove_outliers, average_sample, filter_data
+from probes import load_registry
+from frames import Frame, field_matrix, transform_field
+from multipoles import circle_vertices
 
 class HallProbe(HallDAQ):
-    def __init__(self, coord_diff: str, rate: int, samps_per_chan: int, start_trigger=True, acquisition='finite'):
+    # Samples trimmed from both ends of a filtered scan line
+    FILTER_TRIM = 500
+    # Seconds of motion before an area scan line starts acquiring
+    RUN_UP = 1
+    # Circle acquisitions last this many times the ideal circle time plus CIRCLE_MARGIN seconds,
+    # the segments accelerate and wait on position polling so the motion always takes longer
+    CIRCLE_TIME_FACTOR = 2
+    CIRCLE_MARGIN = 1
+
+    def __init__(self, coord_diff: str, rate: int, samps_per_chan: int, start_trigger=True, acquisition='finite', probe_serial=None, session=None):
         '''
         HallProbe class inherits HallDAQ.
         coord_diff is the text file generated by Calypso which contain the
             rotation and translation values to switch between pcs and mcs
             reference frames.
+        probe_serial selects a probe from the probe registry (eg. '443-20').
+            If None, the active registry probe is used, or the legacy
+            zg_calib_coeffs.npy, sensitivity.npy and fsv_offset.txt files
+            when no registry exists.
+        session: hardware.HardwareSession to lease the DAQ tasks and CMM connection from,
+            held until shutdown.  Without a session the probe opens its own.
         '''
-        super().__init__(rate, samps_per_chan, start_trigger, acquisition)
+        super().__init__(rate, samps_per_chan, start_trigger, acquisition, session=session, user='Field Mapping')
+        try:
+            self.__connect__(coord_diff, probe_serial)
+        except Exception:
+            self.power_off()
+            self.close_tasks()
+            raise
+        self.scan_speed = 5
+
+    def __connect__(self, coord_diff: str, probe_serial=None):
         self.__load_coord_diff__(coord_diff)
         self.direction_index = {
             'xy': {'x': 1, 'y': 0},
@@ -29,12 +56,9 @@ class HallProbe(HallDAQ):
             'y': 1,
             'z': 2
         }
-        self.calib_coeffs = np.load('zg_calib_coeffs.npy')
-        self.s_matrix = np.load('sensitivity.npy')
-        self.probe_offset = np.genfromtxt('fsv_offset.txt')
-        self.cmm = zeisscmm.CMM()
+        self.__load_probe_calibration__(probe_serial)
+        self.cmm = zeisscmm.CMM() if self.session is None else self.session.connect_cmm()
         self.sample_rate = self.__determine_sample_rate__()
-        self.scan_speed = 5
     
     def __repr__(self):
         return 'Integrated Hall Probe Object'
@@ -45,7 +69,42 @@ class HallProbe(HallDAQ):
         self.translation = c_diff[9:]
         print(f'rotation: \n{self.rotation}')
         print(f'translation: \n{self.translation}')
+        if hasattr(self, 's_matrix'):
+            self.__update_frame__()
+
+    def __update_frame__(self):
+        '''
+        Rebuild pcs <-> mcs frame and field matrix after the alignment or probe changes
+        '''
+        self.frame = Frame(self.rotation, self.translation, self.probe_offset)
+        self.field_matrix = field_matrix(self.rotation, self.s_matrix)
     
+    def __load_probe_calibration__(self, probe_serial=None):
+        registry = load_registry()
+        if probe_serial is None and registry.active is None:
+            self.probe = None
+            self.calib_coeffs = np.load('zg_calib_coeffs.npy')
+            self.s_matrix = np.load('sensitivity.npy')
+            self.probe_offset = np.genfromtxt('fsv_offset.txt')
+            self.__update_frame__()
+        else:
+            self.select_probe(probe_serial)
+
+    def select_probe(self, serial=None):
+        '''
+        Switch to the calibration of probe serial held in the probe registry.
+        '''
+        probe = load_registry().get(serial)
+        missing = probe.missing()
+        if missing:
+            raise ValueError(f'Probe {probe.serial} is missing qualification values: {missing}')
+        self.probe = probe
+        self.calib_coeffs = probe.calib_coeffs
+        self.s_matrix = probe.s_matrix
+        self.probe_offset = probe.fsv_offset
+        self.__update_frame__()
+        print(f'Probe: {probe.serial}')
+
     def __determine_sample_rate__(self):
         self.change_sampling(1, 10000)
         self.power_on()
@@ -62,10 +121,30 @@ class HallProbe(HallDAQ):
         return sample_rate
     
     def pcs2mcs(self, coordinate):
-        return (coordinate - self.translation)@self.rotation + self.probe_offset
+        '''
+        coordinate is a (3,), (n, 3) or (m, n, 3) array
+        '''
+        return self.frame.to_mcs(coordinate)
 
     def mcs2pcs(self, coordinate):
-        return (coordinate - self.probe_offset)@np.linalg.inv(self.rotation) + self.translation
+        return self.frame.from_mcs(coordinate)
+
+    def field2pcs(self, Bxyz):
+        '''
+        Bxyz is a (3,), (n, 3) or (m, n, 3) array of calibrated sensor readings
+        returns rotation @ (s_matrix @ B) for every row
+        '''
+        return transform_field(Bxyz, self.field_matrix)
+
+    def scan2pcs(self, scan_data: np.ndarray):
+        '''
+        scan_data is (n, 6) or (m, n, 6) array (x, y, z, Bx, By, Bz) wrt mcs
+        returns new array with xyz and Bxyz wrt pcs, one matmul per column group
+        '''
+        pcs_data = np.empty(scan_data.shape)
+        pcs_data[..., :3] = self.mcs2pcs(scan_data[..., :3])
+        pcs_data[..., 3:] = self.field2pcs(scan_data[..., 3:])
+        return pcs_data
 
     def reduce_scan_density(self, scan_data: np.ndarray, scan_interval=0.5):
         '''
@@ -73,13 +152,21 @@ class HallProbe(HallDAQ):
         or
         (m, n, 6) array (m scan lines, n, samples per line, 6 columns)
         '''
+        return scan_data[::self.reduction_step(scan_data, scan_interval)].copy()
+
+    def lead_in(self):
+        '''
+        returns the distance from a line start point to the first sample kept by scan_area
+        '''
+        return self.scan_speed * (self.RUN_UP + self.FILTER_TRIM / self.sample_rate)
+
+    def reduction_step(self, scan_data: np.ndarray, scan_interval=0.5):
+        '''
+        returns the sample step of reduce_scan_density for an (n, 6) line
+        '''
         scan_distance = np.linalg.norm(scan_data[-1, :3] - scan_data[0, :3])
         pts_mm = scan_data.shape[0] / scan_distance
-        interval_index = int(pts_mm / (1 / scan_interval))
-        reduced_data = []
-        for i in range(0, scan_data.shape[0], interval_index):
-            reduced_data.append(scan_data[i])
-        return np.array(reduced_data)
+        return int(pts_mm / (1 / scan_interval))
 
     def scan_point(self, *point):
         if not point:
@@ -156,8 +243,14 @@ class HallProbe(HallDAQ):
             filt_array = filt_array[filt_cutoff:-filt_cutoff]
             return self.reduce_scan_density(filt_array, scan_interval=point_density)
 
-    def scan_area(self, start_array, allocated_array, pt_density, num_samples, scan_direction):
-        filt_cutoff = 500
+    def scan_area(self, start_array, allocated_array, pt_density, num_samples, scan_direction, line_callback=None, cancel=None):
+        '''
+        line_callback(i, line) is called after every scan line with the
+        filtered (n, 6) line data wrt mcs, eg. to append it to a scan file
+        cancel (threading.Event) is checked before every line, once set the scan
+        stops at the line boundary and only the finished lines are returned
+        '''
+        filt_cutoff = self.FILTER_TRIM
         filt_allocated_array = allocated_array[:, filt_cutoff:-filt_cutoff, :]
         print(f'alloc array: {allocated_array.shape}')
         print(f'filt alloc: {filt_allocated_array.shape}')
@@ -165,36 +258,133 @@ class HallProbe(HallDAQ):
         self.cmm.cnc_on()
         self.cmm.set_speed((20,20,20))
         self.power_on()
-        for i, point in enumerate(start_array):
-            self.cmm.goto_position(point)
-            while np.linalg.norm(point - self.cmm.get_position()) > 0.025:
-                pass
+        num_lines = 0
+        try:
+            for i, point in enumerate(start_array):
+                if cancel is not None and cancel.is_set():
+                    print(f'Scan cancelled after {i} of {start_array.shape[0]} lines')
+                    break
+                self.cmm.goto_position(point)
+                while np.linalg.norm(point - self.cmm.get_position()) > 0.025:
+                    pass
+                self.start_hallsensor_task()
+                sleep(1)
+                self.cmm.send(f'G01X{self.scan_direction_v[scan_direction][0]:.6f}Y{self.scan_direction_v[scan_direction][1]:.6f}Z{self.scan_direction_v[scan_direction][2]:.6f}\r\n'.encode('ascii'))
+                sleep(self.RUN_UP)
+                self.pulse()
+                start_pt = self.cmm.get_position()
+                data = self.read_hallsensor()
+                end_pt = self.cmm.get_position()
+                self.stop_hallsensor_task()
+                Bxyz = calib_data(self.calib_coeffs, data)
+                linear = np.linspace(start_pt, end_pt, num=num_samples)
+                for column in range(3):
+                    filt_column = filter_data(Bxyz[:, column], filt_cutoff)
+                    Bxyz[:, column] = filt_column
+                filt_array = np.hstack((linear, Bxyz))
+                filt_array = filt_array[filt_cutoff:-filt_cutoff]
+                filt_allocated_array[i] = filt_array
+                num_lines = i + 1
+                if line_callback is not None:
+                    line_callback(i, filt_allocated_array[i])
+        finally:
+            # Stop the motion and release the CMM whether the scan finished, was cancelled or failed,
+            # the hall sensor task is shared with the next scan and the qualification windows
+            self.cmm.send('G01X0Y0Z0\r\n'.encode('ascii'))
+            self.cmm.set_speed((70,70,70))
+            self.cmm.cnc_off()
+            self.stop_hallsensor_task()
+            self.power_off()
+        filt_allocated_array = filt_allocated_array[:num_lines]
+        if num_lines == 0:
+            return (filt_allocated_array.copy(), filt_allocated_array)
+        # Every line has the same samples, reduce them with the step of the first line
+        step = self.reduction_step(filt_allocated_array[0], pt_density)
+        return (filt_allocated_array[:, ::step].copy(), filt_allocated_array)
+
+
+    def scan_circle(self, center, radius, num_segments=64, turns=1):
+        '''
+        Measure on the fly along a circle around the magnet axis.
+        center is the (3,) circle center wrt pcs, radius in mm.
+        The circle is driven as num_segments G01 velocity segments at scan_speed, each
+        segment ends when the CMM position readback passes its end vertex so timing errors
+        do not add up over the circle.  CMM positions are logged with timestamps during
+        the motion and interpolated to the time of every hall sensor sample.  The acquisition
+        runs longer than the circle, samples after the last logged position are dropped and a
+        RuntimeError is raised if the remaining samples do not cover the full circle.
+        returns (n, 7) array (t, x, y, z, Bx, By, Bz) wrt pcs, t in seconds from trigger
+        '''
+        vertices = self.pcs2mcs(circle_vertices(center, radius, num_segments))
+        chords = np.diff(vertices, axis=0)
+        chord_length = np.linalg.norm(chords, axis=1)
+        velocities = self.scan_speed * chords / chord_length[:, None]
+        durations = chord_length / self.scan_speed
+        samples = int(round((self.CIRCLE_TIME_FACTOR * turns * durations.sum() + self.CIRCLE_MARGIN) * self.sample_rate))
+        self.change_sampling(1, samples)
+        self.cmm.cnc_on()
+        position_log = []
+        try:
+            self.cmm.set_speed((20,20,20))
+            self.cmm.goto_position(vertices[0])
+            while np.linalg.norm(vertices[0] - self.cmm.get_position()) > 0.025:
+                sleep(0.05)
+            self.power_on()
             self.start_hallsensor_task()
             sleep(1)
-            self.cmm.send(f'G01X{self.scan_direction_v[scan_direction][0]:.6f}Y{self.scan_direction_v[scan_direction][1]:.6f}Z{self.scan_direction_v[scan_direction][2]:.6f}\r\n'.encode('ascii'))
-            sleep(1)
             self.pulse()
-            start_pt = self.cmm.get_position()
+            t0 = perf_counter()
+            position_log.append((0.0, *self.cmm.get_position()))
+            for _ in range(turns):
+                for start, chord, length, velocity, duration in zip(vertices[:-1], chords, chord_length, velocities, durations):
+                    self.cmm.send(f'G01X{velocity[0]:.6f}Y{velocity[1]:.6f}Z{velocity[2]:.6f}\r\n'.encode('ascii'))
+                    t_segment = perf_counter()
+                    while True:
+                        position = self.cmm.get_position()
+                        position_log.append((perf_counter() - t0, *position))
+                        if np.dot(position - start, chord) >= length**2:
+                            break
+                        if perf_counter() - t_segment > self.CIRCLE_TIME_FACTOR * duration + self.CIRCLE_MARGIN:
+                            raise RuntimeError(f'CMM did not reach the end of a circle segment at {position}')
+            self.cmm.send('G01X0Y0Z0\r\n'.encode('ascii'))
             data = self.read_hallsensor()
-            end_pt = self.cmm.get_position()
+        finally:
+            # Stop the motion and release the CMM whether the circle finished or failed
+            self.cmm.send('G01X0Y0Z0\r\n'.encode('ascii'))
+            self.cmm.set_speed((70,70,70))
+            self.cmm.cnc_off()
             self.stop_hallsensor_task()
-            Bxyz = calib_data(self.calib_coeffs, data)
-            linear = np.linspace(start_pt, end_pt, num=num_samples)
-            for column in range(3):
-                filt_column = filter_data(Bxyz[:, column], filt_cutoff)
-                Bxyz[:, column] = filt_column
-            filt_array = np.hstack((linear, Bxyz))
-            filt_array = filt_array[filt_cutoff:-filt_cutoff]
-            filt_allocated_array[i] = filt_array
-        self.cmm.send('G01X0Y0Z0\r\n'.encode('ascii'))
-        self.cmm.set_speed((70,70,70))
-        self.cmm.cnc_off()
-        self.power_off()
-        reduced_array_list = []
-        for line in filt_allocated_array:
-            reduced_array_list.append(self.reduce_scan_density(line, scan_interval=pt_density))
-        return (np.array(reduced_array_list), filt_allocated_array)
+            self.power_off()
+        Bxyz = calib_data(self.calib_coeffs, data)
+        position_log = np.array(position_log)
+        t = np.arange(Bxyz.shape[0]) / self.sample_rate
+        # Samples after the last logged position were taken while the CMM stopped
+        moving = t <= position_log[-1, 0]
+        t, Bxyz = t[moving], Bxyz[moving]
+        xyz = self.mcs2pcs(np.column_stack([np.interp(t, position_log[:, 0], position_log[:, i]) for i in range(1, 4)]))
+        theta = np.unwrap(np.arctan2(xyz[:, 1] - center[1], xyz[:, 0] - center[0]))
+        missing = 2*np.pi*turns - np.ptp(theta) if theta.shape[0] > 1 else 2*np.pi*turns
+        if missing > np.pi / num_segments:
+            raise RuntimeError(f'Circle at z = {center[2]:.3f} mm is missing {np.degrees(missing):.1f} deg of hall sensor samples')
+        return np.hstack((t[:, None], xyz, self.field2pcs(Bxyz)))
 
+    def scan_circles(self, center, radius, z_positions, num_segments=64, turns=1, circle_callback=None, cancel=None):
+        '''
+        Circles of radius around the magnet axis at every z in z_positions (pcs).
+        circle_callback(i, circle) is called after every circle, eg. to store it.
+        cancel (threading.Event) is checked before every circle.
+        returns list of (n, 7) arrays as returned by scan_circle
+        '''
+        circles = []
+        for i, z in enumerate(z_positions):
+            if cancel is not None and cancel.is_set():
+                print(f'Scan cancelled after {i} of {len(z_positions)} circles')
+                break
+            circle = self.scan_circle(np.array([center[0], center[1], z]), radius, num_segments, turns)
+            circles.append(circle)
+            if circle_callback is not None:
+                circle_callback(i, circle)
+        return circles
 
     def scan_volume(self, start_point, scan_distance, pt_density, scan_plane, scan_direction):
         pass
@@ -206,9 +396,10 @@ class HallProbe(HallDAQ):
         return points_array
 
     def shutdown(self):
-        self.cmm.close()
-        self.close_tasks()
         self.power_off()
+        self.close_tasks()
+        if self.session is None:
+            self.cmm.close()
         
 
 if __name__ == '__main__':
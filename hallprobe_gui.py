@@ -1,25 +1,43 @@
+from time import perf_counter
+STARTUP_START = perf_counter()
 import tkinter as tk
 from tkinter import ttk
 from tkinter.messagebox import showinfo, showerror
 from tkinter.scrolledtext import ScrolledText
-from fsv import fsvWindow
-from cube import CubeWindow
-from zero_gauss import zgWindow
 from mapping import MapFrames
 import numpy as np
 import os
 import pickle
 from os.path import isfile
 from pathlib import Path
-import matplotlib
-matplotlib.use("TkAgg")
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-from matplotlib.figure import Figure
-from plots import PlotWindow
+from dataloader import load_scan_data
+from hardware import HardwareSession
 
 from tooltip import ToolTip
 
+# matplotlib, scipy (through plots/beamcalc), PIL and the daq/CMM modules are imported
+# when first used, the main window only needs tkinter and numpy
+STARTUP_BUDGET = 1.0 # s from launch until the main window is drawn
+startup_times = {}
+
+def log_startup(stage: str):
+    startup_times[stage] = perf_counter() - STARTUP_START
+
+def print_startup():
+    print('Startup: ' + ', '.join([f'{stage} {t:.2f} s' for stage, t in startup_times.items()]))
+    if startup_times.get('window', 0.0) > STARTUP_BUDGET:
+        print(f'Startup: main window took longer than the {STARTUP_BUDGET} s budget')
+
+def load_matplotlib():
+    '''
+    returns Figure, FigureCanvasTkAgg, NavigationToolbar2Tk
+    '''
+    import matplotlib
+    matplotlib.use('TkAgg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+    return Figure, FigureCanvasTkAgg, NavigationToolbar2Tk
+
 class HallProbeApp(tk.Frame):
     '''
     Master tk frame to place all containers in.
@@ -35,6 +53,20 @@ class HallProbeApp(tk.Frame):
         self.master.iconbitmap('magnet.ico')
         self.master.geometry('1350x900')
         self.create_frames()
+        log_startup('widgets')
+        # Figures are created once the window is on screen
+        self.bind('<Map>', self.__on_map__)
+
+    def __on_map__(self, event):
+        self.unbind('<Map>')
+        log_startup('window')
+        # Give Tk a moment to paint the widgets before the figures block the mainloop
+        self.after(100, self.create_plots)
+
+    def create_plots(self):
+        self.visuals.create_plots()
+        log_startup('plots')
+        print_startup()
     
     def create_frames(self):
         self.controls = ControlsFrame(self)
@@ -42,13 +74,17 @@ class HallProbeApp(tk.Frame):
         self.grid(column=0, row=0, sticky='nsew')
         self.controls.grid(column=0, row=0, padx=5, pady=5, sticky='nsew')
         self.visuals.grid(column=1, row=0, padx=(0,5), pady=(5,0), sticky='nsew')
+        # Stream finished scan lines to the live field plot
+        self.controls.map_field_frame.frm_mp.scan_listeners.append(self.visuals.field_plot.field_plot)
+        self.controls.map_field_frame.frm_mp.telemetry_listeners.append(self.visuals.temp_plot.temp_plot)
     
     def update_graph_labels(self):
-        self.visuals.temp_plot.temp_frame_parent.temp_plot.update_labels()
+        self.visuals.temp_plot.temp_plot.update_labels()
     
     def on_closing(self):
         if tk.messagebox.askokcancel('Quit', 'Do you want to quit?'):
             self.controls.map_field_frame.frm_mp.close_mapping()
+            HardwareSession.instance().close()
             self.master.destroy()
 
 class ControlsFrame(tk.Frame):
@@ -86,6 +122,12 @@ class VisualsFrame(tk.Frame):
         self.field_plot.grid(column=0, row=0)
         self.temp_plot.grid(column=0, row=1)
 
+    def create_plots(self):
+        self.field_plot.field_plot.create_plot()
+        self.temp_plot.temp_plot.create_widgets()
+        # The last area map is loaded after the empty figures are drawn
+        self.after_idle(self.field_plot.field_plot.plot_last_map)
+
 class MagnetInformation(ttk.LabelFrame):
     '''
     tk frame for part identification
@@ -154,21 +196,49 @@ class MapField(ttk.LabelFrame):
 
 class PlotField(tk.Frame):
     '''
-    tk frame for plotting magnetic field data
+    tk frame for plotting magnetic field data.
+    Shows the last area map until a scan starts, then a live heat map of |B| that grows
+    line by line.  The figure is created by create_plot once the main window is up.  Lines are decimated to num_columns bins along the scan direction and
+    the image is blitted at most every redraw_ms, a full redraw only happens when the
+    color range or extent changes.
     '''
-    def __init__(self, parent):
+    axis_index = {'x': 0, 'y': 1, 'z': 2}
+
+    def __init__(self, parent, num_columns=400, redraw_ms=250):
         self.plotfield_parent = parent
+        self.num_columns = num_columns
+        self.redraw_ms = redraw_ms
+        self.fig = None
+        self.image = None
+        self.background = None
+        self.redraw_pending = False
+        self.full_redraw = False
         super().__init__(parent)
-        self.create_plot()
 
     def create_plot(self):
-        data = np.genfromtxt('area.txt')
+        if self.fig is not None:
+            return
+        Figure, FigureCanvasTkAgg, NavigationToolbar2Tk = load_matplotlib()
+        self.fig = Figure(figsize=(8,4))
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.plotfield_parent)
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self.plotfield_parent)
+        self.toolbar.update()
+        self.canvas.get_tk_widget().pack(side=tk.TOP,
+                                         fill=tk.BOTH, expand=1)
+        # Keep the blit background current after zoom, pan and full redraws
+        self.canvas.mpl_connect('draw_event', self.__on_draw__)
+        self.canvas.draw_idle()
+
+    def plot_last_map(self):
+        '''
+        3D scatter of the last area map in area.txt, skipped if a scan already started
+        '''
+        if self.image is not None or not isfile('area.txt'):
+            return
+        data = load_scan_data('area.txt')
         cmm_xyz = data[:, :3]
         Bxyz = data[:, 3:]
         Bxyz_norm = np.linalg.norm(Bxyz, axis=1)
-        self.fig = Figure(figsize=(8,4))
-        self.canvas = FigureCanvasTkAgg(self.fig, master=self.plotfield_parent)
-        self.canvas.draw()
         self.ax = self.fig.add_subplot(111, projection='3d')
         self.fig.subplots_adjust(left=0.05, right=0.95, bottom=0.05, top=0.95)
         self.ax.set_title(' Field Strength Map')
@@ -178,24 +248,112 @@ class PlotField(tk.Frame):
         plot3d = self.ax.scatter(cmm_xyz[:, 0], cmm_xyz[:, 2], Bxyz_norm,
                                  c=Bxyz_norm, cmap='rainbow', marker='.')
         self.fig.colorbar(plot3d, ax=self.ax, label='mT', pad=0.1)
-        self.toolbar = NavigationToolbar2Tk(self.canvas, self.plotfield_parent)
-        self.toolbar.update()
-        self.canvas.get_tk_widget().pack(side=tk.TOP,
-                                         fill=tk.BOTH, expand=1)
+        self.canvas.draw_idle()
+
+    def scan_started(self, scan_parameters):
+        '''
+        Replace the plot with an empty heat map of num_lines rows
+        '''
+        self.create_plot()
+        self.along = self.axis_index[scan_parameters['scan_direction']]
+        self.across = self.axis_index[''.join([i for i in scan_parameters['scan_plane'] if i != scan_parameters['scan_direction']])]
+        self.map = np.full((scan_parameters['num_lines'], self.num_columns), np.nan)
+        self.line_positions = []
+        self.edges = None
+        self.fig.clf()
+        self.ax = self.fig.add_subplot(111)
+        self.ax.set_title('Field Strength Map')
+        self.ax.set_xlabel(f'{scan_parameters["scan_direction"]} axis [mm]')
+        self.ax.set_ylabel(f'{"xyz"[self.across]} axis [mm]')
+        self.image = self.ax.imshow(self.map, aspect='auto', origin='lower', cmap='rainbow', interpolation='nearest', animated=True)
+        self.fig.colorbar(self.image, ax=self.ax, label='mT')
+        self.request_redraw(full=True)
+
+    def line_finished(self, line, i):
+        '''
+        line: (n, 6) array wrt pcs, i: line number in the scan
+        '''
+        if self.image is None or i >= self.map.shape[0]:
+            return
+        s = line[:, self.along]
+        if self.edges is None:
+            self.edges = np.linspace(s.min(), s.max(), self.num_columns + 1)
+        # Decimate: mean |B| per column bin, bins without samples are interpolated
+        column = np.clip(np.searchsorted(self.edges, s) - 1, 0, self.num_columns - 1)
+        counts = np.bincount(column, minlength=self.num_columns)
+        sums = np.bincount(column, weights=np.linalg.norm(line[:, 3:], axis=1), minlength=self.num_columns)
+        filled = counts > 0
+        centers = (self.edges[1:] + self.edges[:-1]) / 2
+        self.map[i] = np.interp(centers, centers[filled], sums[filled] / counts[filled], left=np.nan, right=np.nan)
+        self.line_positions.append((i, np.mean(line[:, self.across])))
+        self.image.set_data(self.map)
+        full = False
+        low, high = self.image.get_clim()
+        line_low, line_high = np.nanmin(self.map[i]), np.nanmax(self.map[i])
+        if len(self.line_positions) == 1 or line_low < low or line_high > high:
+            self.image.set_clim(np.nanmin(self.map), np.nanmax(self.map))
+            full = True
+        if len(self.line_positions) <= 2:
+            self.image.set_extent(self.__extent__())
+            full = True
+        self.request_redraw(full)
+
+    def __extent__(self):
+        (i0, p0), step = self.line_positions[0], 1.0
+        if len(self.line_positions) > 1:
+            i1, p1 = self.line_positions[1]
+            step = (p1 - p0) / (i1 - i0) if p1 != p0 else 1.0
+        bottom = p0 - (i0 + 0.5) * step
+        return (self.edges[0], self.edges[-1], bottom, bottom + self.map.shape[0] * step)
+
+    def request_redraw(self, full=False):
+        '''
+        Schedule at most one redraw every redraw_ms, the scan itself never waits for drawing
+        '''
+        self.full_redraw = self.full_redraw or full
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.after(self.redraw_ms, self.__redraw__)
+
+    def __redraw__(self):
+        self.redraw_pending = False
+        if self.full_redraw or self.background is None:
+            self.full_redraw = False
+            # draw_event captures the background and draws the image
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.image)
+        self.canvas.blit(self.ax.bbox)
+
+    def __on_draw__(self, event):
+        if self.image is None:
+            return
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.image)
+        self.canvas.blit(self.ax.bbox)
 
 class PlotTemperature(tk.Frame):
     '''
-    tk frame for plotting temperature sensor data
+    tk frame for plotting temperature sensor data.
+    Polls the telemetry ring buffer every poll_ms and redraws only when new rows arrived.
+    The figure is created by create_widgets once the main window is up.
     '''
-    def __init__(self, parent):
+    def __init__(self, parent, poll_ms=2000):
         self.plot_temp_parent = parent
+        self.poll_ms = poll_ms
+        self.telemetry = None
+        self.num_rows = 0
+        self.fig = None
         super().__init__(parent)
-        self.create_widgets()
     
     def create_widgets(self):
         '''
         change to set graph labels at start of measurement
         '''
+        if self.fig is not None:
+            return
+        Figure, FigureCanvasTkAgg, NavigationToolbar2Tk = load_matplotlib()
         self.fig = Figure(figsize=(8,4))
         self.ax = self.fig.add_subplot(111)
         self.ax.set_title('Magnet Temperature')
@@ -203,13 +361,44 @@ class PlotTemperature(tk.Frame):
         self.ax.set_ylabel(r'Temperature [$^\circ$C]')
         self.ax.grid()
         self.graph = FigureCanvasTkAgg(self.fig, self.plot_temp_parent)
-        self.graph.draw()
-        self.ax.plot([1,2,3,4,5,6,7,8], [19.8, 19.9, 20, 20, 20.5, 20.7, 20.8, 21], label='channel 0')
-        self.ax.legend()
+        self.graph.draw_idle()
+        self.lines = [self.ax.plot([], [], label=f'channel {i}')[0] for i in range(8)]
+        self.lines.append(self.ax.plot([], [], 'k--', label='workpiece')[0])
         self.toolbar = NavigationToolbar2Tk(self.graph, self.plot_temp_parent)
         self.toolbar.update()
         self.graph.get_tk_widget().pack()
 
+    def telemetry_started(self, telemetry):
+        # The hall probe can be released and connected again, keep a single polling loop
+        polling = self.telemetry is not None
+        self.telemetry = telemetry
+        self.num_rows = 0
+        if not polling:
+            self.after(self.poll_ms, self.update_plot)
+
+    def update_plot(self):
+        rows, count = self.telemetry.rows()
+        if self.fig is not None and count != self.num_rows and rows.shape[0] > 0:
+            self.num_rows = count
+            minutes = (rows[:, 0] - rows[0, 0]) / 60
+            for i, line in enumerate(self.lines):
+                line.set_data(minutes, rows[:, i + 1])
+            self.update_labels()
+            self.ax.relim()
+            self.ax.autoscale_view()
+            self.graph.draw_idle()
+        self.after(self.poll_ms, self.update_plot)
+
+    def update_labels(self):
+        '''
+        Legend of the sources that delivered data
+        '''
+        if self.fig is None:
+            return
+        active = [line for line in self.lines if np.any(np.isfinite(line.get_ydata()))]
+        if active:
+            self.ax.legend(handles=active, loc='upper left', fontsize='small', ncol=3)
+
 class FieldFrame(tk.Frame):
     '''
     Parent tk frame for magnetic field plot.
@@ -271,12 +460,15 @@ class ProbeQualification(ttk.LabelFrame):
         self.txt_instructions.configure(state='disabled')
 
     def run_zero_gauss(self):
+        from zero_gauss import zgWindow
         zg = zgWindow(self)
     
     def run_fsv(self):
+        from fsv import fsvWindow
         fsv = fsvWindow(self)
     
     def run_cube(self):
+        from cube import CubeWindow
         cube = CubeWindow(self)
     
     def verify_qualification(self):
@@ -318,10 +510,12 @@ class ProgramControls(ttk.LabelFrame):
         self.lbl_controls_status.grid(column=0, row=1, columnspan=3, padx=5, pady=5, sticky='sew')
     
     def plot_window(self):
+        from plots import PlotWindow
         plot = PlotWindow(self)
 
 
 if __name__ == '__main__':
+    log_startup('imports')
     app = HallProbeApp(tk.Tk())
     app.master.protocol('WM_DELETE_WINDOW', app.on_closing)
     app.master.mainloop()
\ No newline at end of file
@@ -0,0 +1,99 @@
+import threading
+
+class HardwareBusy(RuntimeError):
+    '''
+    Raised when the hall probe hardware is leased to another workflow
+    '''
+
+class HardwareSession:
+    '''
+    Process wide owner of the CMM connection and the NI DAQ tasks.
+    The socket and the tasks are created on first use and stay open for the application
+    run, workflows (HallProbe, FSV, Cube, ZeroGauss) lease them instead of opening their own.
+    A lease belongs to an owner object, not a thread, so a probe started in the scan worker
+    can be shut down from the mainloop.  It is reentrant for its owner and acquire never
+    blocks: another owner gets HardwareBusy at once, eg. a second qualification window
+    while a scan runs.
+    '''
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        '''
+        returns the session of this process
+        '''
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.owner = None
+        self.owner_name = None
+        self.lease_count = 0
+        self.cmm = None
+        self.tasks = None
+        # Power and task status of the shared tasks (see nicdaq.task_flag)
+        self.task_state = {}
+
+    def __repr__(self):
+        return f'Hardware Session {"leased to " + self.owner_name if self.owner is not None else "idle"}'
+
+    def acquire(self, owner, name=None):
+        '''
+        Lease the hardware to owner, name is shown to other workflows while the lease is held
+        '''
+        with self.lock:
+            if self.owner is not None and self.owner is not owner:
+                raise HardwareBusy(f'Hall probe hardware is in use by {self.owner_name}, close it first')
+            self.owner = owner
+            self.owner_name = name if name is not None else repr(owner)
+            self.lease_count += 1
+
+    def release(self, owner):
+        with self.lock:
+            if self.owner is not owner:
+                return
+            self.lease_count -= 1
+            if self.lease_count == 0:
+                self.owner = None
+                self.owner_name = None
+
+    def connect_cmm(self):
+        '''
+        returns the shared CMM connection, connected on first use
+        '''
+        with self.lock:
+            if self.cmm is None:
+                import zeisscmm
+                self.cmm = zeisscmm.CMM()
+            return self.cmm
+
+    def daq_tasks(self):
+        '''
+        returns the shared NI tasks (see nicdaq.create_tasks), created on first use
+        '''
+        with self.lock:
+            if self.tasks is None:
+                from nicdaq import create_tasks
+                self.tasks = create_tasks()
+            return self.tasks
+
+    def close(self):
+        '''
+        Close the tasks and the CMM connection at the end of the application run
+        '''
+        with self.lock:
+            if self.tasks is not None:
+                for task in self.tasks.values():
+                    task.close()
+                self.tasks = None
+                self.task_state.clear()
+            if self.cmm is not None:
+                self.cmm.close()
+                self.cmm = None
+            self.owner = None
+            self.owner_name = None
+            self.lease_count = 0
@@ -0,0 +1,90 @@
+import numpy as np
+
+axis_index = {'x': 0, 'y': 1, 'z': 2}
+# (Bx, By, int Bx, int By) columns of the quadrupole fit in horizontal/vertical scan planes
+coefficient_index = {'xy': None, 'yz': (1, 0, 3, 2), 'zx': (0, 1, 2, 3)}
+
+class RunningIntegrals:
+    '''
+    Field integrals of an area scan that are updated as each scan line finishes.
+    Every line is integrated with the trapezoid rule along the scan direction and the
+    int Bx/int By values across lines are refit after each line, so the integrated strength,
+    magnetic length and offset are available as soon as the last line is measured.
+    Units follow QuadPlotDashboard: lines are given in mm/mT, results are in cm/G.
+    '''
+    def __init__(self, scan_plane: str, scan_direction: str, fit_order=9, to_cm_gauss=True):
+        self.scan_plane = scan_plane
+        self.scan_direction = scan_direction
+        self.plot_axis = ''.join([i for i in scan_plane if i != scan_direction])
+        self.fit_order = fit_order
+        self.to_cm_gauss = to_cm_gauss
+        self.steps = []
+        self.integrals = []
+        self.center_field = []
+        self.coeffs = None
+        self.results = {}
+
+    def __repr__(self):
+        return f'Running Integrals {self.scan_plane} plane, {len(self.steps)} lines'
+
+    def add_line(self, line: np.ndarray):
+        '''
+        line: (n, 6) array (x, y, z, Bx, By, Bz) wrt pcs of a single scan line
+        returns the updated results dict
+        '''
+        line = np.array(line, dtype=float)
+        if self.to_cm_gauss:
+            line[:, :3] /= 10
+            line[:, 3:] *= 10
+        s = line[:, axis_index[self.scan_direction]]
+        B = line[:, 3:]
+        self.steps.append(np.mean(line[:, axis_index[self.plot_axis]]))
+        self.integrals.append(np.sum(np.diff(s)[:, None] * (B[1:] + B[:-1]) / 2, axis=0))
+        # Field where the line crosses the magnet center (scan coordinate 0)
+        order = np.argsort(s)
+        if s[order[0]] <= 0 <= s[order[-1]]:
+            self.center_field.append([np.interp(0, s[order], B[order, i]) for i in range(3)])
+        else:
+            self.center_field.append([np.nan] * 3)
+        self.__fit__()
+        return self.results
+
+    def __fit__(self):
+        steps = np.array(self.steps)
+        integrals = np.array(self.integrals)
+        center_field = np.array(self.center_field)
+        self.results = {'lines': steps.shape[0]}
+        index = coefficient_index[self.scan_plane]
+        if steps.shape[0] < 2 or index is None:
+            return
+        order = min(self.fit_order, steps.shape[0] - 1)
+        # Fit of Bx, By, int Bx, int By vs plot axis, rows in increasing power like QuadPlotDashboard.all_coeffs
+        values = np.hstack((center_field[:, :2], integrals[:, :2]))
+        valid = np.all(np.isfinite(values), axis=1)
+        if np.count_nonzero(valid) < 2:
+            return
+        order = min(order, np.count_nonzero(valid) - 1)
+        self.coeffs = np.flip(np.polyfit(steps[valid], values[valid], order), axis=0)
+        gradient = self.coeffs[1, index[3]]
+        self.results['integrated_magnetic_value'] = gradient
+        self.results['quadrupole_magnetic_length'] = gradient / self.coeffs[1, index[1]]
+        self.results['offset'] = (self.coeffs[0, index[3]] / gradient * 10, self.coeffs[0, index[2]] / gradient * 10)
+        center_line = np.argmin(np.abs(steps))
+        self.results['dipole_magnetic_length'] = integrals[center_line, 1] / center_field[center_line, 1]
+
+    def scan_integrals(self):
+        '''
+        returns (n, 4) array [step, int Bx, int By, int Bz] like integrate_lines_from_area
+        '''
+        if not self.steps:
+            return np.zeros((0, 4))
+        return np.hstack((np.array(self.steps)[:, None], np.array(self.integrals)))
+
+    def summary(self):
+        if 'integrated_magnetic_value' not in self.results:
+            return f'Line {self.results.get("lines", 0)}: not enough lines to fit'
+        return (f'Line {self.results["lines"]}: '
+                f'int G: {self.results["integrated_magnetic_value"]:.3f} G, '
+                f'qml: {self.results["quadrupole_magnetic_length"]:.3f} cm, '
+                f'dml: {self.results["dipole_magnetic_length"]:.3f} cm, '
+                f'offset: ({self.results["offset"][0]:.3f}, {self.results["offset"][1]:.3f}) mm')
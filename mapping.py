@@ -3,15 +3,35 @@ from tkinter import ttk
 from tkinter.filedialog import askopenfilename
 from tkinter.messagebox import showerror
 import numpy as np
-from hallprobe import HallProbe
+from scanfile import ScanFile
+from integrals import RunningIntegrals
+from scanworker import ScanWorker
+from telemetry import TemperatureTelemetry
+from hardware import HardwareSession
+from multipoles import circle_harmonics, relative_harmonics
+import symmetry
 import pickle
 import os
+from datetime import datetime
 
 class MapFrames(tk.Frame):
     def __init__(self, parent):
         self.hp = None
+        # Also write the legacy text/npy files next to the binary scan files
+        self.export_text = True
+        self.symmetry = None
         self.mapframes_parent = parent
         super().__init__(parent)
+        # Scans run in a background thread, results are handed back to the mainloop
+        self.worker = ScanWorker(self)
+        # Scan file of the running scan, marked as failed if the scan raises
+        self.scan_file = None
+        # Objects with scan_started(scan_parameters) and line_finished(line, i), eg. live plots
+        self.scan_listeners = []
+        # Magnet temperature telemetry starts with the hall probe, listeners get telemetry_started(telemetry)
+        self.telemetry = None
+        self.telemetry_row = 0
+        self.telemetry_listeners = []
         self.density_list = ['0.1', '0.25', '0.5', '1.0', '2.0', 'full res']
         self.density_list_area = ['0.1', '0.25', '0.5', '1.0', '2.0']
         self.scan_direction_list = [['x', 'y'], ['y', 'z'], ['z', 'x']]
@@ -19,26 +39,104 @@ class MapFrames(tk.Frame):
         self.frm_scan_point = tk.Frame(self)
         self.frm_scan_line = tk.Frame(self)
         self.frm_scan_area = tk.Frame(self)
+        self.frm_scan_circle = tk.Frame(self)
         self.frm_fm_buttons.grid(column=0, row=0, sticky='nsew')
         self.create_fm_buttons()
         self.scan_point_widgets()
         self.scan_line_widgets()
         self.scan_area_widgets()
+        self.scan_circle_widgets()
 
     def close_mapping(self):
+        # Let a running scan (or hall probe start up) finish and release the CMM before shutting down
+        self.worker.stop()
+        self.worker.join()
+        # Run the handlers the scan queued before it ended, eg. area_finished writes the cancelled metadata
+        self.worker.drain()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry = None
         if self.hp is not None:
             self.hp.shutdown()
+            self.hp = None
+
+    def set_scan_state(self, running: bool):
+        '''
+        Disable every control that talks to the hall probe or CMM while a scan runs
+        '''
+        state = 'disabled' if running else 'enabled'
+        for button in (self.btn_load_part_alignment, self.btn_release_hardware, self.btn_measure_point, self.btn_measure_line,
+                       self.btn_sa_measure, self.btn_sc_measure):
+            button.configure(state=state)
+        self.btn_stop_scan.configure(state='enabled' if running else 'disabled')
+
+    def start_scan(self, target, on_done, scan_file=None):
+        self.set_scan_state(True)
+        self.scan_file = scan_file
+        if self.telemetry is not None:
+            # Log from the last reading before the scan
+            self.telemetry_row = max(self.telemetry.buffer.count - 1, 0)
+        self.worker.start(target, on_done=lambda result: self.scan_done(on_done, result), on_error=self.scan_failed)
+
+    def scan_done(self, on_done, result):
+        try:
+            on_done(result)
+        finally:
+            self.scan_file = None
+            self.set_scan_state(False)
+
+    def scan_failed(self, error):
+        self.set_scan_state(False)
+        if self.scan_file is not None:
+            # The lines and circles queued before the error are stored, mark the file so it
+            # is not taken for a scan that is still running
+            self.log_temperature(self.scan_file)
+            chunks = self.scan_file.chunks
+            if self.scan_file.metadata.get('scan_parameters', {}).get('scan_type') == 'circle':
+                self.scan_file.update_metadata(failed=str(error), circles_completed=len(chunks.get('harmonics', [])))
+            else:
+                self.scan_file.update_metadata(failed=str(error), lines_completed=len(chunks.get('lines_mcs', [])) +
+                                               len(chunks.get('verification_lines_mcs', [])))
+            self.scan_file = None
+        showerror(title='Scan Error', message=f'Scan stopped: {error}')
+
+    def stop_scan(self):
+        self.worker.stop()
+
+    def log_temperature(self, scan_file):
+        '''
+        Append the telemetry rows since the last call to the temperature dataset of scan_file
+        '''
+        if self.telemetry is None:
+            return
+        rows, self.telemetry_row = self.telemetry.rows(self.telemetry_row)
+        if rows.shape[0] == 0:
+            return
+        if 'temperature' not in scan_file.chunks:
+            scan_file.update_metadata(temperature_columns=TemperatureTelemetry.columns)
+        scan_file.append('temperature', rows)
+
+    def notify_scan_started(self, scan_parameters):
+        for listener in self.scan_listeners:
+            listener.scan_started(scan_parameters)
     
     def create_fm_buttons(self):
         self.btn_load_part_alignment = ttk.Button(self.frm_fm_buttons, text='Load Part Alignment', command=self.load_part_alignment)
         self.btn_scan_point = ttk.Button(self.frm_fm_buttons, text='Scan Point', state='disabled', command=lambda: self.load_frame(self.frm_scan_point))
         self.btn_scan_line = ttk.Button(self.frm_fm_buttons, text='Scan Line', state='disabled', command=lambda: self.load_frame(self.frm_scan_line))
         self.btn_scan_area_volume = ttk.Button(self.frm_fm_buttons, text='Scan Area', state='disabled', command=lambda: self.load_frame(self.frm_scan_area))
+        self.btn_scan_circle = ttk.Button(self.frm_fm_buttons, text='Scan Circle', state='disabled', command=lambda: self.load_frame(self.frm_scan_circle))
+        # Next to the scan buttons so it stays visible whichever scan frame is loaded
+        self.btn_stop_scan = ttk.Button(self.frm_fm_buttons, text='Stop Scan', state='disabled', command=self.stop_scan)
+        self.btn_release_hardware = ttk.Button(self.frm_fm_buttons, text='Release Hardware', state='disabled', command=self.release_hardware)
         # Place widgets within grid
         self.btn_load_part_alignment.grid(column=0, row=0, sticky='new', padx=5, pady=5)
         self.btn_scan_point.grid(column=0, row=1, sticky='new', padx=5, pady=(0,5))
         self.btn_scan_line.grid(column=0, row=2, sticky='new', padx=5, pady=(0,5))
         self.btn_scan_area_volume.grid(column=0, row=3, sticky='new', padx=5, pady=(0,5))
+        self.btn_scan_circle.grid(column=0, row=4, sticky='new', padx=5, pady=(0,5))
+        self.btn_stop_scan.grid(column=0, row=5, sticky='new', padx=5, pady=(10,5))
+        self.btn_release_hardware.grid(column=0, row=6, sticky='new', padx=5, pady=(0,5))
 
     def load_magnet_info(self):
         # grab from pickled file
@@ -46,6 +144,24 @@ class MapFrames(tk.Frame):
         with open('magnet_info.pkl', 'rb') as f:
             magnet_info = pickle.load(f)
         return magnet_info
+
+    def create_scan_file(self, filename, magnet_info, scan_parameters):
+        '''
+        Create a binary scan file embedding magnet info, alignment and probe calibration.
+        An existing file is never overwritten, the new file name gets a timestamp instead.
+        '''
+        if os.path.exists(filename):
+            base, ext = os.path.splitext(filename)
+            filename = f'{base} {datetime.now().strftime("%Y-%m-%d %H-%M-%S")}{ext}'
+            print(f'Scan file exists, writing {filename}')
+        if self.hp.probe is not None:
+            scan_parameters['probe_serial'] = self.hp.probe.serial
+        arrays = {'rotation': self.hp.rotation,
+                  'translation': self.hp.translation,
+                  'probe_offset': self.hp.probe_offset,
+                  's_matrix': self.hp.s_matrix,
+                  'calib_coeffs': self.hp.calib_coeffs}
+        return ScanFile.create(filename, magnet_info=magnet_info, scan_parameters=scan_parameters, arrays=arrays)
     
     def get_point(self):
         try:
@@ -90,18 +206,62 @@ class MapFrames(tk.Frame):
             scan_direction = self.cbox_sa_scan_direction.get()
             start_point = np.array([sp_x, sp_y, sp_z])
             scan_distance = np.array([sd_x, sd_y, sd_z])
-            start_array = self.hp.create_scan_plane(start_point, scan_distance, pd, scan_plane, scan_direction)
-            distance_dict = {'x': sd_x, 'y': sd_y, 'z': sd_z}
-            for i, point in enumerate(start_array):
-                start_array[i] = self.hp.pcs2mcs(point)
-            distance = distance_dict[scan_direction]
-            travel_time = distance / self.hp.scan_speed
-            samples = np.array(((travel_time * self.hp.sample_rate) - self.hp.sample_rate)).round(0).astype(int)
-            allocated_array = np.zeros((start_array.shape[0], samples, 6))
-            return (start_array, allocated_array, pd, samples, scan_direction)
+            return self.area_scan_args(start_point, scan_distance, pd, scan_plane, scan_direction)
+        except ValueError:
+            return None
+
+    def area_scan_args(self, start_point, scan_distance, pd, scan_plane, scan_direction, start_points=None):
+        '''
+        returns the arguments of HallProbe.scan_area for a scan rectangle wrt pcs.
+        start_points (pcs) replaces the line start points of the rectangle, eg. for verification lines
+        '''
+        if start_points is None:
+            start_points = self.hp.create_scan_plane(start_point, scan_distance, pd, scan_plane, scan_direction)
+        start_array = self.hp.pcs2mcs(start_points)
+        distance = scan_distance[self.hp.scan_length_index[scan_direction]]
+        travel_time = distance / self.hp.scan_speed
+        samples = np.array(((travel_time * self.hp.sample_rate) - self.hp.sample_rate)).round(0).astype(int)
+        allocated_array = np.zeros((start_array.shape[0], samples, 6))
+        return (start_array, allocated_array, pd, samples, scan_direction)
+
+    def get_symmetric_area(self, num_verification_lines=2):
+        '''
+        returns scan_area arguments of the fundamental region and of the full length verification lines
+        for the selected symmetry, and the (magnet type, mirror axes) of the symmetry
+        '''
+        try:
+            start_point = np.array([float(self.ent_sa_sp_x.get()), float(self.ent_sa_sp_y.get()), float(self.ent_sa_sp_z.get())])
+            scan_distance = np.array([float(self.ent_sa_sd_x.get()), float(self.ent_sa_sd_y.get()), float(self.ent_sa_sd_z.get())])
+            pd = float(self.cbox_sa_pd.get())
         except ValueError:
             return None
+        scan_plane = self.cbox_sa_scan_plane.get()
+        scan_direction = self.cbox_sa_scan_direction.get()
+        magnet, axes = symmetry.mirror_axes(self.cbox_sa_symmetry.get(), scan_plane)
+        fund_start, fund_distance = symmetry.fundamental_region(start_point, scan_distance, pd, scan_direction, axes, self.hp.lead_in())
+        positions = symmetry.verification_positions(start_point, scan_distance, pd, scan_plane, scan_direction, axes, num_verification_lines)
+        verification_points = np.array([start_point] * positions.shape[0])
+        verification_points[:, self.hp.direction_index[scan_plane][scan_direction]] = positions
+        fund_args = self.area_scan_args(fund_start, fund_distance, pd, scan_plane, scan_direction)
+        verification_args = self.area_scan_args(start_point, scan_distance, pd, scan_plane, scan_direction, start_points=verification_points)
+        return fund_args, verification_args, (magnet, axes)
     
+    def get_circle(self):
+        try:
+            c_x = float(self.ent_sc_c_x.get())
+            c_y = float(self.ent_sc_c_y.get())
+            radius = float(self.ent_sc_radius.get())
+            z_start = float(self.ent_sc_z_start.get())
+            z_end = float(self.ent_sc_z_end.get())
+            z_step = float(self.ent_sc_z_step.get())
+            num_segments = int(self.ent_sc_segments.get())
+            if z_step <= 0 or radius <= 0 or num_segments < 8:
+                return None
+            z_positions = np.arange(z_start, z_end + z_step / 2, z_step)
+            return (np.array([c_x, c_y, z_start]), radius, z_positions, num_segments)
+        except ValueError:
+            return None
+
     def load_frame(self, frame: tk.Frame):
         if self.grid_slaves(column=1, row=0):
             self.grid_slaves()[0].grid_forget()
@@ -110,12 +270,55 @@ class MapFrames(tk.Frame):
     def load_part_alignment(self):
         cdiff = askopenfilename(filetypes=[('Text Files', '*.txt'), ('All Files', '*.*')])
         if cdiff != '' and self.hp is None:
-            self.hp = HallProbe(cdiff, 1, 2)
-            self.btn_scan_point.configure(state='enabled')
-            self.btn_scan_line.configure(state='enabled')
-            self.btn_scan_area_volume.configure(state='enabled')
+            # Connecting and measuring the sample rate takes seconds, keep the mainloop running
+            print('Connecting to the hall probe and CMM')
+            self.btn_load_part_alignment.configure(state='disabled')
+            self.worker.start(lambda: self.__connect_hallprobe__(cdiff), on_done=self.hallprobe_ready, on_error=self.hallprobe_failed)
         elif cdiff != '' and self.hp is not None:
             self.hp.__load_coord_diff__(cdiff)
+
+    def __connect_hallprobe__(self, cdiff: str):
+        '''
+        Runs in the worker thread, the daq and CMM modules are only imported once a probe is needed
+        '''
+        from hallprobe import HallProbe
+        self.hp = HallProbe(cdiff, 1, 2, session=HardwareSession.instance())
+        return self.hp
+
+    def hallprobe_ready(self, hp):
+        self.btn_load_part_alignment.configure(state='enabled')
+        self.telemetry = TemperatureTelemetry(hp, hp.cmm)
+        self.telemetry.start()
+        for listener in self.telemetry_listeners:
+            listener.telemetry_started(self.telemetry)
+        self.btn_scan_point.configure(state='enabled')
+        self.btn_scan_line.configure(state='enabled')
+        self.btn_scan_area_volume.configure(state='enabled')
+        self.btn_scan_circle.configure(state='enabled')
+        self.btn_release_hardware.configure(state='enabled')
+
+    def release_hardware(self):
+        '''
+        Power off the probe and end its lease of the DAQ and CMM, so FSV, cube and zero gauss can use them.
+        Load Part Alignment connects the probe again.
+        '''
+        if self.worker.running():
+            return
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry = None
+        if self.hp is not None:
+            self.hp.shutdown()
+            self.hp = None
+        for frame in self.grid_slaves(column=1, row=0):
+            frame.grid_forget()
+        for button in (self.btn_scan_point, self.btn_scan_line, self.btn_scan_area_volume, self.btn_scan_circle, self.btn_release_hardware):
+            button.configure(state='disabled')
+        print('Hall probe hardware released')
+
+    def hallprobe_failed(self, error):
+        self.btn_load_part_alignment.configure(state='enabled')
+        showerror(title='Connection Error', message=f'Could not start the hall probe: {error}')
     
     def measure_point(self):
         point = self.get_point()
@@ -133,11 +336,17 @@ class MapFrames(tk.Frame):
             xyz_Bxyz = self.hp.scan_point(point)
             # Transform xyz to PCS
             xyz_Bxyz[:3] = self.hp.mcs2pcs(xyz_Bxyz[:3])
+            scan_filename = mag_folder + f'{magname}-{serial} points.scan'
+            if os.path.isfile(scan_filename):
+                scan_file = ScanFile(scan_filename)
+            else:
+                scan_file = self.create_scan_file(scan_filename, magnet_info, {'scan_type': 'points'})
+            scan_file.append('points_raw', xyz_Bxyz.reshape((1, 6)))
             with open(mag_folder + magname + '-' + serial + ' points Bxyz raw.txt', 'a') as raw_file:
                 raw_file.write(f'{xyz_Bxyz[0]} {xyz_Bxyz[1]} {xyz_Bxyz[2]} {xyz_Bxyz[3]} {xyz_Bxyz[4]} {xyz_Bxyz[5]}\n')
             # Transform Bxyz to PCS
             # xyz_Bxyz[3:] = xyz_Bxyz[3:] @ self.hp.s_matrix @ self.hp.rotation
-            xyz_Bxyz[3:] = self.hp.rotation @ (self.hp.s_matrix @ xyz_Bxyz[3:])
+            xyz_Bxyz[3:] = self.hp.field2pcs(xyz_Bxyz[3:])
             # corr=np.array([[1, 0, 0], [0, 1, -0.00], [0, 0, 1]]) # Overhearing value found on ABEND-35 on date 2024-08-21.
             # xyz_Bxyz[3:] = xyz_Bxyz[3:] @ self.hp.s_matrix @ self.hp.rotation @ corr
             # Print xyz and Bxyz wrt PCS
@@ -145,66 +354,256 @@ class MapFrames(tk.Frame):
             # Save xyz and Bxyz values wrt PCS
             with open(mag_folder+filename, 'a') as file:
                 file.write(f'{xyz_Bxyz[0]} {xyz_Bxyz[1]} {xyz_Bxyz[2]} {xyz_Bxyz[3]} {xyz_Bxyz[4]} {xyz_Bxyz[5]}\n')
+            scan_file.append('points', xyz_Bxyz.reshape((1, 6)))
     
     def measure_line(self):
         line_args = self.get_line()
         magnet_info = self.load_magnet_info()
         magname, serial, current, notes = magnet_info
         mag_folder = f'scans/{magname}-{serial}/'
-        filename = f'{magname}-{serial} line data.txt'
         # Create a subdirectory within the scans folder for the magnet only if it doesn't already exist
         if not os.path.exists(mag_folder):
             os.makedirs(mag_folder)
-        # Verify entries are valid and scan line
+        # Verify entries are valid and scan line in the background
         if line_args is None:
             showerror(title='Entry Error', message='Entries should be integer or float values.')
         else:
-            data = self.hp.scan_line(*line_args)
-            data_xyz_pcs = np.array([self.hp.mcs2pcs(i) for i in data[:, :3]])
-            data_raw = np.hstack((data_xyz_pcs, data[:, 3:]))
+            sp, ep, pd = line_args
+            scan_parameters = {'scan_type': 'line', 'start_point': self.hp.mcs2pcs(sp).tolist(),
+                               'end_point': self.hp.mcs2pcs(ep).tolist(), 'point_density': pd}
+            self.start_scan(lambda: self.hp.scan_line(*line_args),
+                            lambda data: self.line_finished(data, magnet_info, scan_parameters))
+
+    def line_finished(self, data, magnet_info, scan_parameters):
+        magname, serial, current, notes = magnet_info
+        mag_folder = f'scans/{magname}-{serial}/'
+        filename = f'{magname}-{serial} line data.txt'
+        # Transform xyz and Bxyz to PCS, one matmul per array
+        data_raw = np.hstack((self.hp.mcs2pcs(data[:, :3]), data[:, 3:]))
+        # corr=np.array([[1, 0, 0], [0, 1, -0.00], [0, 0, 1]]) # Overhearing value found on ABEND-35 on date 2024-08-21.
+        data = np.hstack((data_raw[:, :3], self.hp.field2pcs(data[:, 3:])))
+        scan_file = self.create_scan_file(mag_folder + f'{magname}-{serial} line.scan', magnet_info, scan_parameters)
+        scan_file.write('line_raw', data_raw)
+        scan_file.write('line', data)
+        self.log_temperature(scan_file)
+        if self.export_text:
             np.savetxt('line_data_raw_Bxyz.txt', data_raw, delimiter=' ', fmt='%.3f')
-            for i, sample in enumerate(data):
-                data[i, :3] = self.hp.mcs2pcs(data[i, :3])
-                #data[i, 3:] = data[i, 3:] @ self.hp.s_matrix @ self.hp.rotation
-                corr=np.array([[1, 0, 0], [0, 1, -0.00], [0, 0, 1]]) # Overhearing value found on ABEND-35 on date 2024-08-21.
-                # data[i, 3:] = data[i, 3:] @ self.hp.s_matrix @ self.hp.rotation @ corr
-                data[i, 3:] = self.hp.rotation @ (self.hp.s_matrix @ data[i, 3:])
             np.save(mag_folder + f'{magname}-{serial} line.npy', data, allow_pickle=False)
             np.savetxt(mag_folder + filename, data, delimiter=' ', fmt='%.3f')
 
     def measure_area(self):
+        if self.cbox_sa_symmetry.get() != 'full':
+            self.measure_symmetric_area()
+            return
+        self.symmetry = None
         sa_args = self.get_area()
         magnet_info = self.load_magnet_info()
         magname, serial, current, notes = magnet_info
         mag_folder = f'scans/{magname}-{serial}/'
-        filename = f'{magname}-{serial} area data.txt'
         if not os.path.exists(mag_folder):
             os.makedirs(mag_folder)
         if sa_args is None:
             showerror(title='Entry Error', message='Entries should be integer or float values.')
         else:
-            data, filtered_array = self.hp.scan_area(*sa_args)
-            print(f'Raw data shape: {data.shape}')
-            print(f'Filtered data shape: {filtered_array.shape}')
-            print(f'Raw data type: {type(data)}')
-            print(f'Filtered data type: {type(filtered_array)}')
+            start_array, allocated_array, pd, samples, scan_direction = sa_args
+            scan_parameters = {'scan_type': 'area', 'start_point': self.hp.mcs2pcs(start_array[0]).tolist(),
+                               'scan_distance': [self.ent_sa_sd_x.get(), self.ent_sa_sd_y.get(), self.ent_sa_sd_z.get()],
+                               'point_density': pd, 'scan_plane': self.cbox_sa_scan_plane.get(),
+                               'scan_direction': scan_direction, 'num_lines': start_array.shape[0],
+                               'samples_per_line': int(samples), 'sample_rate': self.hp.sample_rate}
+            scan_file = self.create_scan_file(mag_folder + f'{magname}-{serial} area.scan', magnet_info, scan_parameters)
+            self.running_integrals = RunningIntegrals(scan_parameters['scan_plane'], scan_direction)
+            self.notify_scan_started(scan_parameters)
+            num_lines = start_array.shape[0]
+            # Filtered full resolution lines wrt mcs are appended as soon as each line finishes
+            self.start_scan(lambda: self.hp.scan_area(*sa_args, cancel=self.worker.cancel,
+                                                      line_callback=lambda i, line: self.worker.post(self.scan_line_finished, scan_file, line.copy(), i, num_lines)),
+                            lambda result: self.area_finished(result, scan_file, mag_folder, magname, serial, pd), scan_file)
+
+    def area_finished(self, result, scan_file, mag_folder, magname, serial, pt_density):
+        data, filtered_array = result
+        self.log_temperature(scan_file)
+        if self.worker.cancel.is_set():
+            scan_file.update_metadata(cancelled=True, lines_completed=data.shape[0])
+        if data.shape[0] == 0:
+            return
+        print(f'Raw data shape: {data.shape}')
+        print(f'Filtered data shape: {filtered_array.shape}')
+        print(f'Raw data type: {type(data)}')
+        print(f'Filtered data type: {type(filtered_array)}')
+        # Transform the full (m, n, 6) lines to PCS once, the reduced lines are a subsample of them
+        filtered_pcs = self.hp.scan2pcs(filtered_array)
+        data_2d = filtered_pcs[:, ::self.hp.reduction_step(filtered_array[0], pt_density)].reshape((-1, 6))
+        filtered_array_2d = filtered_pcs.reshape((-1, 6))
+        scan_file.write('area_mcs', data)
+        scan_file.write('area', data_2d)
+        scan_file.write('area_full', filtered_array_2d)
+        scan_file.update_metadata(finished=datetime.now().isoformat(timespec='seconds'), integrals=self.running_integrals.results)
+        if self.export_text:
             np.save(mag_folder + f'{magname}-{serial} raw area data.npy', data)
-            # Reshape array to shape (m*n, 6)
-            data_2d = data.reshape((data.shape[0]*data.shape[1], data.shape[2]))
-            filtered_array_2d = filtered_array.reshape((filtered_array.shape[0]*filtered_array.shape[1], filtered_array.shape[2]))
-            for i, point in enumerate(filtered_array_2d):
-                filtered_array_2d[i, :3] = self.hp.mcs2pcs(point[:3])
-                # filtered_array_2d[i, 3:] = point[3:] @ self.hp.s_matrix @ self.hp.rotation
-                filtered_array_2d[i, 3:] = self.hp.rotation @ (self.hp.s_matrix @ point[3:])
-            for i, point in enumerate(data_2d):
-                data_2d[i, :3] = self.hp.mcs2pcs(point[:3])
-                #dat   a_2d[i, 3:] = point[3:] @ self.hp.s_matrix @ self.hp.rotation
-                # corr=np.array([[1, 0, 0], [0, 1, -0.00], [0, 0, 1]]) # Overhearing value found on ABEND-35 on date 2024-08-21.
-                # data_2d[i, 3:] = point[3:] @ self.hp.s_matrix @ self.hp.rotation @ corr
-                data_2d[i, 3:] = self.hp.rotation @ (self.hp.s_matrix @ point[3:])
-            np.savetxt(mag_folder + filename, data_2d, delimiter=' ', fmt='%.3f')
+            np.savetxt(mag_folder + f'{magname}-{serial} area data.txt', data_2d, delimiter=' ', fmt='%.3f')
             np.savetxt(mag_folder + f'{magname}-{serial} area full res lines.txt', filtered_array_2d, delimiter=' ', fmt='%.3f')
 
+    def measure_symmetric_area(self):
+        '''
+        Measure the fundamental region of the selected symmetry plus verification lines,
+        then reconstruct the full map and report the consistency residuals
+        '''
+        try:
+            sym_args = self.get_symmetric_area()
+        except ValueError as e:
+            showerror(title='Symmetry Error', message=str(e))
+            return
+        if sym_args is None:
+            showerror(title='Entry Error', message='Entries should be integer or float values.')
+            return
+        fund_args, verification_args, (magnet, axes) = sym_args
+        magnet_info = self.load_magnet_info()
+        magname, serial, current, notes = magnet_info
+        mag_folder = f'scans/{magname}-{serial}/'
+        if not os.path.exists(mag_folder):
+            os.makedirs(mag_folder)
+        scan_plane = self.cbox_sa_scan_plane.get()
+        scan_direction = fund_args[4]
+        # Fixed for the whole scan, the comboboxes stay editable while it runs
+        self.symmetry = (magnet, axes, scan_plane, scan_direction)
+        scan_parameters = {'scan_type': 'area', 'symmetry': self.cbox_sa_symmetry.get(), 'mirror_axes': axes,
+                           'start_point': self.hp.mcs2pcs(fund_args[0][0]).tolist(),
+                           'scan_distance': [self.ent_sa_sd_x.get(), self.ent_sa_sd_y.get(), self.ent_sa_sd_z.get()],
+                           'point_density': fund_args[2], 'scan_plane': scan_plane,
+                           'scan_direction': scan_direction, 'num_lines': fund_args[0].shape[0],
+                           'samples_per_line': int(fund_args[3]), 'verification_lines': verification_args[0].shape[0],
+                           'sample_rate': self.hp.sample_rate}
+        scan_file = self.create_scan_file(mag_folder + f'{magname}-{serial} area.scan', magnet_info, scan_parameters)
+        self.running_integrals = RunningIntegrals(scan_plane, scan_direction)
+        self.notify_scan_started(scan_parameters)
+        num_lines = fund_args[0].shape[0] + verification_args[0].shape[0]
+
+        def scan():
+            fundamental = self.hp.scan_area(*fund_args, cancel=self.worker.cancel,
+                                            line_callback=lambda i, line: self.worker.post(self.scan_line_finished, scan_file, line.copy(), i, num_lines))
+            if self.worker.cancel.is_set():
+                return fundamental, None
+            print(f'Measuring {verification_args[0].shape[0]} verification lines')
+            verification = self.hp.scan_area(*verification_args, cancel=self.worker.cancel,
+                                             line_callback=lambda i, line: self.worker.post(self.verification_line_finished, scan_file, line.copy(),
+                                                                                            fund_args[0].shape[0] + i, num_lines))
+            return fundamental, verification
+
+        self.start_scan(scan, lambda result: self.symmetric_area_finished(result, scan_file, mag_folder, magname, serial, scan_plane, scan_direction, fund_args[2]),
+                        scan_file)
+
+    def symmetric_area_finished(self, result, scan_file, mag_folder, magname, serial, scan_plane, scan_direction, pt_density):
+        (data, filtered_array), verification_result = result
+        magnet, axes = self.symmetry[:2]
+        self.log_temperature(scan_file)
+        scan_file.write('area_mcs', data)
+        if verification_result is None or self.worker.cancel.is_set():
+            # Without the complete fundamental region and verification lines the map is not reconstructed
+            scan_file.update_metadata(cancelled=True, lines_completed=data.shape[0])
+            return
+        verification, filtered_verification = verification_result
+        # Reconstruct the full map wrt pcs from the fundamental region, transformed once at full resolution
+        filtered_pcs = self.hp.scan2pcs(filtered_array)
+        data_pcs = filtered_pcs[:, ::self.hp.reduction_step(filtered_array[0], pt_density)]
+        try:
+            data_2d = symmetry.reconstruct(data_pcs, magnet, axes, scan_plane, scan_direction).reshape((-1, 6))
+            filtered_full = symmetry.reconstruct(filtered_pcs, magnet, axes, scan_plane, scan_direction)
+        except ValueError as e:
+            scan_file.write('area_fundamental', data_pcs.reshape((-1, 6)))
+            scan_file.update_metadata(reconstruction_error=str(e))
+            showerror(title='Symmetry Error', message=f'Map not reconstructed: {e}')
+            return
+        filtered_verification = self.hp.scan2pcs(filtered_verification)
+        residuals = symmetry.residuals(filtered_full, filtered_verification, scan_plane, scan_direction)
+        summary = f'Symmetry residuals Bxyz rms: {np.round(residuals["rms"], 4)} max: {np.round(residuals["max"], 4)} mT'
+        print(summary)
+        self.lbl_sa_integrals.configure(text=self.running_integrals.summary() + '\n' + summary)
+        scan_file.write('area_fundamental', data_pcs.reshape((-1, 6)))
+        scan_file.write('verification', filtered_verification.reshape((-1, 6)))
+        scan_file.write('area', data_2d)
+        scan_file.write('area_full', filtered_full.reshape((-1, 6)))
+        scan_file.update_metadata(finished=datetime.now().isoformat(timespec='seconds'), integrals=self.running_integrals.results,
+                                  symmetry_residuals={'rms': residuals['rms'].tolist(), 'max': residuals['max'].tolist()})
+        if self.export_text:
+            np.savetxt(mag_folder + f'{magname}-{serial} area data.txt', data_2d, delimiter=' ', fmt='%.3f')
+            np.savetxt(mag_folder + f'{magname}-{serial} area full res lines.txt', filtered_full.reshape((-1, 6)), delimiter=' ', fmt='%.3f')
+
+    def measure_circle(self):
+        sc_args = self.get_circle()
+        magnet_info = self.load_magnet_info()
+        magname, serial, current, notes = magnet_info
+        mag_folder = f'scans/{magname}-{serial}/'
+        if not os.path.exists(mag_folder):
+            os.makedirs(mag_folder)
+        if sc_args is None:
+            showerror(title='Entry Error', message='Entries should be integer or float values, radius and z step > 0, segments >= 8.')
+        else:
+            center, radius, z_positions, num_segments = sc_args
+            scan_parameters = {'scan_type': 'circle', 'center': center[:2].tolist(), 'radius': radius,
+                               'z_positions': z_positions.tolist(), 'num_segments': num_segments,
+                               'scan_speed': self.hp.scan_speed, 'sample_rate': self.hp.sample_rate}
+            scan_file = self.create_scan_file(mag_folder + f'{magname}-{serial} circle.scan', magnet_info, scan_parameters)
+            self.start_scan(lambda: self.hp.scan_circles(center, radius, z_positions, num_segments, cancel=self.worker.cancel,
+                                                         circle_callback=lambda i, circle: self.worker.post(self.circle_finished, scan_file, center, radius,
+                                                                                                            z_positions[i], circle, i, len(z_positions))),
+                            lambda circles: self.circles_finished(circles, scan_file, len(z_positions)), scan_file)
+
+    def circles_finished(self, circles, scan_file, num_circles):
+        self.log_temperature(scan_file)
+        if len(circles) < num_circles:
+            scan_file.update_metadata(cancelled=True, circles_completed=len(circles))
+        else:
+            scan_file.update_metadata(finished=datetime.now().isoformat(timespec='seconds'))
+
+    def circle_finished(self, scan_file, center, radius, z, circle, i, num_circles):
+        '''
+        Store the circle (t, x, y, z, Bx, By, Bz) wrt pcs and its harmonics (z, n, B_n, A_n)
+        '''
+        scan_file.append(f'circle_{len(scan_file.chunks.get("harmonics", [])):03d}', circle)
+        self.log_temperature(scan_file)
+        n, normal, skew = circle_harmonics(circle, center, radius)
+        scan_file.append('harmonics', np.column_stack((np.full(n.shape, z), n, normal, skew)))
+        main = np.argmax(np.hypot(normal, skew)) + 1
+        b, a = relative_harmonics(normal, skew, main)
+        print(f'z = {z:.3f} mm, r = {radius:.3f} mm, main harmonic n = {main}: {np.hypot(normal, skew)[main-1]:.4f} mT')
+        for k in range(n.shape[0]):
+            print(f'n={n[k]:2d} b={b[k]:10.2f} a={a[k]:10.2f}')
+        self.lbl_sc_harmonics.configure(text=self.worker.progress(i + 1, num_circles, unit='Circle') + f'\nz = {z:.3f} mm  ' +
+                                        '  '.join(f'b{n[k]}={b[k]:.1f}' for k in range(min(6, n.shape[0]))))
+
+    def verification_line_finished(self, scan_file, line, i, num_lines):
+        scan_file.append('verification_lines_mcs', line)
+        self.lbl_sa_progress.configure(text=self.worker.progress(i + 1, num_lines))
+
+    def scan_line_finished(self, scan_file, line, i, num_lines):
+        '''
+        Store the finished line, update the running field integrals and the scan progress
+        '''
+        scan_file.append('lines_mcs', line)
+        self.log_temperature(scan_file)
+        line = self.hp.scan2pcs(line)
+        for listener in self.scan_listeners:
+            listener.line_finished(line, i)
+        if self.symmetry is None:
+            self.running_integrals.add_line(line)
+        else:
+            # Integrate the mirror images of the line as well so the fit sees the full map
+            try:
+                full_lines = symmetry.reconstruct(line[None], *self.symmetry)
+            except ValueError as e:
+                # The map could not be reconstructed, measuring the other lines is pointless
+                print(f'Symmetry Error: {e}')
+                self.worker.stop()
+                full_lines = line[None]
+            for full_line in full_lines:
+                self.running_integrals.add_line(full_line)
+        summary = self.running_integrals.summary()
+        progress = self.worker.progress(i + 1, num_lines)
+        print(f'{summary}\n{progress}')
+        self.lbl_sa_integrals.configure(text=summary)
+        self.lbl_sa_progress.configure(text=progress)
+
     def scan_point_widgets(self):
         self.lbl_scan_point = tk.Label(self.frm_scan_point, text='Scan Point')
         self.lbl_sp_x = tk.Label(self.frm_scan_point, text='X')
@@ -312,7 +711,10 @@ class MapFrames(tk.Frame):
         self.cbox_sa_scan_plane = ttk.Combobox(self.frm_scan_area, values=['xy', 'yz', 'zx'], state='readonly', width=9)
         self.cbox_sa_scan_direction = ttk.Combobox(self.frm_scan_area, values=self.scan_direction_list[0], state='readonly', width=9)
         self.btn_sa_measure = ttk.Button(self.frm_scan_area, text='Measure', command=self.measure_area)
-        self.btn_sa_stop = ttk.Button(self.frm_scan_area, text='Stop')
+        self.lbl_sa_symmetry = tk.Label(self.frm_scan_area, text='Symmetry')
+        self.cbox_sa_symmetry = ttk.Combobox(self.frm_scan_area, values=list(symmetry.SYMMETRY_MODES), state='readonly', width=18)
+        self.lbl_sa_integrals = tk.Label(self.frm_scan_area, text='', justify='left', wraplength=400)
+        self.lbl_sa_progress = tk.Label(self.frm_scan_area, text='', justify='left')
         # Place widgets within grid
         self.lbl_sa_sp.grid(column=0, row=0, columnspan=6)
         self.lbl_sa_sp_x.grid(column=0, row=1, sticky='e')
@@ -340,8 +742,52 @@ class MapFrames(tk.Frame):
         self.lbl_sa_scan_direction.grid(column=0, row=6, columnspan=2, pady=(0,5), sticky='e')
         self.cbox_sa_scan_direction.grid(column=2, row=6, columnspan=2, padx=5, pady=(0,5), sticky='w')
         self.cbox_sa_scan_direction.set('x')
-        self.btn_sa_measure.grid(column=4, row=5, columnspan=2, padx=5, pady=(5,0), sticky='ew')
-        self.btn_sa_stop.grid(column=4, row=6, columnspan=2, padx=5, pady=(0,5), sticky='ew')
+        self.btn_sa_measure.grid(column=4, row=5, columnspan=2, padx=5, pady=5, sticky='ew')
+        self.lbl_sa_symmetry.grid(column=0, row=7, columnspan=2, pady=(0,5), sticky='e')
+        self.cbox_sa_symmetry.grid(column=2, row=7, columnspan=4, padx=5, pady=(0,5), sticky='w')
+        self.cbox_sa_symmetry.set('full')
+        self.lbl_sa_integrals.grid(column=0, row=8, columnspan=6, padx=5, pady=(0,5), sticky='w')
+        self.lbl_sa_progress.grid(column=0, row=9, columnspan=6, padx=5, pady=(0,5), sticky='w')
+
+    def scan_circle_widgets(self):
+        self.lbl_sc_center = tk.Label(self.frm_scan_circle, text='Circle Center')
+        self.lbl_sc_c_x = tk.Label(self.frm_scan_circle, text='X')
+        self.lbl_sc_c_y = tk.Label(self.frm_scan_circle, text='Y')
+        self.lbl_sc_radius = tk.Label(self.frm_scan_circle, text='Radius')
+        self.ent_sc_c_x = ttk.Entry(self.frm_scan_circle, width=9)
+        self.ent_sc_c_y = ttk.Entry(self.frm_scan_circle, width=9)
+        self.ent_sc_radius = ttk.Entry(self.frm_scan_circle, width=9)
+        self.lbl_sc_z = tk.Label(self.frm_scan_circle, text='Z Positions')
+        self.lbl_sc_z_start = tk.Label(self.frm_scan_circle, text='Start')
+        self.lbl_sc_z_end = tk.Label(self.frm_scan_circle, text='End')
+        self.lbl_sc_z_step = tk.Label(self.frm_scan_circle, text='Step')
+        self.ent_sc_z_start = ttk.Entry(self.frm_scan_circle, width=9)
+        self.ent_sc_z_end = ttk.Entry(self.frm_scan_circle, width=9)
+        self.ent_sc_z_step = ttk.Entry(self.frm_scan_circle, width=9)
+        self.lbl_sc_segments = tk.Label(self.frm_scan_circle, text='Segments')
+        self.ent_sc_segments = ttk.Entry(self.frm_scan_circle, width=9)
+        self.btn_sc_measure = ttk.Button(self.frm_scan_circle, text='Measure', command=self.measure_circle)
+        self.lbl_sc_harmonics = tk.Label(self.frm_scan_circle, text='', justify='left', wraplength=400)
+        # Place widgets within grid
+        self.lbl_sc_center.grid(column=0, row=0, columnspan=6)
+        self.lbl_sc_c_x.grid(column=0, row=1, sticky='e')
+        self.lbl_sc_c_y.grid(column=2, row=1, sticky='e')
+        self.lbl_sc_radius.grid(column=4, row=1, sticky='e')
+        self.ent_sc_c_x.grid(column=1, row=1, padx=(5,10), sticky='w')
+        self.ent_sc_c_y.grid(column=3, row=1, padx=(5,10), sticky='w')
+        self.ent_sc_radius.grid(column=5, row=1, padx=(5,10), sticky='w')
+        self.lbl_sc_z.grid(column=0, row=2, columnspan=6)
+        self.lbl_sc_z_start.grid(column=0, row=3, sticky='e')
+        self.lbl_sc_z_end.grid(column=2, row=3, sticky='e')
+        self.lbl_sc_z_step.grid(column=4, row=3, sticky='e')
+        self.ent_sc_z_start.grid(column=1, row=3, padx=(5,10), sticky='w')
+        self.ent_sc_z_end.grid(column=3, row=3, padx=(5,10), sticky='w')
+        self.ent_sc_z_step.grid(column=5, row=3, padx=(5,10), sticky='w')
+        self.lbl_sc_segments.grid(column=0, row=4, columnspan=2, pady=(10,5), sticky='e')
+        self.ent_sc_segments.grid(column=2, row=4, columnspan=2, padx=5, pady=(10,5), sticky='w')
+        self.ent_sc_segments.insert(tk.END, '64')
+        self.btn_sc_measure.grid(column=4, row=4, columnspan=2, padx=5, pady=(10,5), sticky='ew')
+        self.lbl_sc_harmonics.grid(column=0, row=5, columnspan=6, padx=5, pady=(0,5), sticky='w')
 
 if __name__ == '__main__':
     test = tk.Tk()
@@ -0,0 +1,84 @@
+import numpy as np
+
+def circle_vertices(center, radius: float, num_segments=64):
+    '''
+    center: (3,) circle center wrt pcs, the circle lies in the xy plane around the magnet axis z
+    returns (num_segments+1, 3) polygon vertices wrt pcs, first and last vertex coincide
+    '''
+    theta = np.linspace(0, 2*np.pi, num_segments + 1)
+    vertices = np.zeros((num_segments + 1, 3)) + np.asarray(center, dtype=float)
+    vertices[:, 0] += radius * np.cos(theta)
+    vertices[:, 1] += radius * np.sin(theta)
+    return vertices
+
+def bin_by_angle(theta: np.ndarray, values: np.ndarray, num_bins=256):
+    '''
+    Resample samples onto num_bins equally spaced angles over one turn.
+    Samples are averaged per angular bin (at the mean angle of the bin) and the bin
+    means are interpolated periodically onto the bin centers, which also fills empty bins.
+    theta: (n,) angles in radians, values: (n,) or (n, m) array
+    returns (num_bins,) bin centers and (num_bins,) or (num_bins, m) values
+    '''
+    values = np.asarray(values, dtype=float)
+    flat = values.reshape((values.shape[0], -1))
+    theta = np.mod(theta, 2*np.pi)
+    bins = np.minimum((theta / (2*np.pi) * num_bins).astype(int), num_bins - 1)
+    counts = np.bincount(bins, minlength=num_bins)
+    filled = counts > 0
+    mean_theta = np.bincount(bins, weights=theta, minlength=num_bins)[filled] / counts[filled]
+    centers = (np.arange(num_bins) + 0.5) * 2*np.pi / num_bins
+    resampled = np.empty((num_bins, flat.shape[1]))
+    for k in range(flat.shape[1]):
+        means = np.bincount(bins, weights=flat[:, k], minlength=num_bins)[filled] / counts[filled]
+        resampled[:, k] = np.interp(centers, mean_theta, means, period=2*np.pi)
+    return centers, resampled.reshape((num_bins,) + values.shape[1:])
+
+def harmonics_fft(theta: np.ndarray, Bx: np.ndarray, By: np.ndarray, radius: float, reference_radius=None,
+                  num_harmonics=15, num_bins=256):
+    '''
+    Multipole decomposition of the field sampled on a circle around the magnet axis
+        By + iBx = sum (B_n + iA_n) (z / r_ref)^(n-1),  z = x + iy
+    theta: (n,) angle of every sample wrt pcs, Bx, By: (n,) field wrt pcs
+    radius: radius of the measured circle, reference_radius defaults to radius
+    returns (num_harmonics,) arrays n, normal B_n and skew A_n in field units
+    '''
+    reference_radius = radius if reference_radius is None else reference_radius
+    _, B = bin_by_angle(theta, np.column_stack((Bx, By)), num_bins)
+    # Forward fft of sum C_n e^{i(n-1)theta} on a uniform grid gives N C_n at index n-1
+    # Bins are centered half a bin from zero, remove that phase
+    half_bin = np.pi / num_bins
+    k = np.arange(num_harmonics)
+    C = np.fft.fft(B[:, 1] + 1j*B[:, 0])[:num_harmonics] / num_bins * np.exp(-1j*k*half_bin)
+    C *= (reference_radius / radius)**k
+    return k + 1, C.real, C.imag
+
+def relative_harmonics(normal: np.ndarray, skew: np.ndarray, main: int):
+    '''
+    returns normal b_n and skew a_n in units of 1e-4 of the main harmonic (main=2 for a quadrupole)
+    '''
+    B_main = np.hypot(normal[main-1], skew[main-1])
+    return normal / B_main * 1e4, skew / B_main * 1e4
+
+def circle_harmonics(circle_data: np.ndarray, center, radius: float, reference_radius=None, num_harmonics=15, num_bins=256):
+    '''
+    circle_data: (n, 6) or (n, 7) array (x, y, z, Bx, By, Bz) or (t, x, y, z, Bx, By, Bz) wrt pcs
+    center: (3,) circle center wrt pcs
+    returns n, normal B_n, skew A_n of the circle
+    '''
+    xyzB = circle_data[:, -6:]
+    theta = np.arctan2(xyzB[:, 1] - center[1], xyzB[:, 0] - center[0])
+    return harmonics_fft(theta, xyzB[:, 3], xyzB[:, 4], radius, reference_radius, num_harmonics, num_bins)
+
+
+if __name__ == '__main__':
+    # Synthetic quadrupole with a 10 unit sextupole and 5 unit skew octupole at r = 10 mm
+    r = 10
+    theta = np.sort(np.random.uniform(0, 2*np.pi, 20000))
+    z = r * np.exp(1j*theta)
+    G = 2.0
+    field = G*r*(z/r) + 1j*5e-4*G*r*(z/r)**3 + 10e-4*G*r*(z/r)**2
+    By, Bx = field.real, field.imag
+    n, normal, skew = harmonics_fft(theta, Bx, By, r)
+    b, a = relative_harmonics(normal, skew, main=2)
+    for i in range(6):
+        print(f'n={n[i]}: b={b[i]:9.3f} a={a[i]:9.3f}')
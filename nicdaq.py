@@ -2,6 +2,39 @@ import nidaqmx as ni
 import numpy as np
 from time import sleep
 
+# HallDAQ attribute: NI task name
+TASKS = {'hallsensor': 'HallSensor',
+         'magnet_temp': 'MagnetTemp',
+         'power_relay': 'PowerRelay',
+         'fsv': 'FSV',
+         'hall_sensitivity': 'HallSensitivity',
+         'trigger': 'StartTrigger'}
+
+def create_tasks():
+    '''
+    returns dict of the NI tasks with their channels, keyed by HallDAQ attribute.
+    Hall sensor timing and triggering are configured by each HallDAQ.
+    '''
+    tasks = {attr: ni.Task(name) for attr, name in TASKS.items()}
+    tasks['hallsensor'].ai_channels.add_ai_voltage_chan('FieldSensor/ai0:3')
+    tasks['power_relay'].ao_channels.add_ao_voltage_chan('AnalogOut/ao0')
+    tasks['trigger'].ao_channels.add_ao_voltage_chan('AnalogOut/ao2')
+    tasks['fsv'].ao_channels.add_ao_voltage_chan('AnalogOut/ao3')
+    tasks['hall_sensitivity'].ao_channels.add_ao_voltage_chan('AnalogOut/ao1')
+    tasks['magnet_temp'].ai_channels.add_ai_thrmcpl_chan('MagnetTemp/ai0:7',
+                                                         units=ni.constants.TemperatureUnits.DEG_C,
+                                                         thermocouple_type=ni.constants.ThermocoupleType.K)
+    tasks['magnet_temp'].timing.cfg_samp_clk_timing(HallDAQ.TEMP_RATE, sample_mode=ni.constants.AcquisitionType.CONTINUOUS,
+                                                    samps_per_chan=HallDAQ.TEMP_BUFFER)
+    return tasks
+
+def task_flag(name):
+    '''
+    Status flag of the tasks, kept in task_state so every HallDAQ on the same (shared) tasks sees it
+    '''
+    return property(lambda self: self.task_state.get(name, False),
+                    lambda self, value: self.task_state.__setitem__(name, value))
+
 class HallDAQ:
     POWER_ON = 1.3
     POWER_OFF = 0.0
@@ -11,47 +44,57 @@ class HallDAQ:
     SENSOR_RANGE = {'2T': 5,
                     '100MT': 0,
                     'OFF': 0}
+    # Thermocouples are read by the telemetry thread, independent of the hall sensor timing
+    TEMP_RATE = 2.0
+    TEMP_BUFFER = 600
+    power_status = task_flag('power_status')
+    hs_task_status = task_flag('hs_task_status')
+    mag_temp_task_status = task_flag('mag_temp_task_status')
     
-    def __init__(self, rate, samps_per_chan, start_trigger=False, acquisition='finite'):
+    def __init__(self, rate, samps_per_chan, start_trigger=False, acquisition='finite', session=None, user=None):
+        '''
+        session: hardware.HardwareSession to lease the shared tasks from (held until close_tasks),
+            user names the workflow for other windows.  Without a session the tasks are created here.
+        '''
         if acquisition.lower() == 'continuous':
             self.acquisition_type = ni.constants.AcquisitionType.CONTINUOUS
         elif acquisition.lower() == 'finite':
             self.acquisition_type = ni.constants.AcquisitionType.FINITE
         self.trigger_status = start_trigger
-        self.power_status = False
         self.fsv_status = False
         self.sensitivity_status = False
-        self.hs_task_status = False
-        self.mag_temp_task_status = False
         self.RATE = rate
         self.SAMPLES_CHAN = samps_per_chan
+        self.session = session
+        # Power and task flags belong to the tasks, shared tasks keep them on the session
+        self.task_state = {} if session is None else session.task_state
 
-        self.__create_tasks__()
-        self.__configure_tasks__()
+        if session is None:
+            self.__set_tasks__(create_tasks())
+            self.__configure_tasks__()
+        else:
+            session.acquire(self, user)
+            try:
+                self.__set_tasks__(session.daq_tasks())
+                self.__configure_tasks__()
+            except Exception:
+                session.release(self)
+                raise
     
-    def __create_tasks__(self):
-        self.hallsensor = ni.Task('HallSensor')
-        self.magnet_temp = ni.Task('MagnetTemp')
-        self.power_relay = ni.Task('PowerRelay')
-        self.fsv = ni.Task('FSV')
-        self.hall_sensitivity = ni.Task('HallSensitivity')
-        self.trigger = ni.Task('StartTrigger')
+    def __set_tasks__(self, tasks):
+        for attr, task in tasks.items():
+            setattr(self, attr, task)
     
     def __configure_tasks__(self):
-        self.hallsensor.ai_channels.add_ai_voltage_chan('FieldSensor/ai0:3')
+        '''
+        Hall sensor timing and start trigger of this acquisition, shared tasks keep their channels
+        '''
         self.hallsensor.timing.cfg_samp_clk_timing(self.RATE, sample_mode=self.acquisition_type,
                                                    samps_per_chan=self.SAMPLES_CHAN)
-        self.power_relay.ao_channels.add_ao_voltage_chan('AnalogOut/ao0')
         if self.trigger_status:
-            self.trigger.ao_channels.add_ao_voltage_chan('AnalogOut/ao2')
             self.hallsensor.triggers.start_trigger.cfg_dig_edge_start_trig('/MagnetcDAQ/PFI0')
-        self.fsv.ao_channels.add_ao_voltage_chan('AnalogOut/ao3')
-        self.hall_sensitivity.ao_channels.add_ao_voltage_chan('AnalogOut/ao1')
-        self.magnet_temp.ai_channels.add_ai_thrmcpl_chan('MagnetTemp/ai0:7',
-                                                         units=ni.constants.TemperatureUnits.DEG_C,
-                                                         thermocouple_type=ni.constants.ThermocoupleType.K)
-        self.magnet_temp.timing.cfg_samp_clk_timing(self.RATE, sample_mode=ni.constants.AcquisitionType.CONTINUOUS,
-                                                    samps_per_chan=self.SAMPLES_CHAN)
+        else:
+            self.hallsensor.triggers.start_trigger.disable_start_trig()
     
     def change_sampling(self, rate, num_samples):
         self.hallsensor.timing.cfg_samp_clk_timing(rate, samps_per_chan=num_samples)
@@ -65,6 +108,12 @@ class HallDAQ:
             pass
     
     def close_tasks(self):
+        if self.session is not None:
+            # Shared tasks stay open for the application run, only the lease ends
+            self.stop_hallsensor_task()
+            self.stop_magnet_temp_task()
+            self.session.release(self)
+            return
         self.hallsensor.close()
         self.fsv.close()
         self.magnet_temp.close()
@@ -112,9 +161,13 @@ class HallDAQ:
         return sample
         
     def read_magnet_temp(self):
-        while self.magnet_temp._in_stream.avail_samp_per_chan < self.SAMPLES_CHAN:
-            pass
-        sample = np.array(self.magnet_temp.read(self.magnet_temp._in_stream.avail_samp_per_chan)).T
+        '''
+        returns (n, 8) thermocouple samples acquired since the last read, n may be 0
+        '''
+        available = self.magnet_temp._in_stream.avail_samp_per_chan
+        if available == 0:
+            return np.zeros((0, 8))
+        sample = np.array(self.magnet_temp.read(available)).reshape((8, -1)).T
         return sample
 
     def start_hallsensor_task(self):
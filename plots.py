@@ -6,33 +6,121 @@ from tkinter import ttk
 from tkinter import filedialog
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 import beamcalc as bc
+from multipoles import relative_harmonics
+from dataloader import load_scan_data
 import scipy.constants as const
+from scipy.integrate import trapezoid
+from scipy.interpolate import RegularGridInterpolator
 np.set_printoptions(suppress=True)
 
+plane_step_across_dict = {'xy': {'x': 1, 'y': 0}, 'yz': {'y': 2, 'z': 1}, 'zx': {'z': 0, 'x': 2}}
+integration_dict = {'x': 0, 'y': 1, 'z': 2, 'Bx': 3, 'By': 4, 'Bz': 5}
+# Planar maps: transverse fits use at least this many lines per polynomial coefficient,
+# and harmonics are only evaluated on circles up to this fraction of the data half width
+LINES_PER_COEFFICIENT = 4
+REFERENCE_RADIUS_FRACTION = 2 / 3
+# Field grid of the dipole dashboard, part of every stage key after the interpolation
+GRID_PARAMS = {'ds': 0.0005, 'neighbors': 12, 'downsample_factor': 1, 'grid_tol': 1e-5}
+
+def line_index(coordinate: np.ndarray, steps: np.ndarray, scan_spacing: float):
+    '''
+    coordinate: (n,) array of the coordinate stepped across between scan lines
+    steps: (m,) array of nominal scan line positions spaced by scan_spacing
+    returns (n,) array of the scan line index of every sample,
+    -1 for samples not within scan_spacing / 2 of a scan line
+    '''
+    index = np.rint((coordinate - steps[0]) / scan_spacing).astype(int)
+    index = np.where((index >= 0) & (index < steps.shape[0]), index, -1)
+    on_line = np.abs(coordinate - steps[index.clip(0)]) < scan_spacing / 2
+    return np.where(on_line, index, -1)
+
 def integrate_lines_from_area(data: np.ndarray, scan_plane: str, scan_direction: str, scan_spacing: float):
     '''
     data: numpy array (x, y, z, Bx, By, Bz)
+        or (lines, samples, 6) array of scan lines straight from the scanner
     scan_plane: str 'xy', 'yz', 'zx'
     scan_direction: str 'x', 'y', 'z'
     scan_spacing: float (eg. 1.0)
     returns (n, 4) array of Bxyz integrals of each scan line
     '''
-    plane_step_across_dict = {'xy': {'x': 1, 'y': 0}, 'yz': {'y': 2, 'z': 1}, 'zx': {'z': 0, 'x': 2}}
-    integration_dict = {'x': 0, 'y': 1, 'z': 2, 'Bx': 3, 'By': 4, 'Bz': 5}
-    data_int_min = np.min(data[:, plane_step_across_dict[scan_plane][scan_direction]])
-    data_int_max = np.max(data[:, plane_step_across_dict[scan_plane][scan_direction]])
+    across = plane_step_across_dict[scan_plane][scan_direction]
+    along = integration_dict[scan_direction]
+    if data.ndim == 3:
+        # Lines are already grouped, trapezoid along the samples of every line at once
+        ds = np.diff(data[:, :, along], axis=1)[:, :, None]
+        dx_array_integrals = np.sum(ds * (data[:, 1:, 3:] + data[:, :-1, 3:]) / 2, axis=1)
+        return np.hstack((np.mean(data[:, :, across], axis=1)[:, None], dx_array_integrals))
+    data_int_min = np.min(data[:, across])
+    data_int_max = np.max(data[:, across])
     steps = np.arange(round(data_int_min, 2), round(data_int_max,2) + scan_spacing, scan_spacing)
+    # Group rows by scan line once, keeping the sample order within each line
+    index = line_index(data[:, across], steps, scan_spacing)
+    order = np.argsort(index, kind='stable')
+    order = order[index[order] >= 0]
+    line_id = index[order]
+    s = data[order, along]
+    B = data[order, 3:]
+    # Trapezoid increments between consecutive samples of the same line
+    same_line = line_id[1:] == line_id[:-1]
+    dx_array = (np.diff(s) * same_line)[:, None] * (B[1:] + B[:-1]) / 2
     integrals = np.zeros((steps.shape[0], 4))
-    for j, step in enumerate(steps):
-        line = data[(data[:, plane_step_across_dict[scan_plane][scan_direction]] > step - scan_spacing / 2) & (data[:, plane_step_across_dict[scan_plane][scan_direction]] < step + scan_spacing / 2)]
-        dx_array = np.zeros((line.shape[0], 3))
-        for i in range(1, line.shape[0]):
-            dx = line[i, integration_dict[scan_direction]] - line[i - 1, integration_dict[scan_direction]]
-            dx_array[i-1] = dx * (line[i, 3:] + line[i-1, 3:]) / 2
-        dx_array_integrals = np.sum(dx_array, axis=0)
-        integrals[j] = np.hstack((step, dx_array_integrals))
+    integrals[:, 0] = steps
+    for k in range(3):
+        integrals[:, k+1] = np.bincount(line_id[1:], weights=dx_array[:, k], minlength=steps.shape[0])
     return integrals
+
+def fit_longitudinal_profile(data: np.ndarray, scan_plane: str, scan_direction: str, scan_spacing: float, order=9):
+    '''
+    Transverse polynomial fit of Bx, By, Bz at every longitudinal station of an area map
+    data: numpy array (x, y, z, Bx, By, Bz) or (lines, samples, 6) array of scan lines
+    Lines are resampled onto common stations along scan_direction and all stations are
+    fit at once with a single pseudo-inverse of the Vandermonde matrix of the line positions.
+    order None uses the highest order the number of lines supports (LINES_PER_COEFFICIENT).
+    returns dict with
+        'z': (n_z,) stations along scan_direction
+        'steps': (n_lines,) line positions across
+        'coeffs': (order+1, n_z, 3) coefficients in increasing power for Bx, By, Bz
+    '''
+    across = plane_step_across_dict[scan_plane][scan_direction]
+    along = integration_dict[scan_direction]
+    if data.ndim == 3:
+        lines = list(data)
+    else:
+        steps = np.arange(round(np.min(data[:, across]), 2), round(np.max(data[:, across]), 2) + scan_spacing, scan_spacing)
+        index = line_index(data[:, across], steps, scan_spacing)
+        lines = [data[index == i] for i in np.unique(index[index >= 0])]
+    lines = [line[np.argsort(line[:, along], kind='stable')] for line in lines if line.shape[0] > 1]
+    # Common stations inside the range covered by every line, at the median sample spacing
+    s_min = max(line[0, along] for line in lines)
+    s_max = min(line[-1, along] for line in lines)
+    ds = np.median(np.concatenate([np.diff(line[:, along]) for line in lines]))
+    z = np.arange(s_min, s_max + ds / 2, ds)
+    steps = np.array([np.mean(line[:, across]) for line in lines])
+    B = np.array([[np.interp(z, line[:, along], line[:, 3+k]) for k in range(3)] for line in lines])
+    if order is None:
+        order = max(steps.shape[0] // LINES_PER_COEFFICIENT - 1, 1)
+    order = min(order, steps.shape[0] - 1)
+    pinv = np.linalg.pinv(np.vander(steps, order + 1, increasing=True))
+    # (order+1, lines) @ (lines, 3*n_z) for every station and component in one matmul
+    coeffs = (pinv @ B.reshape((steps.shape[0], -1))).reshape((order + 1, 3, z.shape[0])).transpose((0, 2, 1))
+    return {'z': z, 'steps': steps, 'coeffs': coeffs}
+
+def multipole_profile(profile: dict, component: int, reference_radius: float):
+    '''
+    profile: dict returned by fit_longitudinal_profile
+    component: 0 for Bx, 1 for By
+    returns gradient (n_z,) and relative harmonics (order+1, n_z) in units of 1e-4 of the
+    gradient field at reference_radius, row n is the coefficient of power n
+    '''
+    coeffs = profile['coeffs'][:, :, component]
+    gradient = coeffs[1]
+    powers = np.arange(coeffs.shape[0])[:, None]
+    main = gradient * reference_radius
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harmonics = np.where(np.abs(main) > 0, coeffs * reference_radius**powers / main * 1e4, np.nan)
+    return gradient, harmonics
         
 
 class PlotWindow(tk.Toplevel):
@@ -102,8 +190,12 @@ class PlotWindow(tk.Toplevel):
 
     def load_data(self, convert_to_gauss=True):
         filename = filedialog.askopenfilename(initialdir='./scans/', title='Select Data File',
-                                              filetypes=(('Text Files', '*.txt'), ('All Files', '*.*')))
-        self.data = np.genfromtxt(filename)
+                                              filetypes=(('Text Files', '*.txt'), ('Scan Files', '*.scan'), ('All Files', '*.*')))
+        try:
+            self.data = load_scan_data(filename)
+        except ValueError as e:
+            tk.messagebox.showerror('Data Error', str(e))
+            return
         self.filepath = os.path.dirname(filename)
         print(f'filename: {filename}\nfilepath: {self.filepath}')
         if convert_to_gauss:
@@ -132,9 +224,13 @@ class PlotWindow(tk.Toplevel):
                 x_max = float(self.ent_dp_x_max.get())
                 b_rho = float(self.ent_dp_b_rho.get())
                 z_step = float(self.ent_dp_z_step.get())
-                self.dipole_plot_dashboard = DipolePlotDashboard(self.data, self.filepath, x_pos, y_pos, z_pos, z_max, angle, x_min, x_max, b_rho, z_step)
             except ValueError:
                 tk.messagebox.showerror('Invalid Input', 'Please enter valid numbers')
+                return
+            try:
+                self.dipole_plot_dashboard = DipolePlotDashboard(self.data, self.filepath, x_pos, y_pos, z_pos, z_max, angle, x_min, x_max, b_rho, z_step)
+            except ValueError as e:
+                tk.messagebox.showerror('Dipole Analysis', str(e))
 
 class QuadPlotDashboard:
     plane_index = {'xy': (0, 1, 'x axis [cm]', 'y axis[cm]'),
@@ -150,6 +246,7 @@ class QuadPlotDashboard:
         self.filepath = filepath
         self.find_scan_parameters(self.data[:, :3])
         self.perform_fit()
+        self.fit_profile()
         self.generate_header()
         self.create_figs()
         self.create_subplots()
@@ -228,19 +325,42 @@ class QuadPlotDashboard:
         print(f'dml: {self.dipole_magnetic_length:.3f} cm')
         self.offset = (self.all_coeffs[0, self.coefficient_index[self.scan_plane][3]] / self.all_coeffs[1, self.coefficient_index[self.scan_plane][3]] * 10, self.all_coeffs[0, self.coefficient_index[self.scan_plane][2]] / self.all_coeffs[1, self.coefficient_index[self.scan_plane][3]] * 10)
     
+    def fit_profile(self):
+        '''
+        Transverse fit at every station along the scan direction
+        '''
+        self.profile = fit_longitudinal_profile(self.data, self.scan_plane, self.scan_direction, self.scan_spacing, order=None)
+        # Reference circle inside both the integration range and the measured lines
+        half_width = min((self.int_from_to[1] - self.int_from_to[0]) / 2, self.profile['steps'].max(), -self.profile['steps'].min())
+        self.reference_radius = REFERENCE_RADIUS_FRACTION * half_width
+        component = self.coefficient_index[self.scan_plane][1] if self.coefficient_index[self.scan_plane] is not None else 1
+        self.gradient_profile, self.harmonics_profile = multipole_profile(self.profile, component, self.reference_radius)
+        print(f'Integrated gradient from profile: {trapezoid(self.gradient_profile, self.profile["z"]):.1f} G')
+        if self.scan_plane in ('zx', 'yz'):
+            self.harmonics = map_harmonics(self.data, self.reference_radius, self.scan_plane, self.scan_direction, self.scan_spacing,
+                                           profile=self.profile)
+            main = np.hypot(self.harmonics['integrated_normal'][1], self.harmonics['integrated_skew'][1])
+            print(f'Integrated harmonics at r = {self.reference_radius:.2f} cm [units]')
+            for n, b, a in zip(self.harmonics['n'], self.harmonics['integrated_normal'], self.harmonics['integrated_skew']):
+                print(f'n={n:2d} b={b / main * 1e4:10.2f} a={a / main * 1e4:10.2f}')
+
     def create_figs(self):
         self.fig_p1 = plt.figure(figsize=(11, 8.5))
         self.fig_p2 = plt.figure(figsize=(11, 8.5))
+        self.fig_p3 = plt.figure(figsize=(11, 8.5))
         self.fig_p1.suptitle('3D Plots')
         self.fig_p2.suptitle('2D Plots')
+        self.fig_p3.suptitle('Longitudinal Profiles')
         self.fig_p2.subplots_adjust(hspace=0.37, wspace=0.3,left=0.1, right=0.95, top=0.9, bottom=0.05)
     
     def save_plots(self):
         # Save plots as pdf docs
         self.fig_p1.savefig(self.filepath + '/3d_plots.pdf')
         self.fig_p2.savefig(self.filepath + '/2d_plots.pdf')
+        self.fig_p3.savefig(self.filepath + '/profile_plots.pdf')
         self.fig_p1.savefig(self.filepath + '/3d_plots.png')
         self.fig_p2.savefig(self.filepath + '/2d_plots.png')
+        self.fig_p3.savefig(self.filepath + '/profile_plots.png')
     
     def create_subplots(self):
         # 3D plots - Page 1
@@ -281,6 +401,11 @@ class QuadPlotDashboard:
         self.text_info = self.fig_p2.add_subplot(326)
         self.text_info.axis('tight')
         self.text_info.set_axis_off()
+        # Profile plots - Page 3
+        self.plot_gradient = self.fig_p3.add_subplot(211)
+        self.plot_gradient.set_title('Gradient')
+        self.plot_harmonics = self.fig_p3.add_subplot(212)
+        self.plot_harmonics.set_title(f'Harmonics at r = {self.reference_radius:.2f} cm')
 
     
     def generate_header(self):
@@ -305,6 +430,7 @@ class QuadPlotDashboard:
         self.generate_2d_plot_324()
         self.generate_table()
         self.generate_text_info()
+        self.generate_profile_plots()
 
     def plot_3d_abs(self):
         Bxyz_abs = np.linalg.norm(self.data[:, 3:], axis=1)
@@ -392,11 +518,97 @@ class QuadPlotDashboard:
         
         self.fig_p2.text(0.6, 0.25, info, verticalalignment='top', bbox=self.bbox_props)
 
+    def generate_profile_plots(self):
+        z = self.profile['z']
+        self.plot_gradient.plot(z, self.gradient_profile)
+        self.plot_gradient.set_xlabel(f'{self.scan_direction} axis [cm]')
+        self.plot_gradient.set_ylabel('G [G/cm]')
+        self.plot_gradient.grid()
+        # Relative harmonics only make sense where the gradient is well above noise
+        inside = np.abs(self.gradient_profile) > 0.1 * np.max(np.abs(self.gradient_profile))
+        for n in range(2, min(6, self.harmonics_profile.shape[0])):
+            self.plot_harmonics.plot(z[inside], self.harmonics_profile[n, inside], label=f'n={n+1}')
+        self.plot_harmonics.set_xlabel(f'{self.scan_direction} axis [cm]')
+        self.plot_harmonics.set_ylabel('$b_n$ [units]')
+        self.plot_harmonics.legend()
+        self.plot_harmonics.grid()
+
     def show_plots(self):
         plt.show()
 
+def map_harmonics(data: np.ndarray, reference_radius: float, scan_plane=None, scan_direction='z', scan_spacing=None,
+                  num_harmonics=10, num_points=128, center=(0, 0), profile=None):
+    '''
+    Normal and skew multipoles of an existing field map on a circle of reference_radius
+    around the magnet axis (z) at every longitudinal station, all stations in one pass.
+        By + iBx = sum (B_n + iA_n) (z / r_ref)^(n-1),  z = x + iy
+    data: numpy array (x, y, z, Bx, By, Bz) or (lines, samples, 6) array of scan lines
+    Midplane maps (scan_plane 'zx' or 'yz') are fit per station with fit_longitudinal_profile
+    (or use profile if given) and the transverse polynomial is continued analytically onto the
+    circle around center.  The circle must lie within REFERENCE_RADIUS_FRACTION of the measured
+    lines and harmonics are limited to the order of the fit.
+    Volume maps on a regular x, y, z grid (scan_plane None) are interpolated onto the circles.
+    returns dict with 'z', 'n', 'normal' and 'skew' (n_z, num_harmonics) and their integrals over z
+    '''
+    theta = np.arange(num_points) * 2*np.pi / num_points
+    circle = reference_radius * np.exp(1j*theta)
+    if scan_plane in ('zx', 'yz'):
+        if profile is None:
+            profile = fit_longitudinal_profile(data, scan_plane, scan_direction, scan_spacing, order=None)
+        z = profile['z']
+        coeffs = profile['coeffs']
+        # By + iBx along the transverse axis u = x (or iy) is sum p_k u^k, so on the circle it is sum p_k (z_c / unit)^k
+        unit = 1 if scan_plane == 'zx' else 1j
+        center_u = center[0] if scan_plane == 'zx' else center[1]
+        half_width = min(profile['steps'].max() - center_u, center_u - profile['steps'].min())
+        if reference_radius > REFERENCE_RADIUS_FRACTION * half_width * (1 + 1e-9):
+            raise ValueError(f'Reference radius {reference_radius:.3g} is not inside the measured lines, '
+                             f'use at most {REFERENCE_RADIUS_FRACTION * half_width:.3g}')
+        num_harmonics = min(num_harmonics, coeffs.shape[0])
+        p = coeffs[:, :, 1] + 1j*coeffs[:, :, 0]
+        V = ((center[0] + 1j*center[1] + circle[:, None]) / unit)**np.arange(p.shape[0])
+        field = V @ p
+    elif scan_plane is None:
+        data = data.reshape((-1, 6))
+        axes = [np.unique(data[:, i]) for i in range(3)]
+        if np.prod([axis.shape[0] for axis in axes]) != data.shape[0]:
+            raise ValueError('Volume data must lie on a regular x, y, z grid')
+        order = np.lexsort((data[:, 2], data[:, 1], data[:, 0]))
+        grid = data[order, 3:5].reshape((axes[0].shape[0], axes[1].shape[0], axes[2].shape[0], 2))
+        interp = RegularGridInterpolator(axes, grid, method='cubic' if min(a.shape[0] for a in axes) > 3 else 'linear')
+        z = axes[2]
+        points = np.empty((num_points, z.shape[0], 3))
+        points[:, :, 0] = center[0] + circle.real[:, None]
+        points[:, :, 1] = center[1] + circle.imag[:, None]
+        points[:, :, 2] = z[None, :]
+        B = interp(points.reshape((-1, 3))).reshape((num_points, z.shape[0], 2))
+        field = B[:, :, 1] + 1j*B[:, :, 0]
+    else:
+        raise ValueError(f'Harmonics need a midplane (zx, yz) or volume map, not {scan_plane}')
+    C = np.fft.fft(field, axis=0)[:num_harmonics].T / num_points
+    normal, skew = C.real, C.imag
+    return {'z': z, 'n': np.arange(1, num_harmonics + 1), 'normal': normal, 'skew': skew,
+            'integrated_normal': trapezoid(normal, z, axis=0), 'integrated_skew': trapezoid(skew, z, axis=0)}
+
+def render_plot(function_name, args, save_file):
+    '''
+    Process pool worker: draw one beamcalc plot off screen and save it to save_file
+    '''
+    plt.switch_backend('Agg')
+    getattr(bc, function_name)(*args, save_file=save_file, show_plot=False)
+    plt.close('all')
+    return save_file
+
 class DipolePlotDashboard:
-    def __init__(self, data, filepath, *args):
+    '''
+    Dipole analysis pipeline: interpolate -> optimal trajectory -> field on trajectory -> multipoles -> plots.
+    Every stage is stored on disk (bc.GRID_CACHE_DIR) under a hash of its parameters and the key of the
+    stage it depends on, so changing the beam rigidity or step size only recomputes the trajectory and
+    the stages after it.  Plots are rendered in a process pool while the next stage runs, and are not
+    rendered again when the figures in filepath were last drawn from the same stage keys.
+    Data is in mm and mT, positions are entered in mm.
+    '''
+    def __init__(self, data, filepath, *args, reference_radius=10.0, cache_dir=bc.GRID_CACHE_DIR):
         self.data = data
         self.filepath = filepath
         self.x_pos = args[0]
@@ -408,17 +620,99 @@ class DipolePlotDashboard:
         self.x_max = args[6]
         self.b_rho = args[7]
         self.z_step = args[8]
-        self.process_data()
-        self.create_plots()
-    
+        self.reference_radius = reference_radius
+        self.cache_dir = cache_dir
+        self.plot_jobs = []
+        self.executor = ProcessPoolExecutor(max_workers=3)
+        try:
+            self.process_data()
+            self.create_plots()
+        finally:
+            self.executor.shutdown()
+
     def process_data(self):
-        self.hp_interp, self.xyzB_grid, self.x_mesh, self.z_mesh, self.B_grid = bc.interpolate_grid(self.data)
+        # interpolate_grid keeps its own disk cache of the field grid
+        self.hp_interp, self.xyzB_grid, self.x_mesh, self.z_mesh, self.B_grid = bc.interpolate_grid(self.data, cache_dir=self.cache_dir,
+                                                                                                    **GRID_PARAMS)
+        grid_key = bc.stage_key(bc.stage_key(self.data), interpolator=type(self.hp_interp).__name__, **GRID_PARAMS)
+        trajectory_key = bc.stage_key(grid_key, teta_in=self.angle / 2, x_min=self.x_min, x_max=self.x_max,
+                                      z_pos=self.z_pos, z_max=self.z_max, z_step=self.z_step, b_rho=self.b_rho)
+        field_key = bc.stage_key(trajectory_key)
+        multipoles_key = bc.stage_key(field_key, reference_radius=self.reference_radius)
+        self.plots_key = multipoles_key
+        self.rendered = self.plots_rendered()
+        self.submit_plot('plot_field_map', (self.x_mesh, self.z_mesh, self.B_grid), 'Figure 1 colormap.pdf')
+        self.trajectory = bc.memoize_stage('trajectory', trajectory_key, self.optimal_trajectory, self.cache_dir)
+        self.submit_plot('plot_trajectory', (self.trajectory['xyzB'], self.trajectory['xy_prime']), 'Figure 2 trajectory.pdf')
+        self.field = bc.memoize_stage('field', field_key, self.trajectory_field, self.cache_dir)
+        self.submit_plot('plot_coeffs', (self.trajectory['xyzB'][:, 2], self.field['b_pf'], self.field['a_pf'],
+                                         self.field['int_b_pf'], self.field['int_a_pf']), 'Figure 3 multipoles')
+        self.multipoles = bc.memoize_stage('multipoles', multipoles_key, self.integrated_multipoles, self.cache_dir)
+
+    def optimal_trajectory(self):
+        teta_in = np.radians(self.angle) / 2
+        xyzB, xy_prime, xc = bc.find_optimal_start(self.hp_interp, self.xyzB_grid, teta_in, self.x_min / 1000, self.x_max / 1000,
+                                                   self.z_pos / 1000, self.z_max / 1000, self.z_step / 1000, self.b_rho, show_plot=False)
+        return {'xyzB': xyzB, 'xy_prime': xy_prime, 'xc': np.array(xc)}
+
+    def trajectory_field(self):
+        b_pf, a_pf, int_b_pf, int_a_pf = bc.field_on_traj(self.trajectory['xyzB'], self.trajectory['xy_prime'], self.hp_interp,
+                                                          delta=self.z_step / 1000)
+        return {'b_pf': b_pf, 'a_pf': a_pf, 'int_b_pf': int_b_pf, 'int_a_pf': int_a_pf}
+
+    def integrated_multipoles(self):
+        '''
+        Integrated normal B_n and skew A_n (T m) at the reference radius, n = 1 is the dipole,
+        and b_n, a_n in units of 1e-4 of the dipole
+        '''
+        # Polynomial coefficients are highest power first
+        scale = (self.reference_radius / 1000)**np.arange(self.field['int_b_pf'].shape[0])
+        normal = np.flip(self.field['int_b_pf']) * scale
+        skew = np.flip(self.field['int_a_pf']) * scale
+        b, a = relative_harmonics(normal, skew, main=1)
+        return {'n': np.arange(1, normal.shape[0] + 1), 'normal': normal, 'skew': skew, 'b': b, 'a': a}
+
+    def plot_files(self):
+        return [os.path.join(self.filepath, filename) for filename in ('Figure 1 colormap.pdf', 'Figure 2 trajectory.pdf',
+                'Figure 3 multipoles_1.pdf', 'Figure 3 multipoles_2.pdf', 'Figure 3 multipoles_3.pdf')]
+
+    def rendered_marker(self):
+        '''
+        File in the cache holding the stage key the figures in filepath were last drawn from
+        '''
+        return os.path.join(self.cache_dir, f'plots-{bc.stage_key(os.path.abspath(self.filepath))}.txt')
+
+    def plots_rendered(self):
+        try:
+            with open(self.rendered_marker()) as f:
+                key = f.read().strip()
+        except OSError:
+            return False
+        return key == self.plots_key and all(os.path.isfile(filename) for filename in self.plot_files())
+
+    def submit_plot(self, function_name, args, filename):
+        if self.rendered:
+            return
+        self.plot_jobs.append(self.executor.submit(render_plot, function_name, args, os.path.join(self.filepath, filename)))
 
     def create_plots(self):
         print(f'filepath: {self.filepath}')
-        bc.plot_field_map(self.x_mesh, self.z_mesh, self.B_grid,
-                          save_file=self.filepath + '/Figure 1 colormap.pdf', show_plot=False)
-        
+        print(f'xc = {float(self.trajectory["xc"]) * 1000:.4f} mm, '
+              f'harmonics at r = {self.reference_radius} mm in units of 1e-4 of B1 = {self.multipoles["normal"][0]:.5f} T m')
+        for n, b, a in zip(self.multipoles['n'], self.multipoles['b'], self.multipoles['a']):
+            print(f'n={n}: b={b:9.3f} a={a:9.3f}')
+        if self.rendered:
+            print('Figures are up to date, not rendered again')
+            return
+        for job in self.plot_jobs:
+            print(f'Saved {job.result()}')
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.rendered_marker(), 'w') as f:
+                f.write(self.plots_key)
+        except OSError:
+            print('Could not write plot cache marker')
+
 
 if __name__ == '__main__':
     root = tk.Tk()
@@ -0,0 +1,209 @@
+import numpy as np
+import os
+from datetime import datetime
+from calibration import get_xyz_calib_values
+
+REGISTRY_FILE = 'probe_registry.npz'
+ITEMS = {'coeffs': (3, 3, 7),
+         'zg_offset': (3,),
+         's_matrix': (3, 3),
+         'fsv_offset': (3,)}
+
+_registry_cache = {}
+
+class ProbeCalibration:
+    '''
+    Calibration state of a single hall probe.
+    coeffs are the manufacturer coefficients (3, 3, 7) as read from CalibrationX/Y/Z.txt
+    zg_offset is the zero gauss offset (3,) in volts
+    s_matrix is the (3, 3) sensitivity matrix from the cube qualification
+    fsv_offset is the (3,) probe offset wrt mcs from the fsv qualification
+    timestamps holds the time each item was last recorded
+    '''
+    def __init__(self, serial: str, coeffs, zg_offset, s_matrix, fsv_offset, timestamps=None):
+        self.serial = serial
+        self.coeffs = np.asarray(coeffs, dtype=float)
+        self.zg_offset = np.asarray(zg_offset, dtype=float)
+        self.s_matrix = np.asarray(s_matrix, dtype=float)
+        self.fsv_offset = np.asarray(fsv_offset, dtype=float)
+        self.timestamps = dict.fromkeys(ITEMS, '') if timestamps is None else dict(timestamps)
+        self.__validate__()
+        self.calib_coeffs = self.coeffs.copy()
+        self.calib_coeffs[:, 2, 0] = -self.zg_offset
+
+    def __repr__(self):
+        return f'Hall Probe {self.serial} Calibration'
+
+    def __validate__(self):
+        for item, shape in ITEMS.items():
+            if getattr(self, item).shape != shape:
+                raise ValueError(f'Probe {self.serial}: {item} has shape {getattr(self, item).shape}, expected {shape}')
+        if not np.all(np.isfinite(self.coeffs)):
+            raise ValueError(f'Probe {self.serial}: calibration coefficients are not finite')
+
+    def missing(self):
+        '''
+        returns list of qualification items that have not been recorded yet
+        '''
+        return [item for item in ITEMS if not self.timestamps.get(item) or not np.all(np.isfinite(getattr(self, item)))]
+
+class ProbeRegistry:
+    '''
+    Registry of hall probe calibrations keyed by probe serial (eg. '443-20').
+    All probes are stored in a single npz bundle and kept in memory after loading.
+    '''
+    def __init__(self, filename=REGISTRY_FILE):
+        self.filename = filename
+        self.probes = {}
+        self.active = None
+        if os.path.isfile(filename):
+            self.__load__()
+
+    def __repr__(self):
+        return f'Probe Registry {list(self.probes)}'
+
+    def __load__(self):
+        with np.load(self.filename, allow_pickle=False) as bundle:
+            serials = [str(i) for i in bundle['serials']]
+            for serial in serials:
+                items = {item: bundle[f'{serial}/{item}'] for item in ITEMS}
+                timestamps = dict(zip(ITEMS, [str(i) for i in bundle[f'{serial}/timestamps']]))
+                self.probes[serial] = ProbeCalibration(serial, timestamps=timestamps, **items)
+            active = str(bundle['active'])
+        self.active = active if active in self.probes else None
+
+    def save(self):
+        bundle = {'serials': np.array(list(self.probes), dtype=str),
+                  'active': np.array('' if self.active is None else self.active)}
+        for serial, probe in self.probes.items():
+            for item in ITEMS:
+                bundle[f'{serial}/{item}'] = getattr(probe, item)
+            bundle[f'{serial}/timestamps'] = np.array([probe.timestamps[item] for item in ITEMS], dtype=str)
+        # Write to a temporary file first so a failed save never corrupts the registry
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as file:
+            np.savez(file, **bundle)
+        os.replace(tmp_filename, self.filename)
+        _registry_cache[os.path.abspath(self.filename)] = (os.stat(self.filename).st_mtime_ns, self)
+
+    def serials(self):
+        return list(self.probes)
+
+    def get(self, serial=None):
+        '''
+        returns ProbeCalibration of serial, or of the active probe if serial is None
+        '''
+        serial = self.active if serial is None else serial
+        if serial not in self.probes:
+            raise KeyError(f'Probe {serial} is not in the registry {self.serials()}')
+        return self.probes[serial]
+
+    def select(self, serial):
+        self.get(serial)
+        self.active = serial
+
+    def register(self, serial, calib_folder, zg_offset=None):
+        '''
+        Parse CalibrationX/Y/Z.txt from calib_folder once and add/replace probe serial.
+        Existing qualification values of the probe are kept, a new probe has none recorded
+        until it is qualified (or its legacy files are imported with import_legacy).
+        '''
+        coeffs = get_xyz_calib_values(calib_folder)
+        now = datetime.now().isoformat(timespec='seconds')
+        if serial in self.probes:
+            probe = self.probes[serial]
+            items = {item: getattr(probe, item) for item in ITEMS}
+            timestamps = dict(probe.timestamps)
+        else:
+            items = {'zg_offset': np.zeros(3), 's_matrix': np.full((3, 3), np.nan), 'fsv_offset': np.full(3, np.nan)}
+            timestamps = dict.fromkeys(ITEMS, '')
+        items['coeffs'] = coeffs
+        timestamps['coeffs'] = now
+        self.probes[serial] = ProbeCalibration(serial, timestamps=timestamps, **items)
+        if zg_offset is not None:
+            self.update(serial, zg_offset=zg_offset)
+        self.active = serial
+        return self.probes[serial]
+
+    def update(self, serial=None, **items):
+        '''
+        Record new qualification values (zg_offset, s_matrix, fsv_offset) for a probe
+        '''
+        probe = self.get(serial)
+        now = datetime.now().isoformat(timespec='seconds')
+        values = {item: getattr(probe, item) for item in ITEMS}
+        timestamps = dict(probe.timestamps)
+        for item, value in items.items():
+            if item not in ITEMS:
+                raise KeyError(f'Unknown calibration item: {item}')
+            values[item] = np.asarray(value, dtype=float).reshape(ITEMS[item])
+            timestamps[item] = now
+        self.probes[probe.serial] = ProbeCalibration(probe.serial, timestamps=timestamps, **values)
+        return self.probes[probe.serial]
+
+def legacy_items(zg_offset_file='zg_offset.txt', sensitivity_file='sensitivity.npy', fsv_offset_file='fsv_offset.txt'):
+    '''
+    returns {item: (value, file modification time)} of the legacy qualification files that exist
+    '''
+    items = {}
+    for item, filename, load in (('zg_offset', zg_offset_file, np.genfromtxt),
+                                 ('s_matrix', sensitivity_file, np.load),
+                                 ('fsv_offset', fsv_offset_file, np.genfromtxt)):
+        if os.path.isfile(filename):
+            timestamp = datetime.fromtimestamp(os.path.getmtime(filename)).isoformat(timespec='seconds')
+            items[item] = (np.asarray(load(filename), dtype=float).reshape(ITEMS[item]), timestamp)
+    return items
+
+def load_registry(filename=REGISTRY_FILE):
+    '''
+    returns the ProbeRegistry of filename.  The bundle is only read from disk
+    again if the file changed since it was last loaded.
+    '''
+    key = os.path.abspath(filename)
+    mtime = os.stat(filename).st_mtime_ns if os.path.isfile(filename) else None
+    if key in _registry_cache and _registry_cache[key][0] == mtime:
+        return _registry_cache[key][1]
+    registry = ProbeRegistry(filename)
+    _registry_cache[key] = (mtime, registry)
+    return registry
+
+def update_active_probe(filename=REGISTRY_FILE, **items):
+    '''
+    Store qualification results for the active probe if a registry exists.
+    Used by the zero gauss, fsv and cube routines alongside their legacy text/npy files.
+    '''
+    if not os.path.isfile(filename):
+        return None
+    registry = load_registry(filename)
+    if registry.active is None:
+        return None
+    probe = registry.update(**items)
+    registry.save()
+    return probe
+
+def serial_from_folder(calib_folder: str):
+    '''
+    'Hall probe 443-20' -> '443-20'
+    '''
+    return os.path.basename(os.path.normpath(calib_folder)).split()[-1]
+
+def import_legacy(serial, calib_folder, zg_offset_file='zg_offset.txt', sensitivity_file='sensitivity.npy',
+                  fsv_offset_file='fsv_offset.txt', filename=REGISTRY_FILE):
+    '''
+    Build a registry entry from the files written by the qualification routines,
+    the files must belong to probe serial.  Items are stamped with the file modification times.
+    '''
+    registry = load_registry(filename)
+    registry.register(serial, calib_folder)
+    legacy = legacy_items(zg_offset_file, sensitivity_file, fsv_offset_file)
+    probe = registry.update(serial, **{item: value for item, (value, _) in legacy.items()})
+    probe.timestamps = {**probe.timestamps, **{item: timestamp for item, (_, timestamp) in legacy.items()}}
+    registry.save()
+    return probe
+
+
+if __name__ == '__main__':
+    probe = import_legacy('444-20', 'Hall probe 444-20')
+    print(probe)
+    print(f'missing items: {probe.missing()}')
+    print(load_registry())
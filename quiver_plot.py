@@ -2,8 +2,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from zeisscmm import transform_points
+from dataloader import load_scan_data
 
-data = np.genfromtxt('scan_data.txt', delimiter=' ', skip_header=1)
+data = np.array(load_scan_data('scan_data.txt', skip_header=1))
 data = data[:, :-1]
 coord_diff = np.genfromtxt('test_program/mag_test_mcs.txt', delimiter=' ')
 R = coord_diff[:9].reshape((3,3))
@@ -0,0 +1,156 @@
+import numpy as np
+import zipfile
+import json
+import os
+from datetime import datetime
+
+SCAN_EXT = '.scan'
+# Fast deflate level, scan data is written while the CMM is waiting
+COMPRESS_LEVEL = 1
+
+class ScanFile:
+    '''
+    Binary container for hall probe scan results.
+    The file is a compressed zip archive of npy members, so it can also be
+    opened with np.load.  Layout:
+        meta/NNNNNN.json            metadata revisions (magnet info, scan parameters, ...)
+        meta/<name>.npy             alignment and probe calibration arrays
+        data/<dataset>/NNNNNN.npy   chunks of a dataset, concatenated in order on read
+    Chunks are written as they arrive, so lines can be appended during a scan and
+    the lines finished before a cancelled or failed scan are kept.  Each append
+    rewrites the zip central directory though, a crash or power loss in the middle
+    of an append can leave the whole file unreadable.
+    '''
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.chunks = {}
+        self.metadata = {}
+        self.arrays = {}
+        self.meta_revisions = 0
+        if os.path.isfile(filename):
+            self.__scan_members__()
+
+    def __repr__(self):
+        return f'Scan File {self.filename} {self.datasets()}'
+
+    @classmethod
+    def create(cls, filename: str, magnet_info=None, scan_parameters=None, arrays=None):
+        '''
+        Create a new (or overwrite an existing) scan file.
+        magnet_info is the ['magnet name', 'serial number', 'current', 'notes'] list
+        scan_parameters is a dict of json serializable values
+        arrays is a dict of numpy arrays (eg. rotation, translation, s_matrix, calib_coeffs)
+        '''
+        with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL):
+            pass
+        scan_file = cls(filename)
+        metadata = {'created': datetime.now().isoformat(timespec='seconds')}
+        if magnet_info is not None:
+            metadata['magnet_info'] = dict(zip(['name', 'serial', 'current', 'notes'], magnet_info))
+        if scan_parameters is not None:
+            metadata['scan_parameters'] = scan_parameters
+        scan_file.update_metadata(**metadata)
+        if arrays is not None:
+            with zipfile.ZipFile(filename, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf:
+                for name, array in arrays.items():
+                    scan_file.__write_member__(zf, f'meta/{name}.npy', np.asarray(array))
+                    scan_file.arrays[name] = np.asarray(array)
+        return scan_file
+
+    def __scan_members__(self):
+        with zipfile.ZipFile(self.filename, 'r') as zf:
+            names = sorted(zf.namelist())
+            for name in names:
+                parts = name.split('/')
+                if parts[0] == 'data' and len(parts) == 3:
+                    self.chunks.setdefault(parts[1], []).append(name)
+                elif parts[0] == 'meta' and name.endswith('.json'):
+                    self.metadata.update(json.loads(zf.read(name).decode('utf-8')))
+                    self.meta_revisions += 1
+                elif parts[0] == 'meta' and name.endswith('.npy'):
+                    with zf.open(name) as member:
+                        self.arrays[parts[1][:-4]] = np.lib.format.read_array(member, allow_pickle=False)
+
+    def __write_member__(self, zf, name, array):
+        with zf.open(name, 'w', force_zip64=True) as member:
+            np.lib.format.write_array(member, np.ascontiguousarray(array), allow_pickle=False)
+
+    def update_metadata(self, **items):
+        '''
+        Add or replace metadata entries.  Each update is stored as a new revision.
+        '''
+        with zipfile.ZipFile(self.filename, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf:
+            zf.writestr(f'meta/{self.meta_revisions:06d}.json', json.dumps(items, default=str))
+        self.meta_revisions += 1
+        self.metadata.update(items)
+
+    def append(self, dataset: str, array: np.ndarray, dtype=np.float64):
+        '''
+        Append array as the next chunk of dataset.  Chunks must share trailing dimensions.
+        '''
+        chunks = self.chunks.setdefault(dataset, [])
+        name = f'data/{dataset}/{len(chunks):06d}.npy'
+        with zipfile.ZipFile(self.filename, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf:
+            self.__write_member__(zf, name, np.asarray(array, dtype=dtype))
+        chunks.append(name)
+
+    def write(self, dataset: str, array: np.ndarray, dtype=np.float64, chunk_rows=100000):
+        '''
+        Write a complete dataset split into chunks of chunk_rows rows
+        '''
+        if dataset in self.chunks:
+            raise ValueError(f'Dataset {dataset} already exists in {self.filename}')
+        array = np.asarray(array, dtype=dtype)
+        self.chunks[dataset] = []
+        with zipfile.ZipFile(self.filename, 'a', compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf:
+            for i, start in enumerate(range(0, max(array.shape[0], 1), chunk_rows)):
+                name = f'data/{dataset}/{i:06d}.npy'
+                self.__write_member__(zf, name, array[start:start+chunk_rows])
+                self.chunks[dataset].append(name)
+
+    def datasets(self):
+        return list(self.chunks)
+
+    def read(self, dataset: str, stack=False):
+        '''
+        returns the chunks of dataset concatenated along the first axis,
+        or stacked along a new first axis if stack is True (eg. appended scan lines)
+        '''
+        if dataset not in self.chunks:
+            raise KeyError(f'Dataset {dataset} not in {self.filename}: {self.datasets()}')
+        with zipfile.ZipFile(self.filename, 'r') as zf:
+            chunks = []
+            for name in self.chunks[dataset]:
+                with zf.open(name) as member:
+                    chunks.append(np.lib.format.read_array(member, allow_pickle=False))
+        if stack:
+            return np.stack(chunks)
+        return np.concatenate(chunks, axis=0)
+
+    def export_text(self, dataset: str, filename: str, fmt='%.3f'):
+        '''
+        Convert a dataset to the space delimited text format used by earlier scans
+        '''
+        data = self.read(dataset)
+        np.savetxt(filename, data.reshape((-1, data.shape[-1])), delimiter=' ', fmt=fmt)
+
+def export_magnet_info(scan_file: ScanFile):
+    '''
+    returns magnet info list ['magnet name', 'serial number', 'current', 'notes']
+    in the same order as magnet_info.pkl
+    '''
+    info = scan_file.metadata.get('magnet_info', {})
+    return [info.get(i, '') for i in ['name', 'serial', 'current', 'notes']]
+
+
+if __name__ == '__main__':
+    import sys
+    # Convert scan file datasets to text: python scanfile.py "scans/AQD-0024/AQD-0024 area.scan"
+    for scan_filename in sys.argv[1:]:
+        scan = ScanFile(scan_filename)
+        print(scan)
+        print(json.dumps(scan.metadata, indent=2))
+        for dataset in scan.datasets():
+            text_filename = f'{os.path.splitext(scan_filename)[0]} {dataset}.txt'
+            scan.export_text(dataset, text_filename)
+            print(f'{dataset} -> {text_filename}')
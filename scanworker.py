@@ -0,0 +1,88 @@
+import threading
+import queue
+from time import perf_counter
+
+class ScanWorker:
+    '''
+    Runs a scan in a background thread so the Tk mainloop stays responsive.
+    The worker never touches widgets: it posts calls to a queue which the mainloop
+    drains every poll_ms with after().  Scans check the cancel event at line boundaries.
+    '''
+    def __init__(self, widget, poll_ms=100):
+        self.widget = widget
+        self.poll_ms = poll_ms
+        self.queue = queue.Queue()
+        self.cancel = threading.Event()
+        self.thread = None
+        self.start_time = None
+
+    def __repr__(self):
+        return f'Scan Worker {"running" if self.running() else "idle"}'
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, target, on_done=None, on_error=None):
+        '''
+        Run target() in the background, on_done(result) or on_error(exception) are called in the mainloop
+        '''
+        if self.running():
+            raise RuntimeError('A scan is already running')
+        self.cancel.clear()
+        self.start_time = perf_counter()
+        self.thread = threading.Thread(target=self.__run__, args=(target, on_done, on_error), name='ScanWorker', daemon=True)
+        self.thread.start()
+        self.widget.after(self.poll_ms, self.__poll__)
+
+    def __run__(self, target, on_done, on_error):
+        try:
+            result = target()
+        except Exception as e:
+            print(f'Scan failed: {e!r}')
+            if on_error is not None:
+                self.post(on_error, e)
+            return
+        if on_done is not None:
+            self.post(on_done, result)
+
+    def post(self, func, *args):
+        '''
+        Called from the worker thread, func(*args) runs in the mainloop
+        '''
+        self.queue.put((func, args))
+
+    def __poll__(self):
+        self.drain()
+        if self.running() or not self.queue.empty():
+            self.widget.after(self.poll_ms, self.__poll__)
+
+    def stop(self):
+        '''
+        Request a cooperative stop, the scan ends at the next line boundary
+        '''
+        if self.running():
+            print('Stopping scan after the current line')
+            self.cancel.set()
+
+    def drain(self):
+        '''
+        Run the calls posted so far in the calling (main) thread, eg. after join before the widget is destroyed
+        '''
+        while True:
+            try:
+                func, args = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            func(*args)
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def progress(self, done: int, total: int, unit='Line'):
+        '''
+        returns progress text with elapsed time and the estimated time remaining
+        '''
+        elapsed = perf_counter() - self.start_time
+        remaining = elapsed / done * (total - done) if done > 0 else float('nan')
+        return f'{unit} {done}/{total}, elapsed {elapsed / 60:.1f} min, ETA {remaining / 60:.1f} min'
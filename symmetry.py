@@ -0,0 +1,130 @@
+import numpy as np
+
+axis_index = {'x': 0, 'y': 1, 'z': 2}
+# Sign of (Bx, By, Bz) when mirroring coordinate x, y or z about the magnet center (pcs origin)
+PARITY = {'dipole': {'x': np.array([-1, 1, 1]), 'y': np.array([-1, 1, -1]), 'z': np.array([1, 1, -1])},
+          'quadrupole': {'x': np.array([1, -1, -1]), 'y': np.array([-1, 1, -1]), 'z': np.array([1, 1, -1])}}
+# Symmetry mode: (magnet type, mirror axes used when they lie in the scan plane)
+SYMMETRY_MODES = {'full': (None, ()),
+                  'dipole mirror': ('dipole', ('y', 'z')),
+                  'quadrupole quadrant': ('quadrupole', ('x', 'y', 'z'))}
+
+def mirror_axes(symmetry: str, scan_plane: str):
+    '''
+    returns (magnet type, list of mirror axes) of symmetry within scan_plane
+    '''
+    magnet, axes = SYMMETRY_MODES[symmetry]
+    axes = [axis for axis in axes if axis in scan_plane]
+    if magnet is not None and not axes:
+        raise ValueError(f'{symmetry} symmetry has no mirror plane in the {scan_plane} scan plane')
+    return magnet, axes
+
+def across_axis(scan_plane: str, scan_direction: str):
+    return ''.join([i for i in scan_plane if i != scan_direction])
+
+def mirror(data: np.ndarray, magnet: str, axis: str):
+    '''
+    data: (..., 6) array (x, y, z, Bx, By, Bz) wrt pcs
+    returns data reflected through the plane axis = 0 with the field parity of magnet
+    '''
+    mirrored = np.array(data, dtype=float)
+    mirrored[..., axis_index[axis]] *= -1
+    mirrored[..., 3:] *= PARITY[magnet][axis]
+    return mirrored
+
+def fundamental_region(start_point, scan_distance, pt_density: float, scan_direction: str, axes, lead_in=0.0):
+    '''
+    Clip the scan rectangle (start_point, scan_distance wrt pcs) to the positive side of every mirror axis.
+    Lines across keep their original grid so the line on the symmetry plane is measured.
+    Along the scan direction the lines start lead_in (run-up and filter trim of a scan line,
+    HallProbe.lead_in) plus one point before the symmetry plane, so the kept samples cover it.
+    returns new start_point, scan_distance
+    '''
+    start_point = np.array(start_point, dtype=float)
+    scan_distance = np.array(scan_distance, dtype=float)
+    for axis in axes:
+        i = axis_index[axis]
+        low, high = start_point[i], start_point[i] + scan_distance[i]
+        if not low < 0 < high:
+            raise ValueError(f'Scan area does not contain the {axis} = 0 symmetry plane')
+        if axis == scan_direction:
+            new_low = -(lead_in + pt_density)
+        else:
+            new_low = low + np.ceil(-low / pt_density - 1e-9) * pt_density
+        start_point[i] = new_low
+        scan_distance[i] = high - new_low
+    return start_point, scan_distance
+
+def verification_positions(start_point, scan_distance, pt_density: float, scan_plane: str, scan_direction: str, axes, num_lines=2):
+    '''
+    Across positions of full length verification lines.  They are taken from the mirrored
+    half of the original line grid if the across axis is a mirror axis.
+    returns (num_lines,) array of across coordinates wrt pcs
+    '''
+    i = axis_index[across_axis(scan_plane, scan_direction)]
+    positions = start_point[i] + np.arange(0, scan_distance[i] + pt_density, pt_density)
+    if across_axis(scan_plane, scan_direction) in axes:
+        positions = positions[positions < -pt_density / 2]
+    if positions.shape[0] == 0 or num_lines < 1:
+        return positions[:0]
+    return np.unique(positions[np.linspace(0, positions.shape[0] - 1, num_lines).round().astype(int)])
+
+def __line_tolerance__(coordinate: np.ndarray):
+    spacing = np.abs(np.diff(np.sort(coordinate)))
+    spacing = spacing[spacing > 0]
+    return spacing.min() / 2 if spacing.shape[0] else 1e-2
+
+def reconstruct(lines: np.ndarray, magnet: str, axes, scan_plane: str, scan_direction: str):
+    '''
+    Build the full map from lines measured in the fundamental region.
+    lines: (m, n, 6) array of scan lines (x, y, z, Bx, By, Bz) wrt pcs
+    Samples and lines lying on a symmetry plane are not duplicated, samples measured
+    before the plane along the scan direction are replaced by the mirrored half.
+    Raises ValueError if the lines do not reach the symmetry plane along the scan direction.
+    returns (m', n', 6) array of lines ordered by across and along coordinate
+    '''
+    along = axis_index[scan_direction]
+    across = axis_index[across_axis(scan_plane, scan_direction)]
+    lines = np.asarray(lines, dtype=float)
+    for axis in axes:
+        mirrored = mirror(lines, magnet, axis)
+        if axis == scan_direction:
+            tol = __line_tolerance__(lines[0, :, along])
+            s = np.mean(lines[:, :, along], axis=0)
+            if s.min() > tol:
+                raise ValueError(f'Scan lines start at {axis} = {s.min():.3f}, they do not reach the {axis} = 0 symmetry plane')
+            lines = lines[:, s > -tol]
+            mirrored = mirrored[:, s > -tol]
+            keep = np.abs(np.mean(mirrored[:, :, along], axis=0)) > tol
+            lines = np.concatenate((mirrored[:, keep], lines), axis=1)
+        else:
+            tol = __line_tolerance__(np.mean(lines[:, :, across], axis=1)) if lines.shape[0] > 1 else 1e-2
+            keep = np.abs(np.mean(mirrored[:, :, across], axis=1)) > tol
+            lines = np.concatenate((mirrored[keep], lines), axis=0)
+    lines = np.take_along_axis(lines, np.argsort(lines[:, :, along], axis=1)[:, :, None], axis=1)
+    return lines[np.argsort(np.mean(lines[:, :, across], axis=1), kind='stable')]
+
+def residuals(reconstructed: np.ndarray, verification: np.ndarray, scan_plane: str, scan_direction: str):
+    '''
+    Compare measured verification lines with the reconstructed map.
+    reconstructed: (m, n, 6) lines from reconstruct, verification: (k, l, 6) measured lines wrt pcs
+    returns dict with rms and max (3,) residual of Bxyz and (k, l, 3) residuals (nan where not comparable)
+    '''
+    along = axis_index[scan_direction]
+    across = axis_index[across_axis(scan_plane, scan_direction)]
+    line_positions = np.mean(reconstructed[:, :, across], axis=1)
+    tol = __line_tolerance__(line_positions) if line_positions.shape[0] > 1 else np.inf
+    line_residuals = np.full(verification.shape[:2] + (3,), np.nan)
+    for k, line in enumerate(verification):
+        nearest = np.argmin(np.abs(line_positions - np.mean(line[:, across])))
+        if np.abs(line_positions[nearest] - np.mean(line[:, across])) > tol:
+            continue
+        s = reconstructed[nearest, :, along]
+        inside = (line[:, along] >= s[0]) & (line[:, along] <= s[-1])
+        for c in range(3):
+            line_residuals[k, inside, c] = line[inside, 3+c] - np.interp(line[inside, along], s, reconstructed[nearest, :, 3+c])
+    flat = line_residuals.reshape((-1, 3))
+    flat = flat[np.all(np.isfinite(flat), axis=1)]
+    if flat.shape[0] == 0:
+        return {'rms': np.full(3, np.nan), 'max': np.full(3, np.nan), 'residuals': line_residuals}
+    return {'rms': np.sqrt(np.mean(flat**2, axis=0)), 'max': np.max(np.abs(flat), axis=0), 'residuals': line_residuals}
@@ -0,0 +1,100 @@
+import numpy as np
+import threading
+from time import time
+
+class RingBuffer:
+    '''
+    Fixed size buffer of rows, the oldest rows are overwritten once it is full
+    '''
+    def __init__(self, capacity: int, columns: int):
+        self.data = np.full((capacity, columns), np.nan)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.data.shape[0])
+
+    def append(self, row):
+        self.data[self.count % self.data.shape[0]] = row
+        self.count += 1
+
+    def rows(self, since=0):
+        '''
+        returns rows appended after row number since (oldest first) and the current row number
+        '''
+        capacity = self.data.shape[0]
+        since = max(since, self.count - capacity)
+        index = np.arange(since, self.count) % capacity
+        return self.data[index].copy(), self.count
+
+
+class TemperatureTelemetry:
+    '''
+    Low rate magnet temperature acquisition in its own thread.
+    Every period seconds the thermocouple samples buffered by the continuous MagnetTemp
+    task (HallDAQ.TEMP_RATE) are averaged into one row together with the CMM workpiece
+    temperature, so a ring buffer of capacity rows covers capacity * period seconds.
+    Rows are (time [s since epoch], 8 thermocouples, workpiece) in deg C.
+    The thermocouple task is separate from the hall sensor task, and CMM queries go
+    through the CMM lock, so telemetry does not disturb a running scan.
+    '''
+    columns = ['time'] + [f'channel {i}' for i in range(8)] + ['workpiece']
+
+    def __init__(self, daq=None, cmm=None, period=5.0, capacity=4320):
+        self.daq = daq
+        self.cmm = cmm
+        self.period = period
+        self.buffer = RingBuffer(capacity, len(self.columns))
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __repr__(self):
+        return f'Temperature Telemetry {len(self.buffer)} rows every {self.period} s'
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        if self.daq is not None:
+            self.daq.start_magnet_temp_task()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.__run__, name='MagnetTempTelemetry', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.daq is not None:
+            self.daq.stop_magnet_temp_task()
+
+    def __run__(self):
+        while not self.stop_event.wait(self.period):
+            try:
+                row = self.sample()
+            except Exception as e:
+                print(f'Temperature telemetry read failed: {e!r}')
+                continue
+            with self.lock:
+                self.buffer.append(row)
+
+    def sample(self):
+        '''
+        returns one telemetry row, nan for sources that are not connected or had no new samples
+        '''
+        row = np.full(len(self.columns), np.nan)
+        row[0] = time()
+        if self.daq is not None:
+            thermocouples = self.daq.read_magnet_temp()
+            if thermocouples.shape[0] > 0:
+                row[1:9] = np.mean(thermocouples, axis=0)
+        if self.cmm is not None:
+            row[9] = self.cmm.get_workpiece_temp()
+        return row
+
+    def rows(self, since=0):
+        '''
+        Thread safe copy of the rows appended after row number since,
+        returns (n, 10) rows and the row number to pass next time
+        '''
+        with self.lock:
+            return self.buffer.rows(since)
@@ -1,15 +1,20 @@
 from time import sleep
 import numpy as np
 import socket
+import threading
 import re
+from frames import Frame
 
 class CMM(socket.socket):
     '''
     Creates a TCP connection to the Zeiss CMM.
+    Queries hold lock from send to recv, so threads (scan, telemetry) sharing
+    the connection never read each other's responses.
     '''
     def __init__(self, ip='192.4.1.200', port=4712):
         super().__init__(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((ip, port))
+        self.lock = threading.RLock()
         self.cnc_status = False
         self.speed = None
         # self.position = None
@@ -19,8 +24,9 @@ class CMM(socket.socket):
         return 'Zeiss CMM Object'
 
     def get_status(self):
-        self.send('D16\r\n\x01'.encode('ascii'))
-        self.status = self.recv(1024).decode('ascii')
+        with self.lock:
+            self.send('D16\r\n\x01'.encode('ascii'))
+            self.status = self.recv(1024).decode('ascii')
         return self.status
     
     def cnc_on(self):
@@ -51,25 +57,29 @@ class CMM(socket.socket):
         self.send(f'G03X{xyz[0]}Y{xyz[1]}Z{xyz[2]}\r\n'.encode('ascii'))
 
     def get_position(self):
-        self.send('D84\r\n\x01'.encode('ascii'))
-        position_str = self.recv(1024).decode('ascii')
+        with self.lock:
+            self.send('D84\r\n\x01'.encode('ascii'))
+            position_str = self.recv(1024).decode('ascii')
         return np.array([float(i) for i in re.findall(r'[+-]\d+\.\d+', position_str)])
     
     def get_positions(self):
-        self.send('D17\r\n\x01'.encode('ascii'))
-        position_str = self.recv(1024).decode('ascii')
+        with self.lock:
+            self.send('D17\r\n\x01'.encode('ascii'))
+            position_str = self.recv(1024).decode('ascii')
         position_np = np.array([float(i) for i in re.findall(r'[+-]\d*\.\d+', position_str)])
         return (position_np[:3], position_np[4:])
     
     def get_lag_distance(self):
-        self.send('D19\r\n\x01'.encode('ascii'))
-        lag = self.recv(1024).decode('ascii')
+        with self.lock:
+            self.send('D19\r\n\x01'.encode('ascii'))
+            lag = self.recv(1024).decode('ascii')
         lag_np = np.array([float(i) for i in re.findall(r'[-\+]\d*\.\d+', lag)][:3])
         return lag_np
     
     def get_workpiece_temp(self):
-        self.send('D07\r\n\x01'.encode('ascii'))
-        response = self.recv(1024).decode('ascii')
+        with self.lock:
+            self.send('D07\r\n\x01'.encode('ascii'))
+            response = self.recv(1024).decode('ascii')
         temp = [float(i) for i in re.findall(r'\d+\.\d+', response)]
         avg_temp = (temp[2] + temp[3]) / 2
         return avg_temp
@@ -126,33 +136,12 @@ def transform_points(xyz_array, translation, rotation, inverse=False):
     rotation is a (3,3) array
     use inverse=True to go from mcs to pcs coordinates
     '''
-    xyz_array_copy = xyz_array.copy()
+    # rotation@point + translation for every point
+    frame = Frame.from_affine(np.asarray(rotation).T, translation)
     if not inverse:
-        if xyz_array.ndim == 1:
-            xyz_array_copy = rotation@xyz_array + translation
-        
-        elif xyz_array.ndim == 2:
-            for i, point in enumerate(xyz_array):
-                xyz_array_copy[i] = rotation@point + translation
-
-        elif xyz_array.ndim == 3:
-            for i, height in enumerate(xyz_array):
-                for j, point in enumerate(height):
-                    xyz_array_copy[i, j] = rotation@point + translation
-
+        return frame.to_mcs(xyz_array)
     else:
-        if xyz_array.ndim == 1:
-            xyz_array_copy = np.linalg.inv(rotation)@(xyz_array - translation)
-        
-        elif xyz_array.ndim == 2:
-            for i, point in enumerate(xyz_array):
-                xyz_array_copy[i] = np.linalg.inv(rotation)@(point - translation)
-
-        elif xyz_array.ndim == 3:
-            for i, height in enumerate(xyz_array):
-                for j, point in enumerate(height):
-                    xyz_array_copy[i, j] = np.linalg.inv(rotation)@(point - translation)
-    return xyz_array_copy
+        return frame.from_mcs(xyz_array)
 
 if __name__ == '__main__':
     with CMM() as test:
@@ -2,24 +2,30 @@ import numpy as np
 from nicdaq import HallDAQ
 import tkinter as tk
 from tkinter import ttk
+from tkinter.messagebox import showerror
+from hardware import HardwareSession, HardwareBusy
+from probes import update_active_probe
 from PIL import Image, ImageTk
 
 class ZeroGauss:
-    def __init__(self):
-        self.daq = HallDAQ(1, 20000)
+    def __init__(self, session=None):
+        self.daq = HallDAQ(1, 20000, session=session, user='Zero Gauss Offset')
     
     def measure_offset(self):
-        self.daq.power_on()
-        self.daq.start_hallsensor_task()
-        data = self.daq.read_hallsensor()[6250:13750]
-        self.daq.stop_hallsensor_task()
-        self.daq.power_off()
-        self.daq.close_tasks()
+        try:
+            self.daq.power_on()
+            self.daq.start_hallsensor_task()
+            data = self.daq.read_hallsensor()[6250:13750]
+        finally:
+            self.daq.stop_hallsensor_task()
+            self.daq.power_off()
+            self.daq.close_tasks()
         self.zg_offset = np.mean(data, axis=0)
     
     def save_offset(self, filename):
         with open(filename, 'w') as file:
             file.write(f'{self.zg_offset[0]} {self.zg_offset[1]} {self.zg_offset[2]}\n')
+        update_active_probe(zg_offset=self.zg_offset)
 
 class zgWindow(tk.Toplevel):
     def __init__(self, parent):
@@ -43,7 +49,12 @@ class zgWindow(tk.Toplevel):
         self.btn_zg_run.bind('<Button-1>', lambda event: self.lbl_desc.configure(text='Please wait.  Recording samples...'))
     
     def run_zg(self):
-        zg = ZeroGauss()
+        try:
+            zg = ZeroGauss(HardwareSession.instance())
+        except HardwareBusy as e:
+            showerror(title='Hardware Busy', message=str(e))
+            self.lbl_desc.configure(text='Move probe into zero gauss chamber as shown.')
+            return
         zg.measure_offset()
         zg.save_offset('zg_offset.txt')
         self.lbl_desc.configure(text='Signal offset saved.  You may now close the window.')